@@ -0,0 +1,239 @@
+"""
+Index of the backups kept in the backup storage, to avoid listing and parsing
+the whole storage for each lookup.
+"""
+
+import contextlib
+import json
+import logging
+import threading
+from datetime import datetime
+
+from django.core.files.base import ContentFile
+
+from dbbackup import settings, utils
+
+logger = logging.getLogger("dbbackup.storage")
+
+CATALOG_VERSION = 1
+
+
+def make_entry(filename):
+    """
+    Parse a backup file name into a catalog entry.
+
+    :param filename: Backup file's name
+    :type filename: ``str``
+
+    :returns: Catalog entry
+    :rtype: ``dict``
+    """
+    backup = utils.parse_backup_name(filename)
+    return {
+        "datetime": backup.date.isoformat() if backup.date else None,
+        "content_type": backup.content_type,
+        "encrypted": backup.encrypted,
+        "compressed": backup.compressed,
+    }
+
+
+class BackupCatalog:
+    """
+    JSON index of backup files kept next to them in the backup storage. It is
+    loaded once, updated when a backup is written or deleted through
+    :class:`dbbackup.storage.Storage`, and rebuilt from the storage's listing
+    if missing or unreadable. It can be shared by the threads of a parallel
+    backup, updates are serialized by a lock.
+
+    Entries only depend on file names, so rebuilding the catalog loses
+    nothing: a catalog lost while it is replaced is rebuilt by the next load.
+    The catalog is read again before each update, or each :meth:`batch` of
+    updates, but concurrent processes updating it at the same time can still
+    drop each other's entries, it assumes a single writer at a time.
+    """
+
+    def __init__(self, storage, filename=None):
+        """
+        :param storage: Storage whose backups are indexed
+        :type storage: :class:`dbbackup.storage.Storage`
+
+        :param filename: Name of the catalog in the storage
+        :type filename: ``str``
+        """
+        self.storage = storage
+        self.filename = filename or settings.CATALOG_FILENAME
+        self._entries = None
+        self._lock = threading.RLock()
+        self._batching = False
+        self._changed = False
+
+    @property
+    def entries(self):
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            return self._entries
+
+    def _read(self):
+        """Return the entries of the stored catalog, or ``None`` if missing or unreadable."""
+        if not self.storage.storage.exists(self.filename):
+            return None
+        try:
+            with self.storage.storage.open(self.filename, "rb") as fd:
+                content = json.loads(fd.read().decode("utf-8"))
+            if content.get("version") == CATALOG_VERSION:
+                return content["backups"]
+            logger.warning("Unsupported backup catalog version %s", content.get("version"))
+        except (OSError, ValueError, KeyError, AttributeError):
+            logger.warning("Backup catalog %s is unreadable", self.filename, exc_info=True)
+        return None
+
+    def _load(self):
+        entries = self._read()
+        if entries is None:
+            logger.info("Building the backup catalog from the storage's listing")
+            entries = self._list_storage()
+            self._save(entries)
+        return entries
+
+    def _refresh(self):
+        """Take into account the updates saved by other processes since the catalog was loaded."""
+        entries = self._read() if self._entries is not None else None
+        if entries is not None:
+            self._entries = entries
+
+    def _list_storage(self):
+        return {
+            name: make_entry(name) for name in self.storage.list_directory() if utils.parse_backup_name(name).is_backup
+        }
+
+    def _save(self, entries):
+        content = json.dumps({"version": CATALOG_VERSION, "backups": entries}, sort_keys=True)
+        # Most storages don't overwrite existing files but rename the new one
+        if self.storage.storage.exists(self.filename):
+            self.storage.storage.delete(self.filename)
+        self.storage.storage.save(self.filename, ContentFile(content.encode("utf-8")))
+
+    def _begin_update(self):
+        if not self._batching:
+            self._refresh()
+
+    def _end_update(self):
+        if self._batching:
+            self._changed = True
+        else:
+            self._save(self.entries)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group the updates made in the block: the stored catalog is read again
+        once before them, and saved once after them, even if the block fails.
+        Other threads updating the catalog wait for the end of the block.
+        """
+        with self._lock:
+            if self._batching:
+                yield
+                return
+            self._refresh()
+            self._batching = True
+            self._changed = False
+            try:
+                yield
+            finally:
+                self._batching = False
+                if self._changed:
+                    self._save(self.entries)
+
+    def add(self, filename):
+        """
+        Index a new backup file, other files are ignored.
+
+        :param filename: File's name
+        :type filename: ``str``
+        """
+        if not utils.parse_backup_name(filename).is_backup:
+            return
+        entry = make_entry(filename)
+        with self._lock:
+            self._begin_update()
+            self.entries[filename] = entry
+            self._end_update()
+
+    def remove(self, filename):
+        """
+        Remove a file from the index, files that aren't backups are never
+        indexed and are ignored.
+
+        :param filename: File's name
+        :type filename: ``str``
+        """
+        if not utils.parse_backup_name(filename).is_backup:
+            return
+        with self._lock:
+            self._begin_update()
+            if self.entries.pop(filename, None) is not None:
+                self._end_update()
+
+    def reconcile(self):
+        """
+        Rebuild the index from the storage's listing, to take into account
+        files written or deleted without dbbackup.
+
+        :returns: Names of the files added and removed
+        :rtype: ``tuple`` of ``set``
+        """
+        with self._lock:
+            entries = self._list_storage()
+            added = entries.keys() - self.entries.keys()
+            removed = self.entries.keys() - entries.keys()
+            self._entries = entries
+            self._save(entries)
+        return set(added), set(removed)
+
+    def query(
+        self,
+        encrypted=None,
+        compressed=None,
+        content_type=None,
+        database=None,
+        servername=None,
+        start=None,
+        end=None,
+    ):
+        """
+        List indexed backups matching the filters, like
+        :meth:`dbbackup.storage.Storage.list_backups`. If filter is None, it
+        won't be used.
+
+        :param start: Keep backups made at or after this date
+        :type start: :class:`datetime.datetime` or ``None``
+
+        :param end: Keep backups made before this date
+        :type end: :class:`datetime.datetime` or ``None``
+
+        :returns: List of files with their date, oldest first
+        :rtype: ``list`` of (``str``, :class:`datetime.datetime` or ``None``)
+        """
+        with self._lock:
+            entries = list(self.entries.items())
+        files = []
+        for name, entry in entries:
+            if encrypted is not None and entry["encrypted"] != encrypted:
+                continue
+            if compressed is not None and entry["compressed"] != compressed:
+                continue
+            if content_type and entry["content_type"] != content_type:
+                continue
+            if database and database not in name:
+                continue
+            if servername and servername not in name:
+                continue
+            date = datetime.fromisoformat(entry["datetime"]) if entry["datetime"] else None
+            if start is not None and utils.get_sort_date(date) < utils.get_sort_date(start):
+                continue
+            if end is not None and utils.get_sort_date(date) >= utils.get_sort_date(end):
+                continue
+            files.append((name, date))
+        files.sort(key=lambda item: utils.get_sort_date(item[1]))
+        return files
@@ -3,8 +3,9 @@ from datetime import datetime
 
 from django.core.checks import Tags, register
 from django.core.checks import Warning as DjangoWarning
+from django.utils.module_loading import import_string
 
-from dbbackup import settings
+from dbbackup import compression, encryption, settings
 
 W001 = DjangoWarning(
     "Invalid HOSTNAME parameter",
@@ -49,6 +50,31 @@ W008 = DjangoWarning(
 # W009: Historical - "Using removed DBBACKUP_STORAGE parameter"
 # W010: Historical - "Using removed DBBACKUP_STORAGE_OPTIONS parameter"
 
+W011 = DjangoWarning(
+    "Invalid COMPRESSION parameter",
+    hint="settings.DBBACKUP_COMPRESSION['CODEC'] must be one of: " + ", ".join(compression.CODECS),
+    id="dbbackup.W011",
+)
+
+W012 = DjangoWarning(
+    "Invalid ENCRYPTION parameter",
+    hint="settings.DBBACKUP_ENCRYPTION['BACKEND'] must be one of: "
+    + ", ".join(encryption.BACKENDS)
+    + " or the import path of an encryption backend",
+    id="dbbackup.W012",
+)
+
+
+def check_encryption_backend():
+    name = settings.ENCRYPTION.get("BACKEND", encryption.DEFAULT_BACKEND)
+    if name in encryption.BACKENDS:
+        return []
+    try:
+        import_string(name)
+    except ImportError:
+        return [W012]
+    return []
+
 
 def check_filename_templates():
     return _check_filename_template(
@@ -96,6 +122,10 @@ def check_settings(app_configs, **kwargs):
     if re.search(r"[^A-Za-z0-9%_-]", settings.DATE_FORMAT):
         errors.append(W005)
 
+    if settings.COMPRESSION.get("CODEC", compression.DEFAULT_CODEC) not in compression.CODECS:
+        errors.append(W011)
+
+    errors += check_encryption_backend()
     errors += check_filename_templates()
 
     return errors
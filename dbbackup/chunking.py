@@ -0,0 +1,333 @@
+"""
+Content-addressed chunk store, used to deduplicate database dumps.
+
+A dump is split in chunks whose boundaries depend on the content, so data
+inserted or removed in a dump only changes the chunks around it. Each unique
+chunk is stored once in the backup storage under its SHA-256, and the backup
+itself is a manifest listing the chunks to concatenate.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import posixpath
+import zlib
+
+from django.core.files.base import ContentFile
+
+from dbbackup import compression, settings, utils
+
+logger = logging.getLogger("dbbackup.storage")
+
+MANIFEST_EXTENSION = "chunks"
+MANIFEST_FORMAT = "dbbackup-chunks"
+MANIFEST_VERSION = 1
+# Manifests are written by json.dumps() with the format first
+MANIFEST_HEADER = json.dumps({"format": MANIFEST_FORMAT})[:-1].encode()
+# Fixed pseudo-random weight of each byte, never 0
+BYTE_WEIGHTS = bytes(1 + hashlib.sha256(bytes([i])).digest()[0] % 255 for i in range(256))
+# Bytes summed before each position. Odd, so a run of a single byte never sums
+# to a multiple of 256, and small enough for the sums to fit in 16 bits
+WINDOW_SIZE = 61
+# Positions whose window sum is a multiple of 256 are checked for a boundary
+CANDIDATE_BITS = 8
+# Bits added to the mask before the average size, and removed after it
+NORMALIZATION = 2
+# Bytes whose window sums are computed at once
+BLOCK_SIZE = 64 * 1024
+
+
+def is_manifest_filename(filename):
+    """
+    Tell if a backup file is a chunk manifest.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :rtype: ``bool``
+    """
+    return filename.endswith(f".{MANIFEST_EXTENSION}")
+
+
+def is_manifest_file(fileobj):
+    """
+    Tell if a file is a chunk manifest from its first bytes, whatever its
+    name. Its position is kept, files that can't seek back aren't read.
+
+    :param fileobj: File to check
+    :type fileobj: ``file`` like object
+
+    :rtype: ``bool``
+    """
+    seekable = getattr(fileobj, "seekable", None)
+    if seekable is None or not seekable():
+        return False
+    position = fileobj.tell()
+    try:
+        header = fileobj.read(len(MANIFEST_HEADER))
+    finally:
+        fileobj.seek(position)
+    return header == MANIFEST_HEADER
+
+
+def get_boundary_masks(avg_size):
+    """
+    Return the masks the CRC-32 of a candidate's window must not intersect
+    for it to be a boundary, before and after ``avg_size``. The first one has
+    more bits, so chunk sizes gather around ``avg_size``.
+    """
+    bits = round(math.log2(max(avg_size, 2))) - CANDIDATE_BITS
+
+    def get_mask(count):
+        return (1 << min(max(count, 0), 32)) - 1
+
+    return get_mask(bits + NORMALIZATION), get_mask(bits - NORMALIZATION)
+
+
+def get_window_sums(view, start, stop):
+    """
+    Return the lowest byte of the sum of ``BYTE_WEIGHTS`` over the window
+    ending at each byte from ``start`` to ``stop``.
+
+    The weights are spread in 16-bit lanes of a single integer, multiplying
+    it by ``1 + 2**16 + ... + 2**(16 * (WINDOW_SIZE - 1))`` sums every window
+    at once, in C.
+    """
+    first = max(start - WINDOW_SIZE + 1, 0)
+    weights = view[first:stop].tobytes().translate(BYTE_WEIGHTS)
+    lanes = weights.decode("latin-1").encode("utf-16-le")
+    value = int.from_bytes(lanes, "little")
+    value = ((value << (16 * WINDOW_SIZE)) - value) // 0xFFFF
+    sums = value.to_bytes(len(lanes) + 2 * WINDOW_SIZE, "little")
+    return sums[2 * (start - first) : len(lanes) : 2]
+
+
+def find_boundary(buffer, min_size, avg_size, max_size, masks):
+    """
+    Return the end of the first chunk of ``buffer``, after ``min_size``.
+
+    Like FastCDC, boundaries only depend on the ``WINDOW_SIZE`` bytes before
+    them: candidates are found from a rolling sum over the window, then the
+    CRC-32 of their window is checked against ``masks``.
+    """
+    end = min(len(buffer), max_size)
+    if end <= min_size:
+        return end
+    normal = min(max(avg_size, min_size), end)
+    view = memoryview(buffer)
+    for start in range(min_size, end, BLOCK_SIZE):
+        sums = get_window_sums(view, start, min(start + BLOCK_SIZE, end))
+        position = sums.find(0)
+        while position != -1:
+            cut = start + position + 1
+            mask = masks[0] if cut <= normal else masks[1]
+            if not zlib.crc32(view[max(cut - WINDOW_SIZE, 0) : cut]) & mask:
+                return cut
+            position = sums.find(0, position + 1)
+    return end
+
+
+def iter_chunks(fileobj, min_size, avg_size, max_size):
+    """
+    Split a file in content-defined chunks.
+
+    :param fileobj: File to split
+    :type fileobj: ``file`` like object
+
+    :param min_size: Minimum size of chunks, except the last one
+    :type min_size: ``int``
+
+    :param avg_size: Expected average size of chunks
+    :type avg_size: ``int``
+
+    :param max_size: Maximum size of chunks
+    :type max_size: ``int``
+
+    :returns: Chunks
+    :rtype: Generator of ``bytes``
+    """
+    masks = get_boundary_masks(avg_size)
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = fileobj.read(max_size)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        if eof and len(buffer) <= min_size:
+            yield bytes(buffer)
+            return
+        cut = find_boundary(buffer, min_size, avg_size, max_size, masks)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+class ChunkStore:
+    """
+    Chunks kept in the backup storage under
+    ``<DIRECTORY>/<first 2 hex digits>/<sha256><codec extension>``.
+    """
+
+    def __init__(self, storage, options=None):
+        """
+        :param storage: Backup storage
+        :type storage: :class:`dbbackup.storage.Storage`
+
+        :param options: Chunking options, ``settings.DBBACKUP_DEDUP`` is used
+                        if ``None``
+        :type options: ``dict`` or ``None``
+        """
+        options = {**settings.DEDUP, **(options or {})}
+        self.storage = storage
+        self.directory = options.get("DIRECTORY", "chunks")
+        self.min_size = int(options.get("MIN_SIZE", 256 * 1024))
+        self.avg_size = int(options.get("AVG_SIZE", 1024 * 1024))
+        self.max_size = int(options.get("MAX_SIZE", 4 * 1024 * 1024))
+
+    def get_chunk_path(self, digest, extension=""):
+        return posixpath.join(self.directory, digest[:2], f"{digest}{extension}")
+
+    def write(self, fileobj, filename, codec=None, known_chunks=()):
+        """
+        Store the new chunks of a file and return its manifest.
+
+        :param fileobj: File to store
+        :type fileobj: ``file`` like object
+
+        :param filename: Name of the file, kept in the manifest
+        :type filename: ``str``
+
+        :param codec: Codec used to compress chunks, if any
+        :type codec: :class:`dbbackup.compression.BaseCodec` or ``None``
+
+        :param known_chunks: Paths of chunks known to be stored, they are not
+                             checked in storage
+        :type known_chunks: ``set``
+
+        :returns: Manifest
+        :rtype: ``dict``
+        """
+        extension = codec.extension if codec else ""
+        known_chunks = set(known_chunks)
+        chunks = []
+        size = stored_size = 0
+        for chunk in iter_chunks(fileobj, self.min_size, self.avg_size, self.max_size):
+            digest = hashlib.sha256(chunk).hexdigest()
+            path = self.get_chunk_path(digest, extension)
+            chunks.append([digest, len(chunk)])
+            size += len(chunk)
+            if path in known_chunks or self.storage.storage.exists(path):
+                known_chunks.add(path)
+                continue
+            if codec:
+                compressor = codec.compressor()
+                try:
+                    chunk = compressor.compress(chunk) + compressor.flush()
+                finally:
+                    compression.close_compressor(compressor)
+            self.storage.storage.save(path, ContentFile(chunk))
+            known_chunks.add(path)
+            stored_size += len(chunk)
+        unique = len({digest for digest, _ in chunks})
+        logger.info(
+            "%s split in %s chunks (%s unique), %s stored",
+            filename,
+            len(chunks),
+            unique,
+            utils.bytes_to_str(stored_size),
+        )
+        return {
+            "format": MANIFEST_FORMAT,
+            "version": MANIFEST_VERSION,
+            "filename": filename,
+            "size": size,
+            "codec": codec.name if codec else None,
+            "chunks": chunks,
+        }
+
+    def iter_read(self, manifest):
+        """
+        Read a file from its manifest, checking the chunks' digests.
+
+        :param manifest: Manifest of the file
+        :type manifest: ``dict``
+
+        :returns: File's content
+        :rtype: Generator of ``bytes``
+        """
+        codec = compression.get_codec(manifest["codec"]) if manifest.get("codec") else None
+        extension = codec.extension if codec else ""
+        for digest, _size in manifest["chunks"]:
+            with self.storage.storage.open(self.get_chunk_path(digest, extension), "rb") as fd:
+                data = fd.read()
+            if codec:
+                data = b"".join(codec.iter_uncompress(ContentFile(data)))
+            if hashlib.sha256(data).hexdigest() != digest:
+                msg = f"Chunk {digest} is corrupted"
+                raise ValueError(msg)
+            yield data
+
+    def get_chunk_paths(self, manifest):
+        """Return the storage paths of the chunks of a manifest."""
+        codec = compression.get_codec(manifest["codec"]) if manifest.get("codec") else None
+        extension = codec.extension if codec else ""
+        return {self.get_chunk_path(digest, extension) for digest, _size in manifest["chunks"]}
+
+    def read_manifest(self, filename):
+        """
+        Read a manifest from the backup storage.
+
+        :rtype: ``dict``
+        """
+        with self.storage.storage.open(filename, "rb") as fd:
+            return load_manifest(fd)
+
+    def collect_garbage(self):
+        """
+        Delete chunks not referenced by any manifest of the storage. Backups
+        must not be running on the same storage meanwhile.
+
+        Manifests are listed from the storage itself, not the catalog nor
+        backup names, so a manifest missing from them keeps its chunks.
+
+        :returns: Number of deleted chunks
+        :rtype: ``int``
+        """
+        referenced = set()
+        for filename in self.storage.list_directory():
+            if is_manifest_filename(filename):
+                referenced |= self.get_chunk_paths(self.read_manifest(filename))
+        deleted = 0
+        try:
+            subdirs, _files = self.storage.storage.listdir(self.directory)
+        except FileNotFoundError:
+            return deleted
+        for subdir in subdirs:
+            path = posixpath.join(self.directory, subdir)
+            for name in self.storage.storage.listdir(path)[1]:
+                chunk_path = posixpath.join(path, name)
+                if chunk_path not in referenced:
+                    self.storage.storage.delete(chunk_path)
+                    deleted += 1
+        logger.info("%s unreferenced chunks deleted", deleted)
+        return deleted
+
+
+def load_manifest(fileobj):
+    """
+    Load and validate a chunk manifest.
+
+    :param fileobj: Manifest file
+    :type fileobj: ``file`` like object
+
+    :rtype: ``dict``
+    """
+    manifest = json.loads(fileobj.read())
+    if manifest.get("format") != MANIFEST_FORMAT or manifest.get("version") != MANIFEST_VERSION:
+        msg = "Not a supported chunk manifest"
+        raise ValueError(msg)
+    return manifest
@@ -0,0 +1,356 @@
+"""
+Compression codecs used for backup files.
+
+The codec used to compress new backups is configured with
+``settings.DBBACKUP_COMPRESSION``, the one used to uncompress a backup is
+guessed from its file extension.
+"""
+
+from __future__ import annotations
+
+import gzip
+import io
+import lzma
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ImproperlyConfigured
+
+from dbbackup import encryption, settings
+
+DEFAULT_CODEC = "gzip"
+
+
+class BaseCodec:
+    """
+    Base class for compression codecs. A codec creates incremental
+    compressors, with ``compress(data)`` and ``flush()`` methods like
+    :func:`zlib.compressobj`, and readers uncompressing a file object.
+    """
+
+    name = ""
+    extension = ""
+    default_level: int | None = None
+
+    def __init__(self, level=None, threads=None):
+        self.level = self.default_level if level is None else int(level)
+        self.threads = max(int(threads or 1), 1)
+
+    def compressor(self):
+        """
+        Override this method to return an incremental compressor.
+        """
+        msg = "compressor not implemented"
+        raise NotImplementedError(msg)
+
+    def open_reader(self, fileobj):
+        """
+        Override this method to return a readable file object uncompressing
+        ``fileobj``.
+        """
+        msg = "open_reader not implemented"
+        raise NotImplementedError(msg)
+
+    def iter_uncompress(self, fileobj, chunk_size=None):
+        """
+        Yield uncompressed data of ``fileobj`` by chunks, reading it
+        sequentially.
+        """
+        chunk_size = chunk_size or settings.TMP_FILE_READ_SIZE
+        reader = self.open_reader(fileobj)
+        try:
+            while chunk := reader.read(chunk_size):
+                yield chunk
+        finally:
+            reader.close()
+
+    def open_writer(self, fileobj):
+        """
+        Return a writable file object compressing into ``fileobj``. The
+        compressed data is completed when the writer is closed, ``fileobj``
+        is left open.
+        """
+        return CompressWriter(fileobj, self.compressor())
+
+
+class GzipCodec(BaseCodec):
+    """
+    Gzip codec. With several threads, data is split in blocks compressed
+    concurrently as independent gzip members, which any gzip tool reads as
+    one file.
+    """
+
+    name = "gzip"
+    extension = ".gz"
+    default_level = 9
+    block_size = 4 * 1024 * 1024
+
+    def compressor(self):
+        if self.threads > 1:
+            return ParallelGzipCompressor(self.level, self.threads, self.block_size)
+        # wbits > 15 makes zlib write gzip headers and trailer
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def open_reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+    def iter_uncompress(self, fileobj, chunk_size=None):
+        chunk_size = chunk_size or settings.TMP_FILE_READ_SIZE
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        pending = between_members = False
+        while chunk := fileobj.read(chunk_size):
+            while chunk:
+                if between_members:
+                    # A gzip file may be made of several members, and padded
+                    # with zeroes, which can span several chunks
+                    chunk = chunk.lstrip(b"\x00")
+                    if not chunk:
+                        break
+                    between_members = False
+                pending = True
+                yield decompressor.decompress(chunk)
+                chunk = b""
+                if decompressor.eof:
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    pending = False
+                    between_members = True
+        if pending:
+            msg = "Compressed file ended before the end-of-stream marker was reached"
+            raise EOFError(msg)
+
+
+class XzCodec(BaseCodec):
+    """
+    XZ (LZMA2) codec. The standard library doesn't support multithreaded
+    compression, ``THREADS`` is ignored.
+    """
+
+    name = "xz"
+    extension = ".xz"
+    default_level = 6
+
+    def compressor(self):
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=self.level)
+
+    def open_reader(self, fileobj):
+        return lzma.LZMAFile(fileobj, mode="rb")
+
+
+class ZstdCodec(BaseCodec):
+    """
+    Zstandard codec, requires the ``zstandard`` package.
+    """
+
+    name = "zstd"
+    extension = ".zst"
+    default_level = 3
+
+    def compressor(self):
+        import zstandard
+
+        threads = self.threads if self.threads > 1 else 0
+        return zstandard.ZstdCompressor(level=self.level, threads=threads).compressobj()
+
+    def open_reader(self, fileobj):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+class Lz4Codec(BaseCodec):
+    """
+    LZ4 frame codec, requires the ``lz4`` package.
+    """
+
+    name = "lz4"
+    extension = ".lz4"
+    default_level = 0
+
+    def compressor(self):
+        import lz4.frame
+
+        return Lz4Compressor(lz4.frame.LZ4FrameCompressor(compression_level=self.level))
+
+    def open_reader(self, fileobj):
+        import lz4.frame
+
+        return lz4.frame.LZ4FrameFile(fileobj, mode="rb")
+
+
+CODECS = {codec.name: codec for codec in (GzipCodec, XzCodec, ZstdCodec, Lz4Codec)}
+COMPRESSED_EXTENSIONS = tuple(codec.extension for codec in CODECS.values())
+
+
+class Lz4Compressor:
+    """Give a :func:`zlib.compressobj` like interface to LZ4 frame compressor."""
+
+    def __init__(self, compressor):
+        self._compressor = compressor
+        self._started = False
+
+    def compress(self, data):
+        header = b""
+        if not self._started:
+            header = self._compressor.begin()
+            self._started = True
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        return self.compress(b"") + self._compressor.flush()
+
+
+class ParallelGzipCompressor:
+    """
+    Compress blocks of data in a thread pool, ``zlib`` releases the GIL while
+    compressing. Blocks are returned in order, and at most two blocks per
+    thread are kept in memory.
+    """
+
+    def __init__(self, level, threads, block_size):
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="dbbackup-gzip")
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(gzip.compress, block, self.level))
+
+    def _collect(self, wait):
+        output = []
+        while self._pending and (self._pending[0].done() or wait(len(self._pending))):
+            output.append(self._pending.popleft().result())
+        return b"".join(output)
+
+    def compress(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return self._collect(wait=lambda pending: pending > 2 * self.threads)
+
+    def flush(self):
+        if self._buffer or not self._pending:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        try:
+            return self._collect(wait=lambda pending: True)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the threads, blocks not compressed yet are dropped."""
+        self._pending.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class CompressWriter(io.RawIOBase):
+    """Writable file object compressing data into another file object."""
+
+    def __init__(self, fileobj, compressor):
+        super().__init__()
+        self.fileobj = fileobj
+        self.compressor = compressor
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(bytes(data)))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.fileobj.write(self.compressor.flush())
+            finally:
+                close_compressor(self.compressor)
+        super().close()
+
+
+def close_compressor(compressor):
+    """
+    Release the resources of a compressor, even if it isn't flushed. Only
+    :class:`ParallelGzipCompressor` has some.
+    """
+    if isinstance(compressor, ParallelGzipCompressor):
+        compressor.close()
+
+
+def get_codec(name=None, level=None, threads=None):
+    """
+    Get a compression codec, configured by ``settings.DBBACKUP_COMPRESSION``
+    unless specified.
+
+    :param name: Name of the codec, ``'gzip'``, ``'zstd'``, ``'lz4'`` or ``'xz'``
+    :type name: ``str`` or ``None``
+
+    :returns: Compression codec
+    :rtype: :class:`BaseCodec`
+    """
+    options = settings.COMPRESSION
+    name = name or options.get("CODEC", DEFAULT_CODEC)
+    if name not in CODECS:
+        msg = f"Unknown compression codec {name!r}, must be one of: {', '.join(CODECS)}"
+        raise ImproperlyConfigured(msg)
+    return CODECS[name](
+        level=options.get("LEVEL") if level is None else level,
+        threads=options.get("THREADS") if threads is None else threads,
+    )
+
+
+def get_codec_for_filename(filename, default=DEFAULT_CODEC):
+    """
+    Guess the codec of a compressed file from its extension.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param default: Codec name used if the extension is unknown
+    :type default: ``str`` or ``None``
+
+    :returns: Compression codec or ``None`` if unknown and no default
+    :rtype: :class:`BaseCodec` or ``None``
+    """
+    for codec_cls in CODECS.values():
+        if filename.endswith(codec_cls.extension):
+            return get_codec(codec_cls.name)
+    return get_codec(default) if default else None
+
+
+def is_compressed(filename):
+    """
+    Tell if a backup file name ends with the extension of a compression
+    codec, only followed by the extensions of an encryption backend, of a
+    chunk manifest and of a metadata file.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :rtype: ``bool``
+    """
+    # Imported here, dbbackup.chunking imports this module
+    from dbbackup.chunking import MANIFEST_EXTENSION
+
+    name = filename.removesuffix(".metadata").removesuffix(f".{MANIFEST_EXTENSION}")
+    if encryption.is_encrypted(name):
+        name = name[: name.rindex(".")]
+    return name.endswith(COMPRESSED_EXTENSIONS)
+
+
+def remove_extension(filename, codec):
+    """
+    Remove the codec extension from a file name.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param codec: Compression codec
+    :type codec: :class:`BaseCodec`
+
+    :rtype: ``str``
+    """
+    return filename.removesuffix(codec.extension)
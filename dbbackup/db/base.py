@@ -6,7 +6,7 @@ import logging
 import os
 import shlex
 from importlib import import_module
-from subprocess import Popen
+from subprocess import PIPE, Popen
 from tempfile import SpooledTemporaryFile
 from typing import Any, ClassVar
 
@@ -129,11 +129,12 @@ class BaseCommandDBConnector(BaseDBConnector):
     restore_suffix = ""
 
     use_parent_env = True
+    stream = False
     env: ClassVar[dict[str, Any]] = {}
     dump_env: ClassVar[dict[str, Any]] = {}
     restore_env: ClassVar[dict[str, Any]] = {}
 
-    def run_command(self, command, stdin=None, env=None):
+    def run_command(self, command, stdin=None, env=None, stream=False):
         """
         Launch a shell command line.
 
@@ -143,6 +144,9 @@ class BaseCommandDBConnector(BaseDBConnector):
         :type stdin: file
         :param env: Environment variable used in command
         :type env: dict
+        :param stream: Return standard output as a stream read directly from
+                       the running process instead of waiting for its end
+        :type stream: bool
         :return: Standard output of command
         :rtype: file
         """
@@ -171,19 +175,36 @@ class BaseCommandDBConnector(BaseDBConnector):
                 if original_command == "cat":
                     return self._cat_shim(stdout, stderr, stdin)
 
+            if isinstance(stdin, File):
+                stdin = stdin.open("rb")
+            # Streams without file descriptor are fed through a pipe
+            feed_stdin = stdin is not None and not utils.has_fileno(stdin)
             process = Popen(
                 cmd,
-                stdin=stdin.open("rb") if isinstance(stdin, File) else stdin,
-                stdout=stdout,
+                stdin=PIPE if feed_stdin else stdin,
+                stdout=PIPE if stream else stdout,
                 stderr=stderr,
                 env=full_env,
                 shell=False,
             )
-            process.wait()
-            if process.poll():
+            feeder = utils.start_input_feeder(process, utils.iter_file(stdin)) if feed_stdin else None
+
+            def get_error(returncode):
                 stderr.seek(0)
                 msg = f"Error running: {command}\n{stderr.read().decode('utf-8')}"
-                raise exceptions.CommandConnectorError(msg)
+                return exceptions.CommandConnectorError(msg)
+
+            if stream:
+                stdout = utils.IterStream(utils.ProcessOutput(process, get_error, feeder))
+                return stdout, stderr
+            process.wait()
+            if feeder is not None:
+                thread, feed_errors = feeder
+                thread.join()
+                if feed_errors:
+                    raise feed_errors[0]
+            if process.poll():
+                raise get_error(process.returncode)
             return self._reset_streams(stdout, stderr)
 
         except OSError as err:
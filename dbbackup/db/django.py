@@ -8,14 +8,26 @@ any Django-supported database backend.
 
 import codecs
 import contextlib
+import json
+import logging
 import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import SpooledTemporaryFile
 
+from django.apps import apps
+from django.core import serializers
 from django.core.management import call_command
+from django.core.management.color import no_style
+from django.core.management.utils import parse_apps_and_model_labels
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.db import connections, router, transaction
 
+from dbbackup import settings, utils
 from dbbackup.db.base import BaseDBConnector
 
+logger = logging.getLogger("dbbackup.command")
+
 
 class DjangoConnector(BaseDBConnector):
     """
@@ -25,17 +37,87 @@ class DjangoConnector(BaseDBConnector):
     by leveraging Django's built-in serialization system. It supports any
     database backend that Django supports and handles model-level backups
     with proper foreign key relationships preserved.
+
+    With ``FORMAT = "jsonl"``, models are serialized one by one to JSON Lines,
+    fetching objects by chunks of ``CHUNK_SIZE``, and ``WORKERS`` models of a
+    PostgreSQL database can be dumped at the same time.
+
+    With ``BULK_RESTORE``, dumps are restored by inserting objects of each
+    model by batches of ``BULK_BATCH_SIZE`` instead of saving them one by one.
     """
 
     extension = "json"
+    format = "json"
+    chunk_size = 2000
+    workers = 1
+    bulk_restore = False
+    bulk_batch_size = 1000
+
+    def __init__(self, database_name=None, **kwargs):
+        super().__init__(database_name, **kwargs)
+        if self.format == "jsonl":
+            self.extension = "jsonl"
+
+    def _get_exclude_list(self):
+        """
+        Convert the ``EXCLUDE`` setting to the ``app_label.ModelName`` labels
+        used by ``dumpdata``.
+        """
+        exclude_list = []
+        for item in self.exclude:
+            if "." in item:
+                # Already in app.model format - validate it exists before adding
+                # Skip invalid app.model combinations silently
+                # This allows for graceful handling of non-existent models
+                with contextlib.suppress(LookupError, ValueError):
+                    app_label, model_name = item.split(".", 1)
+                    apps.get_model(app_label, model_name)
+                    exclude_list.append(item)
+            else:
+                # Handle table name format - convert only well-known Django patterns
+                # For unknown table names, skip them rather than risk errors
+                converted = None
+                if item.startswith("auth_"):
+                    # Handle Django auth tables (only if auth app is available)
+                    with contextlib.suppress(LookupError):
+                        apps.get_app_config("auth")  # Check if auth app exists
+                        model_name = item[5:]  # Remove 'auth_' prefix
+                        if model_name == "group":
+                            converted = "auth.Group"
+                        elif model_name == "permission":
+                            converted = "auth.Permission"
+                        elif model_name == "user":
+                            converted = "auth.User"
+                elif item.startswith("django_"):
+                    # Handle Django internal tables (only if apps are available)
+                    model_name = item[7:]  # Remove 'django_' prefix
+                    # Required app not installed, skip
+                    with contextlib.suppress(LookupError):
+                        if model_name == "admin_log":
+                            apps.get_app_config("admin")
+                            converted = "admin.LogEntry"
+                        elif model_name == "content_type":
+                            apps.get_app_config("contenttypes")
+                            converted = "contenttypes.ContentType"
+                        elif model_name == "session":
+                            apps.get_app_config("sessions")
+                            converted = "sessions.Session"
+                # Only add converted names that we're confident about
+                # For unknown table names, we skip them to avoid Django validation errors
+                # This is safer than trying to guess the correct app.model format
+                if converted:
+                    exclude_list.append(converted)
+        return exclude_list
 
     def _create_dump(self):
         """
         Create a database dump using Django's dumpdata command.
 
         Returns a file-like object containing the serialized database data
-        in JSON format.
+        in JSON format, or in JSON Lines format with ``FORMAT = "jsonl"``.
         """
+        if self.format == "jsonl":
+            return self._create_jsonl_dump()
 
         binary_dump_file = SpooledTemporaryFile(mode="w+b")
 
@@ -54,57 +136,7 @@ class DjangoConnector(BaseDBConnector):
 
         # Handle exclude parameter if specified
         if self.exclude:
-            exclude_list = []
-            for item in self.exclude:
-                if "." in item:
-                    # Already in app.model format - validate it exists before adding
-                    # Skip invalid app.model combinations silently
-                    # This allows for graceful handling of non-existent models
-                    with contextlib.suppress(LookupError, ValueError):
-                        from django.apps import apps
-
-                        app_label, model_name = item.split(".", 1)
-                        apps.get_model(app_label, model_name)
-                        exclude_list.append(item)
-                else:
-                    # Handle table name format - convert only well-known Django patterns
-                    # For unknown table names, skip them rather than risk errors
-                    converted = None
-                    if item.startswith("auth_"):
-                        # Handle Django auth tables (only if auth app is available)
-                        with contextlib.suppress(LookupError):
-                            from django.apps import apps
-
-                            apps.get_app_config("auth")  # Check if auth app exists
-                            model_name = item[5:]  # Remove 'auth_' prefix
-                            if model_name == "group":
-                                converted = "auth.Group"
-                            elif model_name == "permission":
-                                converted = "auth.Permission"
-                            elif model_name == "user":
-                                converted = "auth.User"
-                    elif item.startswith("django_"):
-                        # Handle Django internal tables (only if apps are available)
-                        model_name = item[7:]  # Remove 'django_' prefix
-                        # Required app not installed, skip
-                        with contextlib.suppress(LookupError):
-                            from django.apps import apps
-
-                            if model_name == "admin_log":
-                                apps.get_app_config("admin")
-                                converted = "admin.LogEntry"
-                            elif model_name == "content_type":
-                                apps.get_app_config("contenttypes")
-                                converted = "contenttypes.ContentType"
-                            elif model_name == "session":
-                                apps.get_app_config("sessions")
-                                converted = "sessions.Session"
-                    # Only add converted names that we're confident about
-                    # For unknown table names, we skip them to avoid Django validation errors
-                    # This is safer than trying to guess the correct app.model format
-                    if converted:
-                        exclude_list.append(converted)
-
+            exclude_list = self._get_exclude_list()
             if exclude_list:
                 dump_kwargs["exclude"] = exclude_list
 
@@ -115,25 +147,128 @@ class DjangoConnector(BaseDBConnector):
         binary_dump_file.seek(0)
         return binary_dump_file
 
+    def _get_models(self):
+        """
+        Return the models to dump, sorted like ``dumpdata`` does so objects
+        come after the ones they refer to by natural keys.
+        """
+        excluded_models, excluded_apps = parse_apps_and_model_labels(self._get_exclude_list())
+        app_list = [
+            (app_config, None)
+            for app_config in apps.get_app_configs()
+            if app_config.models_module is not None and app_config not in excluded_apps
+        ]
+        return [
+            model
+            for model in serializers.sort_dependencies(app_list, allow_cycles=True)
+            if model not in excluded_models
+            and not model._meta.proxy
+            and router.allow_migrate_model(self.database_name, model)
+        ]
+
+    def _write_model(self, model, binary_file):
+        """Write the objects of a model as JSON Lines, fetching them by chunks."""
+        queryset = model._default_manager.using(self.database_name).order_by(model._meta.pk.name)
+        serializers.serialize(
+            "jsonl",
+            queryset.iterator(chunk_size=int(self.chunk_size)),
+            stream=codecs.getwriter("utf-8")(binary_file),
+            use_natural_foreign_keys=True,
+            use_natural_primary_keys=True,
+        )
+
+    def _export_snapshot(self):
+        """Return the ID of the snapshot of the current transaction."""
+        with connections[self.database_name].cursor() as cursor:
+            cursor.execute("SELECT pg_export_snapshot()")
+            return cursor.fetchone()[0]
+
+    def _import_snapshot(self, snapshot):
+        """Make the current transaction see the data of an exported snapshot."""
+        with connections[self.database_name].cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot])
+
+    def _dump_model(self, model, snapshot):
+        """Dump a model to its own file, from a worker thread."""
+        model_file = SpooledTemporaryFile(max_size=settings.TMP_FILE_MAX_SIZE, dir=settings.TMP_DIR)
+        try:
+            with transaction.atomic(using=self.database_name):
+                self._import_snapshot(snapshot)
+                self._write_model(model, model_file)
+        except BaseException:
+            model_file.close()
+            raise
+        finally:
+            # Each thread has its own connection
+            connections[self.database_name].close()
+        model_file.seek(0)
+        return model_file
+
+    def _create_jsonl_dump(self):
+        """
+        Create a JSON Lines dump model by model. With ``WORKERS``, models are
+        dumped to their own files by a thread pool and joined in order. Their
+        connections share the snapshot of a transaction kept open meanwhile,
+        so they see the same state of the database: only PostgreSQL can share
+        a snapshot, other databases are dumped by a single connection.
+        """
+        dump_file = SpooledTemporaryFile(max_size=settings.TMP_FILE_MAX_SIZE, dir=settings.TMP_DIR)
+        models = self._get_models()
+        workers = int(self.workers)
+        if workers > 1 and connections[self.database_name].vendor != "postgresql":
+            logger.warning(
+                "WORKERS is ignored, %s connections can't share a snapshot of the database",
+                connections[self.database_name].display_name,
+            )
+            workers = 1
+        if workers > 1:
+            with transaction.atomic(using=self.database_name):
+                snapshot = self._export_snapshot()
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dbbackup-django") as executor:
+                    futures = [executor.submit(self._dump_model, model, snapshot) for model in models]
+                    try:
+                        for future in futures:
+                            with future.result() as model_file:
+                                utils.copy_file(model_file, dump_file)
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+        else:
+            for model in models:
+                self._write_model(model, dump_file)
+        dump_file.seek(0)
+        return dump_file
+
     def _restore_dump(self, dump):
         """
         Restore a database dump using Django's loaddata command.
 
         Args:
-            dump: File-like object containing JSON fixture data
+            dump: File-like object containing JSON or JSON Lines fixture data
         """
+        if self.bulk_restore:
+            self._bulk_restore_dump(dump)
+            return
+
+        def read_chunk():
+            chunk = dump.read(8192)  # 8KB chunks
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode("utf-8")
+            return chunk
+
+        dump.seek(0)
+        chunk = read_chunk()
+        # loaddata finds the format from the extension, JSON Lines start with an object
+        suffix = ".jsonl" if chunk.lstrip().startswith("{") else ".json"
         # Create a temporary file for loaddata to read from
-        with tempfile.NamedTemporaryFile(mode="w+t", suffix=".json", encoding="utf-8", delete=False) as temp_file:
+        with tempfile.NamedTemporaryFile(mode="w+t", suffix=suffix, encoding="utf-8", delete=False) as temp_file:
             # Stream copy dump content to temporary file to avoid loading everything into memory
-            dump.seek(0)
             # Use chunked reading for memory efficiency
-            while True:
-                chunk = dump.read(8192)  # 8KB chunks
-                if not chunk:
-                    break
-                if isinstance(chunk, bytes):
-                    chunk = chunk.decode("utf-8")
+            while chunk:
                 temp_file.write(chunk)
+                chunk = read_chunk()
             temp_file_path = temp_file.name
 
         try:
@@ -143,3 +278,161 @@ class DjangoConnector(BaseDBConnector):
             # Best effort clean-up of temporary file
             with contextlib.suppress(OSError):
                 os.unlink(temp_file_path)
+
+    def _iter_batches(self, objects):
+        """Group consecutive objects of the same model by batches."""
+        batch_size = max(int(self.bulk_batch_size), 1)
+        batch = []
+        for obj in objects:
+            if batch and (obj.get("model") != batch[0].get("model") or len(batch) >= batch_size):
+                yield batch
+                batch = []
+            batch.append(obj)
+        if batch:
+            yield batch
+
+    def _insert_objects(self, model, objects):
+        """
+        Insert new objects of a model by batches. Values are inserted as they
+        are, like ``loaddata`` saves raw objects, so fields like ``auto_now``
+        keep their dumped values.
+        """
+        connection = connections[self.database_name]
+        opts = model._meta
+        queryset = model._base_manager.using(self.database_name)
+        fields = [field for field in opts.concrete_fields if not field.generated]
+        returning_fields = opts.db_returning_fields if connection.features.can_return_rows_from_bulk_insert else None
+        objects_with_pk = [obj for obj in objects if obj.pk is not None]
+        objects_without_pk = [obj for obj in objects if obj.pk is None]
+        for batch_objects, batch_fields in (
+            (objects_with_pk, fields),
+            (objects_without_pk, [field for field in fields if field is not opts.auto_field]),
+        ):
+            if not batch_objects:
+                continue
+            batch_size = min(int(self.bulk_batch_size), connection.ops.bulk_batch_size(batch_fields, batch_objects))
+            batch_size = max(batch_size, 1)
+            for start in range(0, len(batch_objects), batch_size):
+                batch = batch_objects[start : start + batch_size]
+                rows = queryset._insert(
+                    batch, fields=batch_fields, returning_fields=returning_fields, raw=True, using=self.database_name
+                )
+                for obj, row in zip(batch, rows or (), strict=False):
+                    for field, value in zip(returning_fields, row, strict=False):
+                        setattr(obj, field.attname, value)
+            for obj in batch_objects:
+                obj._state.adding = False
+                obj._state.db = self.database_name
+
+    def _insert_m2m(self, model, deserialized_objects):
+        """Insert the many-to-many relations of new objects by batches."""
+        through_rows = {}
+        for deserialized in deserialized_objects:
+            for name, values in (deserialized.m2m_data or {}).items():
+                field = model._meta.get_field(name)
+                through = field.remote_field.through
+                source = through._meta.get_field(field.m2m_field_name()).attname
+                target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+                through_rows.setdefault(through, []).extend(
+                    through(**{source: deserialized.object.pk, target: value}) for value in values
+                )
+            deserialized.m2m_data = None
+        for through, rows in through_rows.items():
+            through._base_manager.using(self.database_name).bulk_create(rows, batch_size=int(self.bulk_batch_size))
+
+    def _save_objects(self, deserialized_objects):
+        """Save a batch of deserialized objects of the same model."""
+        model = type(deserialized_objects[0].object)
+        connection = connections[self.database_name]
+        primary_keys = [obj.object.pk for obj in deserialized_objects if obj.object.pk is not None]
+        existing = set(
+            model._base_manager.using(self.database_name).filter(pk__in=primary_keys).values_list("pk", flat=True)
+        )
+        new_objects = []
+        for deserialized in deserialized_objects:
+            # Existing objects are updated, like loaddata does
+            if deserialized.object.pk in existing:
+                deserialized.save(using=self.database_name)
+            else:
+                new_objects.append(deserialized)
+        if not new_objects:
+            return
+        # Models with parents need their parent rows, and relations need primary keys
+        if model._meta.parents or (
+            not connection.features.can_return_rows_from_bulk_insert
+            and any(obj.object.pk is None and obj.m2m_data for obj in new_objects)
+        ):
+            for deserialized in new_objects:
+                deserialized.save(using=self.database_name)
+            return
+        self._insert_objects(model, [deserialized.object for deserialized in new_objects])
+        self._insert_m2m(model, new_objects)
+
+    def _bulk_restore_dump(self, dump):
+        """
+        Restore a dump by streaming its objects and inserting consecutive
+        objects of a model by batches, in a transaction. Dumps list models
+        after the ones they refer to, so natural keys of a batch are resolved
+        against the rows already inserted. References to later objects are
+        saved once everything is inserted.
+        """
+        connection = connections[self.database_name]
+        loaded_models = set()
+        deferred_objects = []
+        dump.seek(0)
+        with transaction.atomic(using=self.database_name):
+            with connection.constraint_checks_disabled():
+                for batch in self._iter_batches(_iter_fixture_objects(dump)):
+                    deserialized_objects = list(
+                        PythonDeserializer(batch, using=self.database_name, handle_forward_references=True)
+                    )
+                    if not deserialized_objects:
+                        continue
+                    self._save_objects(deserialized_objects)
+                    loaded_models.add(type(deserialized_objects[0].object))
+                    deferred_objects.extend(obj for obj in deserialized_objects if obj.deferred_fields)
+                for deserialized in deferred_objects:
+                    deserialized.save_deferred_fields(using=self.database_name)
+            connection.check_constraints(table_names=[model._meta.db_table for model in loaded_models])
+            sequence_sql = connection.ops.sequence_reset_sql(no_style(), loaded_models)
+            if sequence_sql:
+                with connection.cursor() as cursor:
+                    for line in sequence_sql:
+                        cursor.execute(line)
+
+
+def _iter_fixture_objects(dump, chunk_size=64 * 1024):
+    """
+    Yield the objects of a JSON or JSON Lines fixture, reading it by chunks.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def read():
+        chunk = dump.read(chunk_size)
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk, final=not chunk)
+        return chunk
+
+    while True:
+        # Objects are separated by whitespaces in JSON Lines, and by commas in a JSON array
+        while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+            position += 1
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError("Expecting value", buffer, position)
+            obj, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                if position < len(buffer):
+                    raise
+                return
+            chunk = read()
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield obj
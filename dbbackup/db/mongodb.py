@@ -30,7 +30,7 @@ class MongoDumpConnector(BaseCommandDBConnector):
             cmd += f" --excludeCollection {collection}"
         cmd += " --archive"
         cmd = f"{self.dump_prefix} {cmd} {self.dump_suffix}"
-        stdout, _stderr = self.run_command(cmd, env=self.dump_env)
+        stdout, _stderr = self.run_command(cmd, env=self.dump_env, stream=self.stream)
         return stdout
 
     def _restore_dump(self, dump):
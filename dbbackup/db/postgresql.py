@@ -1,10 +1,16 @@
 from __future__ import annotations
 
 import logging
+import os
 import shlex
+import shutil
+import tarfile
+import tempfile
+from functools import partial
 from typing import Any, ClassVar
 from urllib.parse import quote
 
+from dbbackup import settings, utils
 from dbbackup.db.base import BaseCommandDBConnector
 
 logger = logging.getLogger("dbbackup.command")
@@ -82,7 +88,7 @@ class PgDumpConnector(BaseCommandDBConnector):
             cmd += " -n " + " -n ".join(self.schemas)
 
         cmd = f"{self.dump_prefix} {cmd} {self.dump_suffix}"
-        stdout, _stderr = self.run_command(cmd, env={**self.dump_env, **pg_env})
+        stdout, _stderr = self.run_command(cmd, env={**self.dump_env, **pg_env}, stream=self.stream)
         return stdout
 
     def _restore_dump(self, dump):
@@ -157,7 +163,7 @@ class PgDumpBinaryConnector(PgDumpConnector):
             cmd += " -n " + " -n ".join(self.schemas)
 
         cmd = f"{self.dump_prefix} {cmd} {self.dump_suffix}"
-        stdout, _ = self.run_command(cmd, env={**self.dump_env, **pg_env})
+        stdout, _ = self.run_command(cmd, env={**self.dump_env, **pg_env}, stream=self.stream)
         return stdout
 
     def _restore_dump(self, dump: str):
@@ -171,6 +177,13 @@ class PgDumpBinaryConnector(PgDumpConnector):
         """
 
         cmd_part, pg_env = parse_postgres_settings(self)
+        cmd_str = " ".join(self._get_restore_command(cmd_part))
+        stdout, _ = self.run_command(cmd_str, stdin=dump, env={**self.dump_env, **pg_env})
+
+        return stdout
+
+    def _get_restore_command(self, cmd_part):
+        """Build the ``pg_restore`` command as a list of arguments."""
         cmd = []
 
         # Flatten optional values
@@ -201,7 +214,99 @@ class PgDumpBinaryConnector(PgDumpConnector):
         if self.restore_suffix:
             cmd.extend(self.restore_suffix if isinstance(self.restore_suffix, list) else [self.restore_suffix])
 
-        cmd_str = " ".join(cmd)
-        stdout, _ = self.run_command(cmd_str, stdin=dump, env={**self.dump_env, **pg_env})
+        return cmd
 
-        return stdout
+
+class PgDumpDirectoryConnector(PgDumpBinaryConnector):
+    """
+    PostgreSQL connector, it uses `pg_dump` in directory format to dump
+    several tables at once and `pg_restore` with several jobs for restore
+    it. The dump directory is packed in a single tar stream.
+    """
+
+    extension = "psql.dir"
+    jobs = 4
+
+    def _create_dump(self):
+        cmd_part, pg_env = parse_postgres_settings(self)
+        dump_dir = tempfile.mkdtemp(dir=settings.TMP_DIR)
+        try:
+            # pg_dump refuses to write into an existing non-empty directory
+            output_dir = os.path.join(dump_dir, "dump")
+            cmd = f"{self.dump_cmd} {cmd_part}"
+            cmd += f" --format=directory --jobs={int(self.jobs)} --file={shlex.quote(output_dir)}"
+            for table in self.exclude:
+                cmd += f" --exclude-table-data={table}"
+
+            if self.schemas:
+                cmd += " -n " + " -n ".join(self.schemas)
+
+            cmd = f"{self.dump_prefix} {cmd} {self.dump_suffix}"
+            self.run_command(cmd, env={**self.dump_env, **pg_env})
+        except BaseException:
+            shutil.rmtree(dump_dir, ignore_errors=True)
+            raise
+
+        # The temporary directory is removed once the tar stream is consumed or closed
+        stream = utils.IterStream(
+            utils.ClosingIterator(
+                self._iter_tar(output_dir), release=partial(shutil.rmtree, dump_dir, ignore_errors=True)
+            )
+        )
+        if self.stream:
+            return stream
+        dump = utils.create_spooled_temporary_file(fileobj=stream)
+        dump.seek(0)
+        return dump
+
+    @staticmethod
+    def _iter_tar(directory):
+        """
+        Yield a tar archive of ``directory`` by chunks, reading each file only
+        when the archive is consumed.
+        """
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                tarinfo = tarfile.TarInfo(os.path.relpath(path, directory).replace(os.sep, "/"))
+                tarinfo.size = stat.st_size
+                tarinfo.mtime = int(stat.st_mtime)
+                yield tarinfo.tobuf()
+                with open(path, "rb") as fd:
+                    yield from utils.iter_file(fd)
+                remainder = tarinfo.size % tarfile.BLOCKSIZE
+                if remainder:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+        # End of archive marker
+        yield tarfile.NUL * tarfile.BLOCKSIZE * 2
+
+    def _restore_dump(self, dump):
+        cmd_part, pg_env = parse_postgres_settings(self)
+        restore_dir = tempfile.mkdtemp(dir=settings.TMP_DIR)
+        try:
+            dump.seek(0)
+            # Stream mode reading, the dump doesn't need to be seekable
+            with tarfile.open(fileobj=dump, mode="r|") as tar_file:
+                if hasattr(tarfile, "data_filter"):
+                    tar_file.extractall(restore_dir, filter="data")
+                else:  # pragma: no cover - Python without tarfile extraction filters
+                    tar_file.extractall(restore_dir)
+
+            cmd = self._get_restore_command(cmd_part)
+            cmd.append(shlex.quote(restore_dir))
+            stdout, _ = self.run_command(" ".join(cmd), env={**self.restore_env, **pg_env})
+            return stdout
+        finally:
+            shutil.rmtree(restore_dir, ignore_errors=True)
+
+    def _get_restore_command(self, cmd_part):
+        cmd = super()._get_restore_command(cmd_part)
+        if int(self.jobs) > 1:
+            # pg_restore can't run several jobs in a single transaction
+            if "--single-transaction" in cmd:
+                logger.debug("Restoring with %s jobs, --single-transaction is disabled", self.jobs)
+                cmd.remove("--single-transaction")
+            cmd.insert(cmd.index(cmd_part) + 1, f"--jobs={int(self.jobs)}")
+        return cmd
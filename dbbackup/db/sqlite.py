@@ -1,15 +1,24 @@
 import contextlib
+import io
+import logging
 import os
+import queue
 import sqlite3
+import time
 import warnings
-from io import BytesIO
-from shutil import copyfileobj
-from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from shutil import copymode
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile, mkstemp
+from typing import ClassVar
 
-from django.db import IntegrityError, OperationalError
+from django.db import IntegrityError, OperationalError, transaction
 
+from dbbackup import settings, utils
 from dbbackup.db.base import BaseDBConnector
 
+logger = logging.getLogger("dbbackup.command")
+
 DUMP_TABLES = """
 SELECT "name", "type", "sql"
 FROM "sqlite_master"
@@ -27,43 +36,163 @@ class SqliteConnector(BaseDBConnector):
     """
     Create a dump at SQL layer like could make ``.dumps`` in sqlite3.
     Restore by evaluate the created SQL.
+
+    With ``DUMP_BATCH_SIZE``, each ``INSERT`` statement of the dump contains
+    up to this number of rows.
+
+    The dump is restored statement by statement in a single transaction, or
+    in transactions of ``RESTORE_BATCH_SIZE`` statements, with
+    ``RESTORE_PRAGMAS`` set during the restore.
+
+    With ``DUMP_WORKERS``, tables of a database file are dumped concurrently
+    by this number of read-only connections sharing the same snapshot. The
+    time spent on each table is kept in ``table_timings``.
     """
 
-    def _write_dump(self, fileobj):
-        cursor = self.connection.cursor()
+    dump_batch_size = 1
+    dump_workers = 1
+    restore_batch_size = 0
+    restore_pragmas: ClassVar[dict] = {"synchronous": "OFF", "journal_mode": "MEMORY"}
+    table_timings = None
+
+    def _get_tables(self, cursor):
         cursor.execute(DUMP_TABLES)
-        for table_name, _, sql in cursor.fetchall():
-            if table_name.startswith("sqlite_") or table_name in self.exclude:
-                continue
-            if sql.startswith("CREATE TABLE"):
-                sql = sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS")
-                # Make SQL commands in 1 line
-                sql = sql.replace("\n    ", "")
-                sql = sql.replace("\n)", ")")
-            fileobj.write(f"{sql};\n".encode())
-
-            table_name_ident = table_name.replace('"', '""')
-            cursor.execute(f'PRAGMA table_info("{table_name_ident}")')
-            column_names = [str(table_info[1]) for table_info in cursor.fetchall()]
-            q = """SELECT 'INSERT OR REPLACE INTO "{0}" VALUES({1})' FROM "{0}";\n""".format(
-                table_name_ident,
-                ",".join(f"""'||quote("{col.replace('"', '""')}")||'""" for col in column_names),
-            )
-            cursor.execute(q)
-            for row in cursor:
-                fileobj.write(f"{row[0]};\n".encode())
+        return [
+            (table_name, sql)
+            for table_name, _, sql in cursor.fetchall()
+            if not table_name.startswith("sqlite_") and table_name not in self.exclude
+        ]
+
+    def _dump_table(self, cursor, table_name, sql, fileobj):
+        """Write the creation and the rows of a table."""
+        start = time.monotonic()
+        batch_size = max(int(self.dump_batch_size), 1)
+        if sql.startswith("CREATE TABLE"):
+            sql = sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS")
+            # Make SQL commands in 1 line
+            sql = sql.replace("\n    ", "")
+            sql = sql.replace("\n)", ")")
+        fileobj.write(f"{sql};\n")
+
+        table_name_ident = table_name.replace('"', '""')
+        cursor.execute(f'PRAGMA table_info("{table_name_ident}")')
+        column_names = [str(table_info[1]) for table_info in cursor.fetchall()]
+        q = """SELECT '({})' FROM "{}";\n""".format(
+            ",".join(f"""'||quote("{col.replace('"', '""')}")||'""" for col in column_names),
+            table_name_ident,
+        )
+        cursor.execute(q)
+        insert = f'INSERT OR REPLACE INTO "{table_name_ident}" VALUES'
+        # Rows are inserted by batches of dump_batch_size in each statement
+        while rows := cursor.fetchmany(batch_size):
+            fileobj.write(f"{insert}{','.join(row[0] for row in rows)};\n")
+        self.table_timings[table_name] = time.monotonic() - start
+
+    def _get_database_path(self):
+        """Return the path of the database file, or ``None`` for in-memory databases."""
+        path = str(self.connection.settings_dict["NAME"])
+        if path == ":memory:" or "mode=memory" in path:
+            return None
+        return path
+
+    def _open_snapshot(self, path, count):
+        """
+        Open read-only connections reading the same state of the database.
+
+        SQLite has no snapshot shared between connections: writers are held
+        off with a reserved lock while each connection starts its read
+        transaction, and the lock is released once they all have.
+        """
+        path = os.path.abspath(path)
+        lock_connection = sqlite3.connect(f"file:{path}?mode=rw", uri=True, isolation_level=None)
+        connections = []
+        try:
+            lock_connection.execute("BEGIN IMMEDIATE")
+            for _ in range(count):
+                connection = sqlite3.connect(
+                    f"file:{path}?mode=ro", uri=True, isolation_level=None, check_same_thread=False
+                )
+                connections.append(connection)
+                connection.execute("BEGIN")
+                connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+        except BaseException:
+            for connection in connections:
+                connection.close()
+            raise
+        finally:
+            lock_connection.close()
+        return connections
+
+    def _write_tables_in_parallel(self, fileobj, path, workers):
+        connections = self._open_snapshot(path, workers)
+        pool = queue.SimpleQueue()
+        for connection in connections:
+            pool.put(connection)
+
+        def dump_table(table_name, sql):
+            buffer = SpooledTemporaryFile(max_size=10 * 1024 * 1024, dir=settings.TMP_DIR)
+            connection = pool.get()
+            cursor = connection.cursor()
+            try:
+                table_file = _WriteBuffer(buffer)
+                self._dump_table(cursor, table_name, sql, table_file)
+                table_file.flush()
+            except BaseException:
+                buffer.close()
+                raise
+            finally:
+                cursor.close()
+                pool.put(connection)
+            buffer.seek(0)
+            return buffer
+
+        try:
+            tables = self._get_tables(connections[0].cursor())
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dbbackup-sqlite") as executor:
+                futures = [executor.submit(dump_table, table_name, sql) for table_name, sql in tables]
+                try:
+                    # Tables are written in the order of a sequential dump
+                    for future in futures:
+                        with future.result() as buffer:
+                            utils.copy_file(buffer, fileobj)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+            etc = connections[0].execute(DUMP_ETC).fetchall()
+        finally:
+            for connection in connections:
+                connection.close()
+        return etc
+
+    def _write_dump(self, fileobj):
+        self.table_timings = {}
+        workers = int(self.dump_workers)
+        path = self._get_database_path() if workers > 1 else None
+        if path is not None:
+            etc = self._write_tables_in_parallel(fileobj, path, workers)
+            fileobj = _WriteBuffer(fileobj)
+        else:
+            fileobj = _WriteBuffer(fileobj)
+            cursor = self.connection.cursor()
+            for table_name, sql in self._get_tables(cursor):
+                self._dump_table(cursor, table_name, sql, fileobj)
+            cursor.execute(DUMP_ETC)
+            etc = cursor.fetchall()
+            cursor.close()
+        for table_name, seconds in sorted(self.table_timings.items(), key=lambda item: -item[1]):
+            logger.debug("Table %s dumped in %.3fs", table_name, seconds)
 
         # Dump indexes, triggers, and views after all tables are created
-        cursor.execute(DUMP_ETC)
-        for _name, _, sql in cursor.fetchall():
+        for _name, _, sql in etc:
             if sql.startswith("CREATE INDEX"):
                 sql = sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1)
             elif sql.startswith("CREATE TRIGGER"):
                 sql = sql.replace("CREATE TRIGGER", "CREATE TRIGGER IF NOT EXISTS", 1)
             elif sql.startswith("CREATE VIEW"):
                 sql = sql.replace("CREATE VIEW", "CREATE VIEW IF NOT EXISTS", 1)
-            fileobj.write(f"{sql};\n".encode())
-        cursor.close()
+            fileobj.write(f"{sql};\n")
+        fileobj.flush()
 
     def create_dump(self):
         if not self.connection.is_usable():
@@ -73,83 +202,213 @@ class SqliteConnector(BaseDBConnector):
         dump_file.seek(0)
         return dump_file
 
-    def _is_sql_command_complete(self, sql_command_bytes):
+    def _iter_statements(self, dump):
         """
-        Check if an SQL command is complete by ensuring that any closing ");\n"
-        is not within a quoted string literal.
+        Yield the SQL statements of a dump, reading it line by line. A
+        statement may span several lines, if its values contain line feeds.
         """
-        sql_str = sql_command_bytes.decode("UTF-8")
-        if not sql_str.endswith(");\n"):
-            return False
-
-        # Parse the SQL to check if we're inside a quoted string at the end
-        in_quotes = False
-        i = 0
-        while i < len(sql_str) - 3:  # -3 to avoid checking the final ");\n"
-            char = sql_str[i]
-            if char == "'":
-                if i + 1 < len(sql_str) and sql_str[i + 1] == "'":
-                    # Escaped single quote (''), skip both
-                    i += 2
-                else:
-                    # Toggle quote state
-                    in_quotes = not in_quotes
-                    i += 1
-            else:
-                i += 1
+        lines = []
+        for line in dump:
+            lines.append(line)
+            if not line.rstrip().endswith(b";"):
+                continue
+            statement = b"".join(lines).decode("UTF-8")
+            if sqlite3.complete_statement(statement):
+                yield statement
+                lines = []
+        statement = b"".join(lines).decode("UTF-8")
+        if statement.strip():
+            yield statement
 
-        # The command is complete if we're not inside quotes when we reach ");\n"
-        return not in_quotes
+    def _execute_statement(self, cursor, statement):
+        try:
+            cursor.execute(statement)
+        except (OperationalError, IntegrityError) as err:
+            err_str = str(err)
+            if not self._should_suppress_error(err_str):
+                warnings.warn(f"Error in db restore: {err}")
+
+    def _set_pragmas(self, cursor, pragmas):
+        """Set PRAGMAs and return their previous values."""
+        previous = {}
+        for name, value in pragmas.items():
+            try:
+                cursor.execute(f"PRAGMA {name}")
+                previous[name] = cursor.fetchall()[0][0]
+                cursor.execute(f"PRAGMA {name} = {value}")
+                cursor.fetchall()
+            except Exception:
+                # PRAGMAs only speed up the restore, it can go on without them
+                logger.debug("Unable to set PRAGMA %s = %s", name, value, exc_info=True)
+        return previous
 
     def restore_dump(self, dump):
         if not self.connection.is_usable():
             self.connection.connect()
         cursor = self.connection.cursor()
-        sql_command = b""
-        sql_is_complete = True
-        for line in dump.readlines():
-            sql_command = sql_command + line
-            line_str = line.decode("UTF-8")
-            if line_str.startswith("INSERT") and not line_str.endswith(");\n"):
-                sql_is_complete = False
-                continue
-            if not sql_is_complete:
-                # Check if the accumulated command is now complete
-                sql_is_complete = self._is_sql_command_complete(sql_command)
-
-            if sql_is_complete:
-                try:
-                    cursor.execute(sql_command.decode("UTF-8"))
-                except (OperationalError, IntegrityError) as err:
-                    err_str = str(err)
-                    if not self._should_suppress_error(err_str):
-                        warnings.warn(f"Error in db restore: {err}")
-
-                sql_command = b""
+        # PRAGMAs can't be changed inside a transaction
+        pragmas = {} if self.connection.in_atomic_block else self.restore_pragmas
+        previous_pragmas = self._set_pragmas(cursor, pragmas)
+        batch_size = int(self.restore_batch_size)
+        try:
+            statements = self._iter_statements(dump)
+            # Each batch starts with the next statement and takes the following ones
+            for first_statement in statements:
+                with transaction.atomic(using=self.database_name):
+                    self._execute_statement(cursor, first_statement)
+                    for statement in islice(statements, batch_size - 1) if batch_size > 0 else statements:
+                        self._execute_statement(cursor, statement)
+        finally:
+            self._set_pragmas(cursor, previous_pragmas)
+            cursor.close()
 
     @staticmethod
     def _should_suppress_error(msg: str):
         return (msg.startswith(("index", "trigger", "view"))) and msg.endswith("already exists")
 
 
+class _WriteBuffer:
+    """Gather text written to a binary file, to encode and write it by large blocks."""
+
+    def __init__(self, fileobj, size=1024 * 1024):
+        self.fileobj = fileobj
+        self.size = size
+        self._parts = []
+        self._length = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._length += len(text)
+        if self._length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.fileobj.write("".join(self._parts).encode())
+            self._parts = []
+            self._length = 0
+
+
 class SqliteCPConnector(BaseDBConnector):
     """
     Create a dump by copy the binary data file.
     Restore by simply copy to the good location.
+
+    The database file is cloned with a reflink where the filesystem supports
+    it, or copied in the kernel, to a temporary file used as the dump. The
+    copy holds the write lock of the database so it isn't changed meanwhile.
+    Databases in WAL mode are checkpointed first; if committed changes are
+    still in the WAL, the database is copied with the SQLite backup API
+    instead. Restores write a temporary file next to the database, then
+    rename it over the database while holding an exclusive lock.
     """
 
+    @contextlib.contextmanager
+    def _copy_lock(self, path):
+        """
+        Hold the write lock of the database, keeping writers from committing
+        and checkpoints from writing into the file. Yield whether the file
+        holds every committed change, which isn't the case if the WAL couldn't
+        be emptied, e.g. because a reader still uses it.
+        """
+        connection = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=rw", uri=True, isolation_level=None)
+        try:
+            wal_mode = connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            if wal_mode:
+                # Checkpoints can't run in a transaction, and don't wait for
+                # readers: the backup API copes with them
+                busy_timeout = connection.execute("PRAGMA busy_timeout").fetchone()[0]
+                connection.execute("PRAGMA busy_timeout=0")
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+                connection.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+            connection.execute("BEGIN IMMEDIATE")
+            # A writer may have committed between the checkpoint and the lock
+            complete = not wal_mode or self._get_wal_size(path) == 0
+            if not complete:
+                connection.execute("ROLLBACK")
+            yield complete
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _get_wal_size(path):
+        try:
+            return os.path.getsize(f"{path}-wal")
+        except FileNotFoundError:
+            return 0
+
+    def _backup_database(self, path, snapshot_path):
+        source = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        try:
+            target = sqlite3.connect(snapshot_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
     def create_dump(self):
         path = self.connection.settings_dict["NAME"]
-        dump = BytesIO()
-        with open(path, "rb") as db_file:
-            copyfileobj(db_file, dump)
-        dump.seek(0)
-        return dump
+        snapshot = NamedTemporaryFile(delete=False, dir=settings.TMP_DIR)
+        try:
+            with snapshot, self._copy_lock(path) as complete:
+                if complete:
+                    with open(path, "rb") as db_file:
+                        utils.copy_file(db_file, snapshot)
+            if not complete:
+                logger.info("%s has changes in its WAL, it is copied with the SQLite backup API", path)
+                self._backup_database(path, snapshot.name)
+            return _TemporaryDumpFile(snapshot.name)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(snapshot.name)
+            raise
+
+    @contextlib.contextmanager
+    def _write_lock(self, path):
+        """
+        Hold an exclusive lock on a database switched to the rollback journal
+        mode, so no other connection uses it or its journal files meanwhile.
+        """
+        connection = sqlite3.connect(path, isolation_level=None)
+        try:
+            try:
+                # Leaving WAL mode checkpoints and removes the WAL
+                connection.execute("PRAGMA journal_mode=DELETE").fetchall()
+            except sqlite3.DatabaseError as err:
+                if isinstance(err, sqlite3.OperationalError):
+                    raise
+                # Not a database, nothing else can be using it
+                logger.warning("%s is not a valid database, it is replaced without lock", path)
+            else:
+                connection.execute("BEGIN EXCLUSIVE")
+            yield
+        finally:
+            connection.close()
 
     def restore_dump(self, dump):
-        path = self.connection.settings_dict["NAME"]
-        with open(path, "wb") as db_file:
-            copyfileobj(dump, db_file)
+        path = os.path.abspath(self.connection.settings_dict["NAME"])
+        # Renames are atomic in the same directory
+        fd, restore_path = mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".restore")
+        try:
+            with os.fdopen(fd, "wb") as db_file:
+                utils.copy_file(dump, db_file)
+                db_file.flush()
+                os.fsync(db_file.fileno())
+            with contextlib.suppress(OSError):
+                copymode(path, restore_path)
+            self.connection.close()
+            with self._write_lock(path):
+                # Journals of the previous database would corrupt the restored one
+                for suffix in ("-journal", "-wal", "-shm"):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(f"{path}{suffix}")
+                os.replace(restore_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(restore_path)
+            raise
 
 
 class SqliteBackupConnector(BaseDBConnector):
@@ -159,13 +418,22 @@ class SqliteBackupConnector(BaseDBConnector):
     in use (unlike simply copying the database file).
     Restore by copying the backup file over the
     database file.
+
+    With ``PAGES``, the database is copied by steps of this number of pages
+    and the source is only locked during each step, letting writers work
+    between them.
     """
 
     extension = "sqlite3"
+    pages = -1
+    sleep = 0.250
 
     def _write_dump(self, fileobj):
         pass
 
+    def _progress(self, status, remaining, total):
+        logger.debug("SQLite backup: %s of %s pages copied", total - remaining, total)
+
     def create_dump(self):
         if not self.connection.is_usable():
             self.connection.connect()
@@ -176,22 +444,51 @@ class SqliteBackupConnector(BaseDBConnector):
 
         # On Windows sqlite3 cannot open a NamedTemporaryFile that is still
         # open by another handle. Use delete=False then reopen.
-        bkp_db_file = NamedTemporaryFile(delete=False)
+        bkp_db_file = NamedTemporaryFile(delete=False, dir=settings.TMP_DIR)
         bkp_path = bkp_db_file.name
         bkp_db_file.close()  # Close so sqlite can open it on Windows.
         try:
-            with sqlite3.connect(bkp_path) as bkp_db_connection:
-                src_db_connection.backup(bkp_db_connection)
-            with open(bkp_path, "rb") as reopened:
-                spooled = SpooledTemporaryFile()
-                copyfileobj(reopened, spooled)
-            spooled.seek(0)
-            return spooled
-        finally:  # pragma: no cover - cleanup best effort
-            with contextlib.suppress(Exception):
+            bkp_db_connection = sqlite3.connect(bkp_path)
+            try:
+                src_db_connection.backup(
+                    bkp_db_connection,
+                    pages=int(self.pages),
+                    progress=self._progress if int(self.pages) > 0 else None,
+                    sleep=float(self.sleep),
+                )
+            finally:
+                bkp_db_connection.close()
+            # The backup file itself is the dump, it isn't copied again
+            return _TemporaryDumpFile(bkp_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
                 os.remove(bkp_path)
+            raise
 
     def restore_dump(self, dump):
         path = self.connection.settings_dict["NAME"]
         with open(path, "wb") as db_file:
-            copyfileobj(dump, db_file)
+            utils.copy_file(dump, db_file)
+
+
+class _TemporaryDumpFile(io.FileIO):
+    """
+    Read-only temporary file removed once it isn't used anymore. It is
+    removed right away where open files can be removed, or when closed.
+    """
+
+    _path_to_remove = None
+
+    def __init__(self, path):
+        super().__init__(path, "rb")
+        self._path_to_remove = path
+        with contextlib.suppress(OSError):
+            os.remove(path)
+            self._path_to_remove = None
+
+    def close(self):
+        super().close()
+        if self._path_to_remove is not None:
+            with contextlib.suppress(OSError):
+                os.remove(self._path_to_remove)
+            self._path_to_remove = None
@@ -0,0 +1,236 @@
+"""
+Parallel downloads of backup files, using ranged requests of remote storages.
+
+Byte ranges of a file are fetched concurrently and read in order through a
+file object, so restores aren't limited by the throughput of a single
+connection. Storages without ranged requests use their ``open`` method.
+"""
+
+import io
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from dbbackup import settings
+from dbbackup.uploads import DEFAULT_RETRIES, call_with_retries
+
+logger = logging.getLogger("dbbackup.storage")
+
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_THREADS = 4
+
+
+class BaseDownloader:
+    """
+    Base class for ranged downloads. Subclasses implement :meth:`get_size`
+    and :meth:`read_range` with the storage's API.
+    """
+
+    def __init__(self, storage, part_size=None, threads=None, retries=None):
+        """
+        :param storage: Django storage
+        :type storage: :class:`django.core.files.storage.Storage`
+
+        :param part_size: Size of ranges in bytes
+        :type part_size: ``int`` or ``None``
+
+        :param threads: Number of ranges downloaded at the same time
+        :type threads: ``int`` or ``None``
+
+        :param retries: Number of times a failed range is requested again
+        :type retries: ``int`` or ``None``
+        """
+        options = settings.PARALLEL_DOWNLOAD or {}
+        self.storage = storage
+        self.part_size = max(int(part_size or options.get("PART_SIZE", DEFAULT_PART_SIZE)), 1)
+        self.threads = max(int(threads or options.get("THREADS", DEFAULT_THREADS)), 1)
+        self.retries = int(options.get("RETRIES", DEFAULT_RETRIES) if retries is None else retries)
+
+    def get_size(self, name):
+        """
+        Override this method to return the size of a file.
+        """
+        msg = "get_size not implemented"
+        raise NotImplementedError(msg)
+
+    def read_range(self, name, start, end):
+        """
+        Override this method to return the bytes of a file from ``start``
+        included to ``end`` excluded.
+        """
+        msg = "read_range not implemented"
+        raise NotImplementedError(msg)
+
+    def _read_range(self, name, start, end):
+        def read():
+            data = self.read_range(name, start, end)
+            if len(data) != end - start:
+                msg = f"Got {len(data)} bytes instead of {end - start} for range {start}-{end} of {name}"
+                raise OSError(msg)
+            return data
+
+        return call_with_retries(read, retries=self.retries, description=f"Download of range {start}-{end}")
+
+    def open(self, name):
+        """
+        Open a file for reading. A file not bigger than a range is opened
+        with the storage's ``open`` method.
+
+        :param name: Name of the file in the storage
+        :type name: ``str``
+
+        :returns: File opened in binary mode
+        :rtype: ``file`` like object
+        """
+        size = self.get_size(name)
+        if size <= self.part_size:
+            return self.storage.open(name, "rb")
+        logger.debug("Downloading %s with %s ranged requests at a time", name, self.threads)
+        return RangeReader(self, name, size)
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read-only file object fetching the next ranges of a file in a thread
+    pool while the current one is read. Seeking outside the current range
+    drops the fetched ranges.
+    """
+
+    def __init__(self, downloader, name, size):
+        super().__init__()
+        self.downloader = downloader
+        self.name = name
+        self.size = size
+        self._position = 0
+        self._buffer = b""
+        self._buffer_start = 0
+        self._next_start = 0
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=downloader.threads, thread_name_prefix="dbbackup-download")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def _schedule(self):
+        while len(self._pending) < self.downloader.threads and self._next_start < self.size:
+            end = min(self._next_start + self.downloader.part_size, self.size)
+            self._pending.append(self._executor.submit(self.downloader._read_range, self.name, self._next_start, end))
+            self._next_start = end
+
+    def _drop_pending(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        filled = 0
+        while filled < len(view) and self._position < self.size:
+            offset = self._position - self._buffer_start
+            if offset >= len(self._buffer):
+                self._schedule()
+                self._buffer_start += len(self._buffer)
+                self._buffer = self._pending.popleft().result()
+                self._schedule()
+                offset = 0
+            data = self._buffer[offset : offset + len(view) - filled]
+            view[filled : filled + len(data)] = data
+            filled += len(data)
+            self._position += len(data)
+        return filled
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            msg = f"Negative seek position {offset}"
+            raise ValueError(msg)
+        if not self._buffer_start <= offset < self._buffer_start + len(self._buffer):
+            self._drop_pending()
+            self._buffer = b""
+            self._buffer_start = self._next_start = offset
+        self._position = offset
+        return offset
+
+    def close(self):
+        if not self.closed:
+            self._drop_pending()
+            self._executor.shutdown(wait=False)
+        super().close()
+
+
+class S3Downloader(BaseDownloader):
+    """
+    Ranged download for ``storages.backends.s3.S3Storage``, using the boto3
+    client.
+    """
+
+    def _get_key(self, name):
+        from storages.utils import clean_name
+
+        return self.storage._normalize_name(clean_name(name))
+
+    def get_size(self, name):
+        client = self.storage.connection.meta.client
+        return client.head_object(Bucket=self.storage.bucket_name, Key=self._get_key(name))["ContentLength"]
+
+    def read_range(self, name, start, end):
+        client = self.storage.connection.meta.client
+        response = client.get_object(
+            Bucket=self.storage.bucket_name, Key=self._get_key(name), Range=f"bytes={start}-{end - 1}"
+        )
+        return response["Body"].read()
+
+
+class GoogleCloudDownloader(BaseDownloader):
+    """
+    Ranged download for ``storages.backends.gcloud.GoogleCloudStorage``.
+    """
+
+    def _get_key(self, name):
+        from storages.utils import clean_name
+
+        return self.storage._normalize_name(clean_name(name))
+
+    def get_size(self, name):
+        blob = self.storage.bucket.get_blob(self._get_key(name))
+        if blob is None:
+            msg = f"File does not exist: {name}"
+            raise FileNotFoundError(msg)
+        return blob.size
+
+    def read_range(self, name, start, end):
+        # GCS ranges include their end
+        return self.storage.bucket.blob(self._get_key(name)).download_as_bytes(start=start, end=end - 1)
+
+
+# Storages are matched by class name, their modules import optional packages
+DOWNLOADERS = {
+    "S3Storage": S3Downloader,
+    "S3Boto3Storage": S3Downloader,
+    "GoogleCloudStorage": GoogleCloudDownloader,
+}
+
+
+def get_downloader(storage, **options):
+    """
+    Get the ranged downloader of a storage.
+
+    :param storage: Django storage
+    :type storage: :class:`django.core.files.storage.Storage`
+
+    :returns: Downloader or ``None`` if the storage has no ranged requests
+    :rtype: :class:`BaseDownloader` or ``None``
+    """
+    for storage_cls in type(storage).__mro__:
+        if storage_cls.__name__ in DOWNLOADERS:
+            return DOWNLOADERS[storage_cls.__name__](storage, **options)
+    return None
@@ -0,0 +1,420 @@
+"""
+Encryption backends used for backup files.
+
+The backend used to encrypt new backups is configured with
+``settings.DBBACKUP_ENCRYPTION``, the one used to decrypt a backup is
+guessed from its file extension.
+"""
+
+from __future__ import annotations
+
+import base64
+import binascii
+import itertools
+import os
+import re
+import struct
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from dbbackup import settings
+
+DEFAULT_BACKEND = "gpg"
+
+
+class EncryptionError(Exception):
+    pass
+
+
+class DecryptionError(Exception):
+    pass
+
+
+class BaseBackend:
+    """
+    Base class for encryption backends. A backend encrypts and decrypts a
+    file object on the fly, yielding the output by chunks. Options of
+    ``settings.DBBACKUP_ENCRYPTION`` are given as lowercase attributes.
+    """
+
+    name = ""
+    extension = ""
+
+    def __init__(self, **options):
+        for option, value in options.items():
+            setattr(self, option.lower(), value)
+
+    def uses_passphrase(self, decrypt=False):
+        """
+        Tell if the backend needs a passphrase to encrypt, or to decrypt if
+        ``decrypt`` is ``True``.
+        """
+        return False
+
+    def iter_encrypt(self, fileobj, passphrase=None):
+        """
+        Override this method to return a generator of the encrypted data of
+        ``fileobj``, read from its position. Configuration errors should be
+        raised before the generator is returned.
+        """
+        msg = "iter_encrypt not implemented"
+        raise NotImplementedError(msg)
+
+    def iter_decrypt(self, fileobj, passphrase=None):
+        """
+        Override this method to return a generator of the decrypted data of
+        ``fileobj``, read from its position.
+        """
+        msg = "iter_decrypt not implemented"
+        raise NotImplementedError(msg)
+
+
+def get_gpg_recipients():
+    """
+    :returns: Recipients of ``settings.DBBACKUP_GPG_RECIPIENT``
+    :rtype: ``list``
+    """
+    recipients = settings.GPG_RECIPIENT
+    if not recipients:
+        return []
+    return [recipients] if isinstance(recipients, str) else list(recipients)
+
+
+class GpgBackend(BaseBackend):
+    """
+    GPG backend, piping data through a ``gpg`` process. Backups are encrypted
+    for each key of ``settings.DBBACKUP_GPG_RECIPIENT``, or with a passphrase
+    if ``settings.DBBACKUP_GPG_SYMMETRIC`` is set.
+    """
+
+    name = "gpg"
+    extension = ".gpg"
+
+    def uses_passphrase(self, decrypt=False):
+        return decrypt or bool(settings.GPG_SYMMETRIC)
+
+    def iter_encrypt(self, fileobj, passphrase=None):
+        if settings.GPG_SYMMETRIC:
+            args = ["--symmetric"]
+        else:
+            recipients = get_gpg_recipients()
+            if not recipients:
+                msg = "Encryption failed; status: no recipient, set DBBACKUP_GPG_RECIPIENT"
+                raise EncryptionError(msg)
+            args = ["--encrypt"]
+            for recipient in recipients:
+                args += ["--recipient", recipient]
+            if settings.GPG_ALWAYS_TRUST:
+                args += ["--trust-model", "always"]
+        return self._run(args, fileobj, EncryptionError, "Encryption failed", passphrase)
+
+    def iter_decrypt(self, fileobj, passphrase=None):
+        return self._run(["--decrypt"], fileobj, DecryptionError, "Decryption failed", passphrase)
+
+    def _run(self, args, fileobj, error_class, failure, passphrase=None):
+        """
+        Run ``gpg`` on a file and return an iterator of its output. The input
+        is written to ``gpg`` by a thread while the output is read, so neither
+        is kept in memory or on disk.
+        """
+        cmd = [settings.GPG_BINARY, "--batch", "--yes", "--no-tty", "--output", "-"]
+        if passphrase is not None:
+            # The passphrase is read from the first line of the input
+            cmd += ["--pinentry-mode", "loopback", "--passphrase-fd", "0"]
+        cmd += args
+        stderr = tempfile.TemporaryFile(dir=settings.TMP_DIR)
+        try:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        except BaseException:
+            stderr.close()
+            raise
+        # Imported here, dbbackup.utils imports this module
+        from dbbackup import utils
+
+        chunks = utils.iter_file(fileobj)
+        if passphrase is not None:
+            chunks = itertools.chain([f"{passphrase}\n".encode()], chunks)
+
+        def get_error(returncode):
+            stderr.seek(0)
+            status = stderr.read().decode(errors="replace").strip()
+            return error_class(f"{failure}; status: {status or returncode}")
+
+        feeder = utils.start_input_feeder(process, chunks)
+        return utils.ProcessOutput(process, get_error, feeder, release=stderr.close)
+
+
+# Header of AEAD files: magic and version, algorithm, segment size, salt of
+# the file key and prefix of segment nonces
+AEAD_MAGIC = b"DBBENC\x01"
+AEAD_HEADER = struct.Struct(">7sBI16s7s")
+AEAD_ALGORITHMS = {"AES-256-GCM": 1, "ChaCha20-Poly1305": 2}
+AEAD_KEY_SIZE = 32
+AEAD_TAG_SIZE = 16
+# Segment sizes accepted, so a corrupted header can't make decryption read huge segments
+AEAD_MIN_SEGMENT_SIZE = 1024
+AEAD_MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class AeadBackend(BaseBackend):
+    """
+    Built-in authenticated encryption with AES-256-GCM or
+    ChaCha20-Poly1305, requires the ``cryptography`` package.
+
+    Data is split in segments of ``SEGMENT_SIZE`` bytes, each encrypted with
+    its own nonce and authentication tag, so ``THREADS`` segments can be
+    encrypted or decrypted concurrently while streaming. Nonces are made of
+    a random prefix, the segment index and a flag on the last segment, so
+    reordered, removed or truncated segments fail the decryption. Each file
+    is encrypted with a key derived from the ``KEY`` and a random salt.
+
+    ``KEY`` is a 32 bytes key or its base64 encoding, or a callable
+    returning it (or the dotted import path of such a callable) to fetch it
+    from a key management service. ``KEY_FILE`` is the path of a file
+    containing the key, raw or in base64.
+    """
+
+    name = "aead"
+    extension = ".enc"
+    algorithm = "AES-256-GCM"
+    key = None
+    key_file = None
+    segment_size = 1024 * 1024
+    threads = 1
+
+    def _get_key(self):
+        key = self.key
+        # Dots aren't part of the base64 alphabet
+        if isinstance(key, str) and "." in key:
+            try:
+                key = import_string(key)
+            except ImportError:
+                msg = f"Can't import the encryption key callable {key!r}"
+                raise ImproperlyConfigured(msg) from None
+        if callable(key):
+            key = key()
+        if isinstance(key, str):
+            key = _decode_key(key, "Invalid encryption key, expected base64 key or import path")
+        if key is None and self.key_file:
+            with open(self.key_file, "rb") as fd:
+                key = fd.read()
+            if len(key) != AEAD_KEY_SIZE:
+                key = _decode_key(key, f"Invalid encryption key file {self.key_file}, expected raw or base64 key")
+        if key is None:
+            msg = "Set DBBACKUP_ENCRYPTION['KEY'] or DBBACKUP_ENCRYPTION['KEY_FILE'] to encrypt backups"
+            raise ImproperlyConfigured(msg)
+        if len(key) != AEAD_KEY_SIZE:
+            msg = f"Encryption key must be {AEAD_KEY_SIZE} bytes long, not {len(key)}"
+            raise ImproperlyConfigured(msg)
+        return bytes(key)
+
+    def _get_cipher(self, algorithm_id, salt):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        cipher_cls = {1: AESGCM, 2: ChaCha20Poly1305}[algorithm_id]
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=AEAD_KEY_SIZE, salt=salt, info=AEAD_MAGIC)
+        return cipher_cls(hkdf.derive(self._get_key()))
+
+    def _map(self, function, items):
+        """Apply a function to items with a thread pool, yielding results in order."""
+        threads = max(int(self.threads or 1), 1)
+        if threads == 1:
+            for item in items:
+                yield function(*item)
+            return
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="dbbackup-aead") as executor:
+            pending = deque()
+            try:
+                for item in items:
+                    pending.append(executor.submit(function, *item))
+                    if len(pending) > 2 * threads:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def iter_encrypt(self, fileobj, passphrase=None):
+        if self.algorithm not in AEAD_ALGORITHMS:
+            msg = f"Unknown encryption algorithm {self.algorithm!r}, must be one of: {', '.join(AEAD_ALGORITHMS)}"
+            raise ImproperlyConfigured(msg)
+        segment_size = int(self.segment_size)
+        if not AEAD_MIN_SEGMENT_SIZE <= segment_size <= AEAD_MAX_SEGMENT_SIZE:
+            msg = f"SEGMENT_SIZE must be between {AEAD_MIN_SEGMENT_SIZE} and {AEAD_MAX_SEGMENT_SIZE} bytes"
+            raise ImproperlyConfigured(msg)
+        algorithm_id = AEAD_ALGORITHMS[self.algorithm]
+        salt, nonce_prefix = os.urandom(16), os.urandom(7)
+        header = AEAD_HEADER.pack(AEAD_MAGIC, algorithm_id, segment_size, salt, nonce_prefix)
+        cipher = self._get_cipher(algorithm_id, salt)
+
+        def encrypt(index, data, last):
+            return cipher.encrypt(_segment_nonce(nonce_prefix, index, last), data, header)
+
+        def _encrypt():
+            yield header
+            yield from self._map(encrypt, _iter_segments(fileobj, segment_size))
+
+        return _encrypt()
+
+    def iter_decrypt(self, fileobj, passphrase=None):
+        from cryptography.exceptions import InvalidTag
+
+        header = _read_full(fileobj, AEAD_HEADER.size)
+        if len(header) < AEAD_HEADER.size or not header.startswith(AEAD_MAGIC):
+            msg = "Decryption failed; status: not an encrypted backup"
+            raise DecryptionError(msg)
+        _magic, algorithm_id, segment_size, salt, nonce_prefix = AEAD_HEADER.unpack(header)
+        if algorithm_id not in AEAD_ALGORITHMS.values():
+            msg = f"Decryption failed; status: unknown algorithm {algorithm_id}"
+            raise DecryptionError(msg)
+        if not AEAD_MIN_SEGMENT_SIZE <= segment_size <= AEAD_MAX_SEGMENT_SIZE:
+            msg = f"Decryption failed; status: invalid segment size {segment_size}"
+            raise DecryptionError(msg)
+        cipher = self._get_cipher(algorithm_id, salt)
+
+        def decrypt(index, data, last):
+            try:
+                return cipher.decrypt(_segment_nonce(nonce_prefix, index, last), data, header)
+            except InvalidTag:
+                msg = f"Decryption failed; status: segment {index} is corrupted, truncated or has a wrong key"
+                raise DecryptionError(msg) from None
+
+        return self._map(decrypt, _iter_segments(fileobj, segment_size + AEAD_TAG_SIZE))
+
+
+def _decode_key(key, error):
+    try:
+        return base64.b64decode(key.strip(), validate=True)
+    except binascii.Error:
+        raise ImproperlyConfigured(error) from None
+
+
+def _segment_nonce(prefix, index, last):
+    return prefix + struct.pack(">IB", index, last)
+
+
+def _read_full(fileobj, size):
+    """Read ``size`` bytes, less only at the end of the file."""
+    data = fileobj.read(size)
+    while data and len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data or b""
+
+
+def _iter_segments(fileobj, size):
+    """
+    Yield ``(index, data, last)`` of the consecutive segments of a file. The
+    last segment is read before being yielded, an empty file has one empty
+    segment.
+    """
+    index = 0
+    data = _read_full(fileobj, size)
+    while True:
+        following = _read_full(fileobj, size)
+        yield index, data, not following
+        if not following:
+            return
+        data = following
+        index += 1
+
+
+BACKENDS = {backend.name: backend for backend in (GpgBackend, AeadBackend)}
+# Encryption is the last transformation, only a metadata file can follow it
+REG_ENCRYPTED = re.compile(
+    rf"(?:{'|'.join(re.escape(backend.extension) for backend in BACKENDS.values())})(?:\.metadata)?$",
+)
+
+
+def get_backend(name=None):
+    """
+    Get an encryption backend, configured by ``settings.DBBACKUP_ENCRYPTION``
+    unless specified.
+
+    :param name: Name of the backend, ``'gpg'`` or ``'aead'``, or the
+                 import path of a :class:`BaseBackend` subclass
+    :type name: ``str`` or ``None``
+
+    :returns: Encryption backend
+    :rtype: :class:`BaseBackend`
+    """
+    options = {key: value for key, value in settings.ENCRYPTION.items() if key != "BACKEND"}
+    name = name or settings.ENCRYPTION.get("BACKEND", DEFAULT_BACKEND)
+    if name in BACKENDS:
+        return BACKENDS[name](**options)
+    try:
+        backend_cls = import_string(name)
+    except ImportError:
+        msg = f"Unknown encryption backend {name!r}, must be one of: {', '.join(BACKENDS)} or an import path"
+        raise ImproperlyConfigured(msg) from None
+    return backend_cls(**options)
+
+
+def get_backend_for_filename(filename, default=DEFAULT_BACKEND):
+    """
+    Guess the backend of an encrypted file from its last extension. The
+    configured backend is used if it has this extension.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param default: Backend name used if the extension is unknown
+    :type default: ``str``
+
+    :returns: Encryption backend
+    :rtype: :class:`BaseBackend`
+    """
+    backend = get_backend()
+    if backend.extension and filename.endswith(backend.extension):
+        return backend
+    for backend_cls in BACKENDS.values():
+        if filename.endswith(backend_cls.extension):
+            return get_backend(backend_cls.name)
+    return get_backend(default)
+
+
+def is_encrypted(filename):
+    """
+    Tell if a backup file name ends with the extension of an encryption
+    backend.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :rtype: ``bool``
+    """
+    if REG_ENCRYPTED.search(filename):
+        return True
+    name = settings.ENCRYPTION.get("BACKEND", DEFAULT_BACKEND)
+    if name in BACKENDS:
+        return False
+    try:
+        extension = import_string(name).extension
+    except ImportError:
+        return False
+    return bool(extension) and filename.removesuffix(".metadata").endswith(extension)
+
+
+def remove_extension(filename, backend):
+    """
+    Remove the backend extension from a file name.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param backend: Encryption backend
+    :type backend: :class:`BaseBackend`
+
+    :rtype: ``str``
+    """
+    return filename.removesuffix(backend.extension)
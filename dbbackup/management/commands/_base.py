@@ -4,13 +4,14 @@ Abstract Command.
 
 from __future__ import annotations
 
+import json
 import logging
 import sys
-from shutil import copyfileobj
 from typing import TYPE_CHECKING
 
 from django.core.management.base import BaseCommand, CommandError
 
+from dbbackup import utils
 from dbbackup.storage import StorageError
 
 if TYPE_CHECKING:
@@ -70,6 +71,7 @@ class BaseDbBackupCommand(BaseCommand):
     uncompress = False
     encrypt = False
     compress = False
+    stream = False
     content_type = ""
 
     def __init__(self, *args, **kwargs):
@@ -120,7 +122,23 @@ class BaseDbBackupCommand(BaseCommand):
         self.logger.info("Writing file to %s", path)
         outputfile.seek(0)
         with open(path, "wb") as fd:
-            copyfileobj(outputfile, fd)
+            utils.copy_file(outputfile, fd)
+
+    def read_metadata(self, filename):
+        """
+        Read the metadata file of a backup in storage.
+
+        :returns: Metadata or ``None`` if missing or malformed
+        :rtype: ``dict`` or ``None``
+        """
+        metadata_filename = f"{filename}.metadata"
+        try:
+            if not self.storage.storage.exists(metadata_filename):
+                return None
+            return json.load(self.storage.read_file(metadata_filename))
+        except Exception:
+            self.logger.warning("Unable to read metadata file for '%s'", filename, exc_info=True)
+            return None
 
     def _get_backup_file(self, database=None, servername=None):
         if self.path:
@@ -145,7 +163,7 @@ class BaseDbBackupCommand(BaseCommand):
             input_file = self.read_from_storage(input_filename)
         return input_filename, input_file
 
-    def _cleanup_old_backups(self, database=None, servername=None):
+    def _cleanup_old_backups(self, database=None, servername=None, keep_filter=None, collect_garbage=True):
         """
         Cleanup old backups, keeping the number of backups specified by
         DBBACKUP_CLEANUP_KEEP.
@@ -156,4 +174,6 @@ class BaseDbBackupCommand(BaseCommand):
             content_type=self.content_type,
             database=database,
             servername=servername,
+            keep_filter=keep_filter,
+            collect_garbage=collect_garbage,
         )
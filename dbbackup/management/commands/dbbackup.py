@@ -2,12 +2,16 @@
 Command for backup database.
 """
 
+import contextlib
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.files.base import ContentFile
 from django.core.management.base import CommandError
+from django.db import connections
 
-from dbbackup import settings, utils
+from dbbackup import chunking, compression, metrics, settings, utils
 from dbbackup.db.base import get_connector
 from dbbackup.management.commands._base import BaseDbBackupCommand, make_option
 from dbbackup.signals import post_backup, pre_backup
@@ -44,8 +48,29 @@ class Command(BaseDbBackupCommand):
             default=[],
             help="Specify schema(s) to backup. Can be used multiple times.",
         ),
+        make_option(
+            "--stream",
+            action="store_true",
+            default=False,
+            help="Stream the dump through compression to storage without spooling it to temporary files",
+        ),
+        make_option(
+            "--dedup",
+            action="store_true",
+            default=False,
+            help="Store the dump as deduplicated chunks shared with previous backups",
+        ),
+        make_option(
+            "-P",
+            "--parallel",
+            type=int,
+            default=1,
+            help="Number of databases to backup at the same time (default: 1)",
+        ),
     )
 
+    dedup = False
+
     @utils.email_uncaught_exception
     def handle(self, **options):
         self.verbosity = options.get("verbosity")
@@ -63,43 +88,101 @@ class Command(BaseDbBackupCommand):
         self.exclude_tables = options.get("exclude_tables")
         self.storage = get_storage()
         self.schemas = options.get("schema")
+        self.stream = options.get("stream", False)
 
         self.database = options.get("database") or ""
+        self.parallel = max(options.get("parallel") or 1, 1)
+        self.dedup = options.get("dedup", False)
+        if self.dedup and (self.encrypt or self.path or self.filename):
+            # Manifests are found by their dated name with the chunks extension
+            msg = "--dedup can't be used with --encrypt, --output-path or --output-filename"
+            raise CommandError(msg)
 
-        for database_key in self._get_database_keys():
-            self.connector = get_connector(database_key)
-            if self.connector and self.exclude_tables:
-                self.connector.exclude.extend(list(self.exclude_tables.replace(" ", "").split(",")))
-            database = self.connector.settings
+        database_keys = self._get_database_keys()
+        if self.parallel > 1 and len(database_keys) > 1:
+            self._backup_databases_in_parallel(database_keys)
+            return
+        for database_key in database_keys:
+            self.connector = self._get_connector(database_key)
             try:
-                self._save_new_backup(database)
-                if self.clean:
-                    self._cleanup_old_backups(database=database_key)
+                self._backup_database(database_key, self.connector)
             except StorageError as err:
                 raise CommandError(err) from err
 
+    def _get_connector(self, database_key):
+        connector = get_connector(database_key)
+        if connector and self.exclude_tables:
+            connector.exclude.extend(list(self.exclude_tables.replace(" ", "").split(",")))
+        return connector
+
+    def _backup_database(self, database_key, connector, collect_garbage=True):
+        """
+        Backup a single database and clean its old backups if asked.
+        """
+        start = time.monotonic()
+        self._save_new_backup(connector.settings, connector=connector)
+        if self.clean:
+            self._cleanup_old_backups(database=database_key, collect_garbage=collect_garbage)
+        self.logger.info("Backup of %s done in %.2fs", database_key, time.monotonic() - start)
+
+    def _backup_database_in_thread(self, database_key):
+        try:
+            # Chunks of the other backups may not be referenced yet
+            self._backup_database(database_key, self._get_connector(database_key), collect_garbage=False)
+        finally:
+            # Django connections are per thread, don't leak them
+            connections.close_all()
+
+    def _backup_databases_in_parallel(self, database_keys):
+        """
+        Backup several databases at the same time, each thread using its own
+        connector and database connection. Errors are reported once all
+        backups are done, and unreferenced chunks are only deleted then.
+        """
+        self.logger.info("Backing up %s databases, %s at a time", len(database_keys), self.parallel)
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix="dbbackup") as executor:
+            futures = [(key, executor.submit(self._backup_database_in_thread, key)) for key in database_keys]
+            for database_key, future in futures:
+                try:
+                    future.result()
+                except Exception as err:
+                    self.logger.exception("Backup of %s failed", database_key)
+                    errors.append(f"{database_key}: {err}")
+        if self.clean and self.dedup:
+            chunking.ChunkStore(self.storage).collect_garbage()
+        if errors:
+            msg = f"{len(errors)} of {len(database_keys)} database backups failed:\n" + "\n".join(errors)
+            raise CommandError(msg)
+
     def _get_database_keys(self):
         """
         Get the list of database keys to backup.
 
         Returns the databases specified by the -d/--database option,
         or falls back to the DBBACKUP_DATABASES setting if no option is provided.
+        Repeated keys are only backed up once.
         """
         if self.database:
             # Split by comma and filter out empty strings to prevent
             # get_connector('') from being called, which would fall back
             # to the 'default' database and ignore DBBACKUP_DATABASES
-            return [key.strip() for key in self.database.split(",") if key.strip()]
-        return settings.DATABASES
+            keys = [key.strip() for key in self.database.split(",") if key.strip()]
+        else:
+            keys = settings.DATABASES
+        return list(dict.fromkeys(keys))
 
-    def _save_metadata(self, filename, local=False):
+    def _save_metadata(self, filename, local=False, connector=None, backup_metrics=None):
         """
         Save metadata file for the backup.
         """
+        connector = connector or self.connector
         metadata = {
-            "engine": self.connector.connection.settings_dict["ENGINE"],
-            "connector": f"{self.connector.__module__}.{self.connector.__class__.__name__}",
+            "engine": connector.connection.settings_dict["ENGINE"],
+            "connector": f"{connector.__module__}.{connector.__class__.__name__}",
         }
+        if backup_metrics is not None:
+            metadata["metrics"] = backup_metrics
         metadata_filename = f"{filename}.metadata"
 
         # Load custom metadata if configured
@@ -116,61 +199,158 @@ class Command(BaseDbBackupCommand):
             metadata_file = ContentFile(metadata_content.encode("utf-8"))
             self.write_to_storage(metadata_file, metadata_filename)
 
-    def _save_new_backup(self, database):
+    def _write_backup_to_storage(self, outputfile, filename):
+        """
+        Write backup to storage, removing what has been partially written if
+        a streamed dump fails during the upload. A file already stored under
+        the name is kept: storages overwriting files may still hold it, and
+        others save the backup under another name.
+        """
+        streamed = isinstance(outputfile, utils.IterStream)
+        existed = streamed and self.storage.storage.exists(filename)
+        try:
+            self.write_to_storage(outputfile, filename)
+        except Exception:
+            if streamed and not existed:
+                with contextlib.suppress(Exception):
+                    self.storage.delete_file(filename)
+            raise
+        finally:
+            if streamed:
+                outputfile.close()
+
+    def _get_known_chunks(self, chunk_store, filename):
+        """
+        Return the chunks of the latest deduplicated backup of the same
+        database, they don't need to be looked up in storage.
+        """
+        database = utils.parse_backup_name(filename).database
+        manifests = [
+            name
+            for name in self.storage.list_backups(content_type="db", database=database)
+            if chunking.is_manifest_filename(name)
+        ]
+        if not manifests:
+            return set()
+        latest = max(manifests, key=lambda name: utils.parse_backup_name(name).sort_date)
+        try:
+            return chunk_store.get_chunk_paths(chunk_store.read_manifest(latest))
+        except Exception:
+            self.logger.warning("Unable to read chunk manifest %s", latest, exc_info=True)
+            return set()
+
+    def _write_chunks(self, outputfile, filename):
+        """
+        Store the dump as chunks, compressed if asked, and return its
+        manifest as backup file.
+        """
+        chunk_store = chunking.ChunkStore(self.storage)
+        codec = compression.get_codec() if self.compress else None
+        known_chunks = self._get_known_chunks(chunk_store, filename)
+        outputfile.seek(0)
+        try:
+            manifest = chunk_store.write(outputfile, filename, codec=codec, known_chunks=known_chunks)
+        finally:
+            if isinstance(outputfile, utils.IterStream):
+                outputfile.close()
+        extension = codec.extension if codec else ""
+        manifest_file = ContentFile(json.dumps(manifest).encode("utf-8"))
+        return manifest_file, f"{filename}{extension}.{chunking.MANIFEST_EXTENSION}"
+
+    def _save_new_backup(self, database, connector=None):
         """
         Save a new backup file.
         """
+        connector = connector or self.connector
         self.logger.info("Backing Up Database: %s", database["NAME"])
 
         # Send pre_backup signal
         pre_backup.send(
             sender=self.__class__,
             database=database,
-            connector=self.connector,
+            connector=connector,
             servername=self.servername,
         )
 
         # Get backup, schema and name
-        filename = self.connector.generate_filename(self.servername)
+        filename = connector.generate_filename(self.servername)
 
         if self.schemas:
-            self.connector.schemas = self.schemas
+            connector.schemas = self.schemas
+        connector.stream = self.stream
 
-        outputfile = self.connector.create_dump()
+        backup_metrics = metrics.BackupMetrics()
+        with backup_metrics.stage("dump") as stage:
+            outputfile = connector.create_dump()
+            stage["bytes_out"] = metrics.get_size(outputfile)
+            stage["streamed"] = metrics.is_stream(outputfile)
 
         # Apply trans
-        if self.compress:
-            compressed_file, filename = utils.compress_file(outputfile, filename)
-            outputfile = compressed_file
+        if self.dedup:
+            with backup_metrics.stage("chunk", bytes_in=metrics.get_size(outputfile)) as stage:
+                outputfile, filename = self._write_chunks(outputfile, filename)
+                stage["bytes_out"] = metrics.get_size(outputfile)
+        elif self.compress:
+            compress = utils.compress_stream if self.stream else utils.compress_file
+            with backup_metrics.stage("compress", bytes_in=metrics.get_size(outputfile)) as stage:
+                compressed_file, filename = compress(outputfile, filename)
+                outputfile = compressed_file
+                stage["bytes_out"] = metrics.get_size(outputfile)
+                stage["streamed"] = metrics.is_stream(outputfile)
 
         if self.encrypt:
-            encrypted_file, filename = utils.encrypt_file(outputfile, filename)
-            outputfile = encrypted_file
+            encrypt = utils.encrypt_stream if self.stream else utils.encrypt_file
+            with backup_metrics.stage("encrypt", bytes_in=metrics.get_size(outputfile)) as stage:
+                encrypted_file, filename = encrypt(outputfile, filename)
+                outputfile = encrypted_file
+                stage["bytes_out"] = metrics.get_size(outputfile)
+                stage["streamed"] = metrics.is_stream(outputfile)
 
         # Set file name
         filename = self.filename or filename
-        self.logger.debug("Backup size: %s", utils.handle_size(outputfile))
+        if isinstance(outputfile, utils.IterStream):
+            self.logger.debug("Streaming backup, size unknown until written")
+        else:
+            self.logger.debug("Backup size: %s", utils.handle_size(outputfile))
 
         # Store backup
         outputfile.seek(0)
 
-        if self.path is None:
-            self.write_to_storage(outputfile, filename)
-            self._save_metadata(filename)
-        elif self.path.startswith("s3://"):
-            # Handle S3 URIs through storage backend
-            self.write_to_storage(outputfile, self.path)
-            self._save_metadata(self.path)
-        else:
-            self.write_local_file(outputfile, self.path)
-            self._save_metadata(self.path, local=True)
+        # S3 URIs are handled through storage backend
+        to_storage = self.path is None or self.path.startswith("s3://")
+        target = self.path or filename
+        with backup_metrics.stage("upload", bytes_in=metrics.get_size(outputfile)) as stage:
+            if to_storage:
+                self._write_backup_to_storage(outputfile, target)
+            else:
+                self.write_local_file(outputfile, target)
+            if metrics.is_stream(outputfile):
+                # The size of a stream is known once it has been read
+                stage["bytes_in"] = outputfile.tell()
+
+        # The metadata holds the metrics of the previous stages
+        with backup_metrics.stage("metadata"):
+            self._save_metadata(
+                target, local=not to_storage, connector=connector, backup_metrics=backup_metrics.as_dict()
+            )
+        backup_metrics.finish()
+        backup_metrics = backup_metrics.as_dict()
+        self.logger.debug(
+            "Backup stages: %s",
+            ", ".join(
+                f"{name} {stage['seconds']:.3f}s" if stage["seconds"] is not None else f"{name} streamed"
+                for name, stage in backup_metrics["stages"].items()
+            ),
+        )
+        metrics.export_metrics(backup_metrics, connector.database_name)
 
         # Send post_backup signal
         post_backup.send(
             sender=self.__class__,
             database=database,
-            connector=self.connector,
+            connector=connector,
             servername=self.servername,
             filename=filename,
             storage=self.storage,
+            metrics=backup_metrics,
         )
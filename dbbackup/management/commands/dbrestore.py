@@ -14,7 +14,7 @@ from django.conf import settings
 from django.core.management.base import CommandError
 from django.db import connection
 
-from dbbackup import utils
+from dbbackup import chunking, utils
 from dbbackup.db.base import get_connector
 from dbbackup.management.commands._base import BaseDbBackupCommand, make_option
 from dbbackup.signals import post_restore, pre_restore
@@ -65,6 +65,12 @@ class Command(BaseDbBackupCommand):
             default="",
             help="Additional pg_restore options, e.g. '--if-exists --no-owner'. Use quotes.",
         ),
+        make_option(
+            "--stream",
+            action="store_true",
+            default=False,
+            help="Stream the backup from storage through decompression into the restore without temporary files",
+        ),
     )
 
     def handle(self, *args, **options):
@@ -88,6 +94,7 @@ class Command(BaseDbBackupCommand):
             self.no_drop = options.get("no_drop")
             self.pg_options = options.get("pg_options", "")
             self.schemas = options.get("schema")
+            self.stream = options.get("stream", False)
             self._restore_backup()
         except StorageError as err:
             raise CommandError(err) from err
@@ -163,6 +170,22 @@ class Command(BaseDbBackupCommand):
 
         return metadata
 
+    def _read_chunks(self, manifest_file):
+        """
+        Return a stream of the dump described by a chunk manifest, and the
+        dump's name.
+        """
+        try:
+            manifest = chunking.load_manifest(manifest_file)
+        except ValueError as err:
+            msg = f"Invalid chunk manifest: {err}"
+            raise CommandError(msg) from err
+        finally:
+            manifest_file.close()
+        chunk_store = chunking.ChunkStore(self.storage)
+        self.logger.info("Reading %s chunks of %s", len(manifest["chunks"]), manifest["filename"])
+        return utils.IterStream(chunk_store.iter_read(manifest), name=manifest["filename"]), manifest["filename"]
+
     def _restore_backup(self):
         """Restore the specified database."""
         input_filename, input_file = self._get_backup_file(
@@ -192,18 +215,27 @@ class Command(BaseDbBackupCommand):
             storage=self.storage,
         )
 
-        if self.decrypt:
-            unencrypted_file, input_filename = utils.unencrypt_file(input_file, input_filename, self.passphrase)
-            input_file.close()
-            input_file = unencrypted_file
-        if self.uncompress:
-            uncompressed_file, input_filename = utils.uncompress_file(input_file, input_filename)
-            input_file.close()
-            input_file = uncompressed_file
+        if chunking.is_manifest_filename(input_filename) or chunking.is_manifest_file(input_file):
+            # Chunks are uncompressed as described by the manifest
+            input_file, input_filename = self._read_chunks(input_file)
+        else:
+            if self.decrypt and self.stream:
+                input_file, input_filename = utils.unencrypt_stream(input_file, input_filename, self.passphrase)
+            elif self.decrypt:
+                unencrypted_file, input_filename = utils.unencrypt_file(input_file, input_filename, self.passphrase)
+                input_file.close()
+                input_file = unencrypted_file
+            if self.uncompress and self.stream:
+                input_file, input_filename = utils.uncompress_stream(input_file, input_filename)
+            elif self.uncompress:
+                uncompressed_file, input_filename = utils.uncompress_file(input_file, input_filename)
+                input_file.close()
+                input_file = uncompressed_file
 
         # Convert remote storage files to SpooledTemporaryFile for compatibility with subprocess
         # This fixes the issue with FTP and other remote storage backends that don't support fileno()
-        if not self.path:  # Only for remote storage files, not local files
+        # Streamed restores feed such files to the subprocess through a pipe instead.
+        if not self.path and not self.stream:  # Only for remote storage files, not local files
             try:
                 # Test if the file supports fileno() - required by subprocess.Popen
                 input_file.fileno()
@@ -216,7 +248,10 @@ class Command(BaseDbBackupCommand):
                 input_file.close()
                 input_file = temp_file
 
-        self.logger.info("Restore tempfile created: %s", utils.handle_size(input_file))
+        if self.stream:
+            self.logger.info("Restore will be streamed from: %s", input_filename)
+        else:
+            self.logger.info("Restore tempfile created: %s", utils.handle_size(input_file))
         if self.interactive:
             self._ask_confirmation()
 
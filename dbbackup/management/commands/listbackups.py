@@ -46,11 +46,19 @@ class Command(BaseDbBackupCommand):
             dest="encrypted",
         ),
         make_option("-c", "--content-type", help="Filter by content type 'db' or 'media'"),
+        make_option(
+            "--reconcile",
+            help="Rebuild the backup catalog from the storage's content before listing",
+            action="store_true",
+            default=False,
+        ),
     )
 
     def handle(self, **options):
         self.quiet = options.get("quiet")
         self.storage = get_storage()
+        if options.get("reconcile"):
+            self.reconcile_catalog()
         files_attr = self.get_backup_attrs(options)
         if not self.quiet:
             title = ROW_TEMPLATE.format(name="Name", datetime="Datetime")
@@ -59,6 +67,14 @@ class Command(BaseDbBackupCommand):
             row = ROW_TEMPLATE.format(**file_attr)
             self.stdout.write(row)
 
+    def reconcile_catalog(self):
+        if self.storage.catalog is None:
+            self.stderr.write("The backup catalog is disabled, set DBBACKUP_CATALOG = True to use it")
+            return
+        added, removed = self.storage.catalog.reconcile()
+        if not self.quiet:
+            self.stdout.write(f"Backup catalog reconciled: {len(added)} added, {len(removed)} removed")
+
     def get_backup_attrs(self, options):
         filters = {k: v for k, v in options.items() if k in FILTER_KEYS}
         filenames = self.storage.list_backups(**filters)
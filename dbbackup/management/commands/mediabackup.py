@@ -2,12 +2,18 @@
 Save media files.
 """
 
+import hashlib
+import json
 import os
 import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
+from django.core.files.base import ContentFile
 from django.core.management.base import CommandError
 
-from dbbackup import utils
+from dbbackup import compression, settings, utils
 from dbbackup.management.commands._base import BaseDbBackupCommand, make_option
 from dbbackup.signals import post_media_backup, pre_media_backup
 from dbbackup.storage import StorageError, get_storage, get_storage_class
@@ -31,8 +37,16 @@ class Command(BaseDbBackupCommand):
             default=None,
             help="Specify where to store backup (local filesystem path or S3 URI like s3://bucket/path/)",
         ),
+        make_option(
+            "--incremental",
+            help="Only store files added or changed since the previous media backup",
+            action="store_true",
+            default=False,
+        ),
     )
 
+    incremental = False
+
     @utils.email_uncaught_exception
     def handle(self, **options):
         self.verbosity = options.get("verbosity")
@@ -45,12 +59,16 @@ class Command(BaseDbBackupCommand):
 
         self.filename = options.get("output_filename")
         self.path = options.get("output_path")
+        self.incremental = options.get("incremental", False)
         try:
             self.media_storage = get_storage_class()()
             self.storage = get_storage()
             self.backup_mediafiles()
             if options.get("clean"):
-                self._cleanup_old_backups(servername=self.servername)
+                keep_filter = None
+                if self.incremental and self.path is None:
+                    keep_filter = self._get_chain_keep_filter()
+                self._cleanup_old_backups(servername=self.servername, keep_filter=keep_filter)
 
         except StorageError as err:
             raise CommandError(err) from err
@@ -66,23 +84,189 @@ class Command(BaseDbBackupCommand):
                 yield os.path.join(path, media_filename)
             dirs.extend([os.path.join(path, subdir) for subdir in subdirs])
 
-    def _create_tar(self, name):
-        """Create TAR file."""
+    def _get_media_file_state(self, media_filename):
+        """Return size and modification time of a media file."""
+        try:
+            mtime = self.media_storage.get_modified_time(media_filename).timestamp()
+        except (NotImplementedError, OSError):
+            # Without modification time, files are always considered changed
+            mtime = None
+        return {"size": self.media_storage.size(media_filename), "mtime": mtime}
+
+    def _fetch_media_file(self, media_filename, previous_manifest=None, max_size=0):
+        """
+        Get what is needed to archive a media file: its state in incremental
+        mode, its size, and its content if it is not bigger than ``max_size``.
+        Bigger files are left open, and streamed from storage when archived.
+        """
+        state = None
+        if self.incremental:
+            state = self._get_media_file_state(media_filename)
+            previous = (previous_manifest or {}).get(media_filename)
+            if (
+                previous
+                and state["mtime"] is not None
+                and (previous["size"], previous["mtime"]) == (state["size"], state["mtime"])
+            ):
+                return _MediaFile(media_filename, state, sha256=previous["sha256"])
+            size = state["size"]
+        else:
+            size = self.media_storage.size(media_filename)
+        media_file = self.media_storage.open(media_filename)
+        if size > max_size:
+            return _MediaFile(media_filename, state, size=size, file=media_file)
+        with media_file:
+            content = media_file.read()
+        return _MediaFile(media_filename, state, size=len(content), content=content)
+
+    def _iter_media_files(self, previous_manifest=None):
+        """
+        Yield media files to archive in order. With
+        ``DBBACKUP_MEDIA_PREFETCH['WORKERS']`` greater than 1, the next files
+        are fetched by a thread pool while the current one is archived.
+        """
+        options = settings.MEDIA_PREFETCH
+        workers = int(options.get("WORKERS", 1))
+        if workers <= 1:
+            for media_filename in self._explore_storage():
+                yield self._fetch_media_file(media_filename, previous_manifest)
+            return
+        depth = max(int(options.get("DEPTH", 2 * workers)), 1)
+        # Each prefetched file is kept in memory only if it fits its share of the budget
+        max_size = max(int(options.get("MAX_MEMORY", 64 * 1024 * 1024)) // depth, 1)
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dbbackup-media") as executor:
+                try:
+                    for media_filename in self._explore_storage():
+                        pending.append(
+                            executor.submit(self._fetch_media_file, media_filename, previous_manifest, max_size)
+                        )
+                        if len(pending) >= depth:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                finally:
+                    for future in pending:
+                        future.cancel()
+        finally:
+            # Files fetched but not archived are left open
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
+
+    def _add_media_file(self, tar_file, media):
+        """Write a media file in the TAR and record it in the manifest."""
+        tarinfo = tarfile.TarInfo(media.name)
+        tarinfo.size = media.size
+        media_file = BytesIO(media.content) if media.content is not None else media.file
+        with media_file:
+            reader = _HashingReader(media_file) if self.incremental else media_file
+            tar_file.addfile(tarinfo, reader)
+        self.stored_files += 1
+        if self.incremental:
+            self.manifest[media.name] = {**media.state, "size": tarinfo.size, "sha256": reader.hexdigest()}
+
+    def _create_tar(self, name, previous_manifest=None):
+        """
+        Create TAR file. If a manifest of the previous backup is given, files
+        with the same size and modification time are skipped. In incremental
+        mode ``self.manifest`` describes all current media files.
+        """
         fileobj = utils.create_spooled_temporary_file()
-        mode = "w:gz" if self.compress else "w"
-        tar_file = tarfile.open(name=name, fileobj=fileobj, mode=mode)
-        for media_filename in self._explore_storage():
-            tarinfo = tarfile.TarInfo(media_filename)
-            media_file = self.media_storage.open(media_filename)
-            tarinfo.size = len(media_file)
-            tar_file.addfile(tarinfo, media_file)
+        writer = compression.get_codec().open_writer(fileobj) if self.compress else fileobj
+        tar_file = tarfile.open(name=name, fileobj=writer, mode="w|")
+        self.manifest = {}
+        self.stored_files = 0
+        for media in self._iter_media_files(previous_manifest):
+            if media.sha256 is not None:
+                # Unchanged since the previous backup
+                self.manifest[media.name] = {**media.state, "sha256": media.sha256}
+                continue
+            self._add_media_file(tar_file, media)
         # Close the TAR for writing
         tar_file.close()
+        if writer is not fileobj:
+            writer.close()
         return fileobj
 
+    def _get_previous_backup(self):
+        """
+        Return the name and metadata of the previous media backup an
+        increment can be based on, or ``(None, None)``. A full backup is
+        made when the previous backup's chain has
+        ``DBBACKUP_MEDIA_INCREMENTAL_MAX_CHAIN`` backups.
+        """
+        try:
+            filename = self.storage.get_latest_backup(
+                encrypted=self.encrypt,
+                compressed=self.compress,
+                content_type="media",
+                servername=self.servername,
+            )
+        except StorageError:
+            self.logger.info("No previous media backup, doing a full backup")
+            return None, None
+        metadata = self.read_metadata(filename)
+        if not metadata or "manifest" not in metadata:
+            self.logger.info("Previous media backup %s has no manifest, doing a full backup", filename)
+            return None, None
+        max_chain = settings.MEDIA_INCREMENTAL_MAX_CHAIN
+        if max_chain and metadata.get("chain", 1) >= max_chain:
+            self.logger.info("Chain of previous media backup %s is complete, doing a full backup", filename)
+            return None, None
+        return filename, metadata
+
+    def _get_chain(self, filename, metadata_cache):
+        """Return the names of the backups an incremental backup is based on."""
+        chain = []
+        name = filename
+        while name not in chain:
+            if name not in metadata_cache:
+                metadata_cache[name] = self.read_metadata(name)
+            metadata = metadata_cache[name]
+            if not metadata or not metadata.get("base"):
+                break
+            name = metadata["base"]
+            chain.append(name)
+        return chain
+
+    def _get_chain_keep_filter(self):
+        """
+        Return a cleanup filter keeping the backups that the backups kept by
+        the cleanup are based on. Older chains are deleted as a whole.
+        """
+        files = self.storage.list_backups(
+            encrypted=self.encrypt,
+            compressed=self.compress,
+            content_type=self.content_type,
+            servername=self.servername,
+        )
+        files = sorted(files, key=lambda name: utils.parse_backup_name(name).sort_date, reverse=True)
+        kept = [
+            name
+            for index, name in enumerate(files)
+            if index < settings.CLEANUP_KEEP_MEDIA or settings.CLEANUP_KEEP_FILTER(name)
+        ]
+        metadata_cache = {}
+        needed = {base for name in kept for base in self._get_chain(name, metadata_cache)}
+        return lambda name: name in needed or settings.CLEANUP_KEEP_FILTER(name)
+
+    def _save_metadata(self, filename, metadata):
+        content = json.dumps(metadata)
+        if self.path is None or self.path.startswith("s3://"):
+            self.write_to_storage(ContentFile(content.encode("utf-8")), f"{filename}.metadata")
+        else:
+            self.logger.info("Writing metadata file to %s.metadata", filename)
+            with open(f"{filename}.metadata", "w") as fd:
+                fd.write(content)
+
     def backup_mediafiles(self):
         """
         Create backup file and write it to storage.
+
+        :returns: Name of the backup file
+        :rtype: ``str``
         """
         # Send pre_media_backup signal
         pre_media_backup.send(
@@ -95,10 +279,16 @@ class Command(BaseDbBackupCommand):
         if self.filename:
             filename = self.filename
         else:
-            extension = f"tar{'.gz' if self.compress else ''}"
+            extension = f"tar{compression.get_codec().extension if self.compress else ''}"
             filename = utils.filename_generate(extension, servername=self.servername, content_type=self.content_type)
 
-        tarball = self._create_tar(filename)
+        base_filename, previous_manifest, chain = None, None, 1
+        if self.incremental:
+            base_filename, previous_metadata = self._get_previous_backup()
+            if previous_metadata:
+                previous_manifest = previous_metadata["manifest"]
+                chain = previous_metadata.get("chain", 1) + 1
+        tarball = self._create_tar(filename, previous_manifest)
         # Apply trans
         if self.encrypt:
             encrypted_file = utils.encrypt_file(tarball, filename)
@@ -115,6 +305,25 @@ class Command(BaseDbBackupCommand):
         else:
             self.write_local_file(tarball, self.path)
 
+        if self.incremental:
+            deleted = sorted(set(previous_manifest or ()) - set(self.manifest))
+            self.logger.info(
+                "%s media files stored, %s unchanged, %s deleted",
+                self.stored_files,
+                len(self.manifest) - self.stored_files,
+                len(deleted),
+            )
+            self._save_metadata(
+                self.path or filename,
+                {
+                    "incremental": True,
+                    "base": base_filename,
+                    "chain": chain,
+                    "manifest": self.manifest,
+                    "deleted": deleted,
+                },
+            )
+
         # Send post_media_backup signal
         post_media_backup.send(
             sender=self.__class__,
@@ -122,3 +331,38 @@ class Command(BaseDbBackupCommand):
             servername=self.servername,
             storage=self.storage,
         )
+        return filename
+
+
+class _MediaFile:
+    """Media file fetched for archiving, with its content or its open file."""
+
+    __slots__ = ("content", "file", "name", "sha256", "size", "state")
+
+    def __init__(self, name, state=None, size=None, content=None, file=None, sha256=None):
+        self.name = name
+        self.state = state
+        self.size = size
+        self.content = content
+        self.file = file
+        self.sha256 = sha256
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class _HashingReader:
+    """Compute SHA-256 of a file while it is read."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
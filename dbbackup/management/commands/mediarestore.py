@@ -2,9 +2,14 @@
 Restore media files.
 """
 
+import os
 import tarfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from dbbackup import utils
+from django.core.files.base import ContentFile
+from django.core.management.base import CommandError
+
+from dbbackup import compression, encryption, settings, utils
 from dbbackup.management.commands._base import BaseDbBackupCommand, make_option
 from dbbackup.signals import post_media_restore, pre_media_restore
 from dbbackup.storage import get_storage, get_storage_class
@@ -43,8 +48,18 @@ class Command(BaseDbBackupCommand):
             help="Uncompress gzip data before restoring",
         ),
         make_option("-r", "--replace", help="Replace existing files", action="store_true"),
+        make_option(
+            "-P",
+            "--parallel",
+            type=int,
+            default=1,
+            help="Number of files uploaded to the media storage at the same time",
+        ),
     )
 
+    parallel = 1
+    existing_files = None
+
     def handle(self, *args, **options):
         """Django command handler."""
         self.verbosity = int(options.get("verbosity", "1"))
@@ -61,13 +76,34 @@ class Command(BaseDbBackupCommand):
         self.replace = options.get("replace")
         self.passphrase = options.get("passphrase")
         self.interactive = options.get("interactive")
+        self.parallel = max(options.get("parallel") or 1, 1)
 
         self.storage = get_storage()
         self.media_storage = get_storage_class()()
         self._restore_backup()
 
+    def _list_media_files(self):
+        """Return the names of all files in media storage."""
+        names = set()
+        dirs = [""]
+        while dirs:
+            path = dirs.pop()
+            try:
+                subdirs, files = self.media_storage.listdir(path)
+            except FileNotFoundError:
+                continue
+            names.update(os.path.join(path, media_filename) for media_filename in files)
+            dirs.extend(os.path.join(path, subdir) for subdir in subdirs)
+        return names
+
+    def _exists(self, name):
+        # Files are listed once before parallel restores instead of checked one by one
+        if self.existing_files is not None:
+            return name in self.existing_files
+        return self.media_storage.exists(name)
+
     def _upload_file(self, name, media_file):
-        if self.media_storage.exists(name):
+        if self._exists(name):
             if not self.replace:
                 return
             self.media_storage.delete(name)
@@ -75,10 +111,122 @@ class Command(BaseDbBackupCommand):
         self.media_storage.save(name, media_file)
         self.logger.info("%s uploaded", name)
 
+    def _iter_tar_files(self, tar_file, paths=None):
+        """
+        Yield name, size and file object of the files of a TAR to restore,
+        only the ones in ``paths`` if given. Yielded files are removed from
+        ``paths``.
+        """
+        for media_file_info in tar_file:
+            if media_file_info.path == "media":
+                continue  # Don't copy root directory
+            name = media_file_info.path
+            if paths is not None and name not in paths:
+                continue  # Restored from a more recent increment or deleted
+            media_file = tar_file.extractfile(media_file_info)
+            if media_file is None:
+                continue  # Skip directories
+            yield name, media_file_info.size, media_file
+            if paths is not None:
+                paths.discard(name)
+
+    def _restore_tar(self, tar_file, paths=None):
+        """
+        Restore the files of a TAR, only the ones in ``paths`` if given. Restored
+        files are removed from ``paths``.
+        """
+        if self.parallel > 1:
+            self._restore_tar_in_parallel(tar_file, paths)
+            return
+        # Restore file 1 by 1
+        for name, _size, media_file in self._iter_tar_files(tar_file, paths):
+            self._upload_file(name, media_file)
+
+    def _restore_tar_in_parallel(self, tar_file, paths=None):
+        """
+        Restore the files of a TAR with a thread pool. The TAR is read
+        sequentially and files are uploaded from memory, with at most
+        ``settings.MEDIA_RESTORE_MAX_MEMORY`` bytes waiting to be uploaded.
+        Bigger files are uploaded directly from the TAR.
+        """
+        max_memory = settings.MEDIA_RESTORE_MAX_MEMORY
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix="dbbackup-upload") as executor:
+
+            def wait_for(memory):
+                while pending and sum(pending.values()) > memory:
+                    done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del pending[future]
+                        future.result()
+
+            try:
+                for name, size, media_file in self._iter_tar_files(tar_file, paths):
+                    if size > max_memory:
+                        wait_for(0)
+                        self._upload_file(name, media_file)
+                        continue
+                    wait_for(max_memory - size)
+                    content = ContentFile(media_file.read())
+                    pending[executor.submit(self._upload_file, name, content)] = size
+                wait_for(0)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _open_backup(self, filename):
+        """Read a backup of an incremental chain, decrypted and uncompressed."""
+        input_file = self.read_from_storage(filename)
+        if encryption.is_encrypted(filename):
+            unencrypted_file, filename = utils.unencrypt_file(input_file, filename, self.passphrase)
+            input_file.close()
+            input_file = unencrypted_file
+        if compression.is_compressed(filename):
+            uncompressed_file, filename = utils.uncompress_file(input_file, filename)
+            input_file.close()
+            input_file = uncompressed_file
+        input_file.seek(0)
+        return input_file
+
+    def _restore_chain(self, tar_file, metadata):
+        """
+        Restore an incremental backup: files listed in its manifest are taken
+        from the most recent backup of the chain containing them.
+        """
+        manifest = set(metadata["manifest"])
+        remaining = set(manifest)
+        deleted = set(metadata.get("deleted", ()))
+        self._restore_tar(tar_file, remaining)
+        base = metadata.get("base")
+        while base and remaining:
+            self.logger.info("Restoring from base backup: %s", base)
+            metadata = self.read_metadata(base)
+            if metadata is None:
+                msg = f"Metadata of base backup {base} not found, the incremental chain is broken"
+                raise CommandError(msg)
+            base_file = self._open_backup(base)
+            try:
+                with tarfile.open(fileobj=base_file, mode="r:") as base_tar_file:
+                    self._restore_tar(base_tar_file, remaining)
+            finally:
+                base_file.close()
+            deleted.update(metadata.get("deleted", ()))
+            base = metadata.get("base")
+        if remaining:
+            msg = f"{len(remaining)} media files not found in the incremental chain, e.g. {min(remaining)}"
+            raise CommandError(msg)
+        if self.replace:
+            for name in sorted(deleted - manifest):
+                if self._exists(name):
+                    self.media_storage.delete(name)
+                    self.logger.info("%s deleted", name)
+
     def _restore_backup(self):
         self.logger.info("Restoring backup for media files")
         input_filename, input_file = self._get_backup_file(servername=self.servername)
         self.logger.info("Restoring: %s", input_filename)
+        # Metadata are named after the stored file, before decryption and decompression
+        metadata = None if self.path else self.read_metadata(input_filename)
 
         # Send pre_media_restore signal
         pre_media_restore.send(
@@ -103,15 +251,11 @@ class Command(BaseDbBackupCommand):
 
         input_file.seek(0)
         tar_file = tarfile.open(fileobj=input_file, mode="r:")
-        # Restore file 1 by 1
-        for media_file_info in tar_file:
-            if media_file_info.path == "media":
-                continue  # Don't copy root directory
-            media_file = tar_file.extractfile(media_file_info)
-            if media_file is None:
-                continue  # Skip directories
-            name = media_file_info.path
-            self._upload_file(name, media_file)
+        self.existing_files = self._list_media_files() if self.parallel > 1 else None
+        if metadata and metadata.get("base"):
+            self._restore_chain(tar_file, metadata)
+        else:
+            self._restore_tar(tar_file)
 
         # Send post_media_restore signal
         post_media_restore.send(
@@ -0,0 +1,245 @@
+"""
+Timings and sizes of the stages of a backup.
+
+Metrics are sent with the ``post_backup`` signal, written into the backup's
+metadata and exported to a Prometheus textfile or StatsD if configured with
+``DBBACKUP_METRICS``.
+"""
+
+import contextlib
+import logging
+import os
+import socket
+import tempfile
+import time
+
+from dbbackup import settings, utils
+
+logger = logging.getLogger("dbbackup.command")
+
+# Stages reading temporary files from the previous stage and writing new ones
+TEMP_FILE_STAGES = ("dump", "compress", "encrypt", "chunk")
+
+
+def is_stream(fileobj):
+    """
+    Tell if a file is a stream produced while it is read, whose stage does its
+    work during the next stages.
+
+    :param fileobj: File
+    :type fileobj: ``file`` like object
+
+    :rtype: ``bool``
+    """
+    return isinstance(fileobj, utils.IterStream)
+
+
+def get_size(fileobj):
+    """
+    Get the size of a file, without moving its position.
+
+    :param fileobj: File
+    :type fileobj: ``file`` like object
+
+    :returns: Size in bytes or ``None`` for streams
+    :rtype: ``int`` or ``None``
+    """
+    if is_stream(fileobj):
+        return None
+    if getattr(fileobj, "size", None) is not None:
+        return fileobj.size
+    try:
+        position = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return size
+
+
+class BackupMetrics:
+    """
+    Gather the duration, bytes read and bytes written of each stage of a
+    backup.
+
+    Stages producing a stream only set it up: their work is done while the
+    next stages read it, and is measured by the stage consuming the stream,
+    usually ``upload``. They are marked as ``streamed`` and have no duration.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._start = time.monotonic()
+        self._end = None
+
+    @contextlib.contextmanager
+    def stage(self, name, bytes_in=None):
+        """
+        Measure the duration of a stage. The yielded ``dict`` can be given
+        the ``bytes_out`` of the stage, and ``streamed`` if its output is a
+        stream.
+
+        :param name: Name of the stage
+        :type name: ``str``
+
+        :param bytes_in: Size of the stage input
+        :type bytes_in: ``int`` or ``None``
+        """
+        stage = {"bytes_in": bytes_in, "bytes_out": None, "streamed": False}
+        start = time.monotonic()
+        try:
+            yield stage
+        finally:
+            stage["seconds"] = time.monotonic() - start
+            self.stages[name] = stage
+
+    def finish(self):
+        """Stop the measure of the whole backup."""
+        self._end = time.monotonic()
+
+    def as_dict(self):
+        """
+        :returns: Metrics serializable as JSON
+        :rtype: ``dict``
+        """
+        stages = {}
+        for name, stage in self.stages.items():
+            seconds = None if stage["streamed"] else stage["seconds"]
+            size = stage["bytes_in"] if stage["bytes_in"] is not None else stage["bytes_out"]
+            stages[name] = {
+                "seconds": round(seconds, 6) if seconds is not None else None,
+                "bytes_in": stage["bytes_in"],
+                "bytes_out": stage["bytes_out"],
+                "bytes_per_second": round(size / seconds) if size is not None and seconds else None,
+                "streamed": stage["streamed"],
+            }
+        # Temporary files aren't measured on disk, the largest input and
+        # output of a stage held at the same time estimates their peak size
+        temp_sizes = [
+            (stage["bytes_in"] or 0) + (stage["bytes_out"] or 0)
+            for name, stage in self.stages.items()
+            if name in TEMP_FILE_STAGES
+        ]
+        end = self._end if self._end is not None else time.monotonic()
+        return {
+            "seconds": round(end - self._start, 6),
+            "bytes": self.stages["upload"]["bytes_in"] if "upload" in self.stages else None,
+            "estimated_temp_bytes": max(temp_sizes, default=0),
+            "streamed": any(stage["streamed"] for stage in self.stages.values()),
+            "stages": stages,
+        }
+
+
+def _prometheus_labels(**labels):
+    escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"') for key, value in labels.items()}
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+
+def write_prometheus_textfile(path, metrics, database):
+    """
+    Write metrics in the Prometheus text format, for the textfile collector
+    of the node exporter. The file is replaced atomically.
+
+    :param path: Path of the file, ``{database}`` is replaced by the database
+                 alias
+    :type path: ``str``
+
+    :param metrics: Metrics from :meth:`BackupMetrics.as_dict`
+    :type metrics: ``dict``
+
+    :param database: Database alias
+    :type database: ``str``
+    """
+    path = path.format(database=database)
+    labels = _prometheus_labels(database=database)
+    lines = [
+        "# TYPE dbbackup_backup_duration_seconds gauge",
+        f"dbbackup_backup_duration_seconds{labels} {metrics['seconds']}",
+        "# TYPE dbbackup_backup_estimated_temp_bytes gauge",
+        f"dbbackup_backup_estimated_temp_bytes{labels} {metrics['estimated_temp_bytes']}",
+        "# TYPE dbbackup_backup_streamed gauge",
+        f"dbbackup_backup_streamed{labels} {int(metrics['streamed'])}",
+        "# TYPE dbbackup_backup_last_success_timestamp_seconds gauge",
+        f"dbbackup_backup_last_success_timestamp_seconds{labels} {time.time():.3f}",
+    ]
+    if metrics["bytes"] is not None:
+        lines += ["# TYPE dbbackup_backup_size_bytes gauge", f"dbbackup_backup_size_bytes{labels} {metrics['bytes']}"]
+    for metric, key in (
+        ("dbbackup_stage_duration_seconds", "seconds"),
+        ("dbbackup_stage_bytes_in", "bytes_in"),
+        ("dbbackup_stage_bytes_out", "bytes_out"),
+        ("dbbackup_stage_bytes_per_second", "bytes_per_second"),
+    ):
+        lines.append(f"# TYPE {metric} gauge")
+        lines.extend(
+            f"{metric}{_prometheus_labels(database=database, stage=name)} {stage[key]}"
+            for name, stage in metrics["stages"].items()
+            if stage[key] is not None
+        )
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as fd:
+        fd.write("\n".join(lines) + "\n")
+    os.replace(fd.name, path)
+
+
+def send_statsd(address, metrics, database, prefix="dbbackup"):
+    """
+    Send metrics to StatsD over UDP, durations as timers in milliseconds and
+    sizes as gauges.
+
+    :param address: StatsD server as ``host:port``
+    :type address: ``str``
+
+    :param metrics: Metrics from :meth:`BackupMetrics.as_dict`
+    :type metrics: ``dict``
+
+    :param database: Database alias
+    :type database: ``str``
+
+    :param prefix: Prefix of metric names
+    :type prefix: ``str``
+    """
+    host, _, port = address.rpartition(":")
+    prefix = f"{prefix}.{database}"
+    lines = [
+        f"{prefix}.seconds:{metrics['seconds'] * 1000:.0f}|ms",
+        f"{prefix}.estimated_temp_bytes:{metrics['estimated_temp_bytes']}|g",
+        f"{prefix}.streamed:{int(metrics['streamed'])}|g",
+    ]
+    if metrics["bytes"] is not None:
+        lines.append(f"{prefix}.bytes:{metrics['bytes']}|g")
+    for name, stage in metrics["stages"].items():
+        if stage["seconds"] is not None:
+            lines.append(f"{prefix}.{name}.seconds:{stage['seconds'] * 1000:.0f}|ms")
+        lines.extend(
+            f"{prefix}.{name}.{key}:{stage[key]}|g"
+            for key in ("bytes_in", "bytes_out", "bytes_per_second")
+            if stage[key] is not None
+        )
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for line in lines:
+            sock.sendto(line.encode(), (host or "localhost", int(port)))
+
+
+def export_metrics(metrics, database):
+    """
+    Export metrics with the exporters configured in ``DBBACKUP_METRICS``.
+    Errors are logged, they don't make the backup fail.
+
+    :param metrics: Metrics from :meth:`BackupMetrics.as_dict`
+    :type metrics: ``dict``
+
+    :param database: Database alias
+    :type database: ``str``
+    """
+    options = settings.METRICS or {}
+    if options.get("PROMETHEUS_TEXTFILE"):
+        try:
+            write_prometheus_textfile(options["PROMETHEUS_TEXTFILE"], metrics, database)
+        except Exception:
+            logger.warning("Unable to write Prometheus metrics", exc_info=True)
+    if options.get("STATSD"):
+        try:
+            send_statsd(options["STATSD"], metrics, database, prefix=options.get("STATSD_PREFIX", "dbbackup"))
+        except Exception:
+            logger.warning("Unable to send StatsD metrics", exc_info=True)
@@ -21,6 +21,9 @@ CLEANUP_KEEP = getattr(settings, "DBBACKUP_CLEANUP_KEEP", 10)
 CLEANUP_KEEP_MEDIA = getattr(settings, "DBBACKUP_CLEANUP_KEEP_MEDIA", CLEANUP_KEEP)
 CLEANUP_KEEP_FILTER = getattr(settings, "DBBACKUP_CLEANUP_KEEP_FILTER", lambda x: False)
 MEDIA_PATH = getattr(settings, "DBBACKUP_MEDIA_PATH", settings.MEDIA_ROOT)
+MEDIA_PREFETCH = getattr(settings, "DBBACKUP_MEDIA_PREFETCH", {})
+MEDIA_RESTORE_MAX_MEMORY = getattr(settings, "DBBACKUP_MEDIA_RESTORE_MAX_MEMORY", 64 * 1024 * 1024)
+MEDIA_INCREMENTAL_MAX_CHAIN = getattr(settings, "DBBACKUP_MEDIA_INCREMENTAL_MAX_CHAIN", 7)
 DATE_FORMAT = getattr(settings, "DBBACKUP_DATE_FORMAT", "%Y-%m-%d-%H%M%S")
 FILENAME_TEMPLATE = getattr(
     settings,
@@ -28,8 +31,19 @@ FILENAME_TEMPLATE = getattr(
     "{databasename}-{servername}-{datetime}.{extension}",
 )
 MEDIA_FILENAME_TEMPLATE = getattr(settings, "DBBACKUP_MEDIA_FILENAME_TEMPLATE", "{servername}-{datetime}.{extension}")
+CATALOG = getattr(settings, "DBBACKUP_CATALOG", False)
+CATALOG_FILENAME = getattr(settings, "DBBACKUP_CATALOG_FILENAME", "dbbackup-catalog.json")
+DEDUP = getattr(settings, "DBBACKUP_DEDUP", {})
+COMPRESSION = getattr(settings, "DBBACKUP_COMPRESSION", {})
+MULTIPART_UPLOAD = getattr(settings, "DBBACKUP_MULTIPART_UPLOAD", None)
+PARALLEL_DOWNLOAD = getattr(settings, "DBBACKUP_PARALLEL_DOWNLOAD", None)
+METRICS = getattr(settings, "DBBACKUP_METRICS", {})
+ENCRYPTION = getattr(settings, "DBBACKUP_ENCRYPTION", {})
 GPG_ALWAYS_TRUST = getattr(settings, "DBBACKUP_GPG_ALWAYS_TRUST", False)
 GPG_RECIPIENT = GPG_ALWAYS_TRUST = getattr(settings, "DBBACKUP_GPG_RECIPIENT", None)
+GPG_SYMMETRIC = getattr(settings, "DBBACKUP_GPG_SYMMETRIC", False)
+GPG_PASSPHRASE = getattr(settings, "DBBACKUP_GPG_PASSPHRASE", None)
+GPG_BINARY = getattr(settings, "DBBACKUP_GPG_BINARY", "gpg")
 STORAGES_DBBACKUP_ALIAS = "dbbackup"
 DJANGO_STORAGES = getattr(settings, "STORAGES", {})
 storage: dict = DJANGO_STORAGES.get(STORAGES_DBBACKUP_ALIAS, {})
@@ -4,11 +4,12 @@ Utils for handle files.
 
 import contextlib
 import logging
-from datetime import datetime, timezone
+from datetime import datetime
 
 from django.core.exceptions import ImproperlyConfigured
 
-from dbbackup import settings, utils
+from dbbackup import chunking, downloads, settings, uploads, utils
+from dbbackup.catalog import BackupCatalog
 
 
 def get_storage(path=None, options=None):
@@ -67,6 +68,7 @@ class Storage:
         self.storageCls = get_storage_class(self._storage_path)
         self.storage = self.storageCls(**options)
         self.name = self.storageCls.__name__
+        self.catalog = BackupCatalog(self) if settings.CATALOG else None
 
     def __str__(self):
         return f"dbbackup-{self.storage.__str__()}"
@@ -74,21 +76,97 @@ class Storage:
     def delete_file(self, filepath):
         self.logger.debug("Deleting file %s", filepath)
         self.storage.delete(name=filepath)
+        if self.catalog is not None:
+            self.catalog.remove(filepath)
 
     def list_directory(self, path=""):
         return [self._normalize_listed_name(name) for name in self.storage.listdir(path)[1]]
 
     def write_file(self, filehandle, filename):
+        if settings.MULTIPART_UPLOAD is not None:
+            self.upload_file(filehandle, filename)
+            return
         self.logger.debug("Writing file %s", filename)
-        self.storage.save(name=filename, content=filehandle)
+        name = self.storage.save(name=filename, content=filehandle)
+        if self.catalog is not None:
+            self.catalog.add(name)
+
+    def upload_file(self, filehandle, filename, part_size=None, threads=None, retries=None):
+        """
+        Write a file by parts with the storage's multipart API, or with its
+        ``save`` method if it has none. Options not given are taken from
+        ``settings.DBBACKUP_MULTIPART_UPLOAD``.
+
+        :param filehandle: File to write
+        :type filehandle: ``file`` like object
+
+        :param filename: Name of the file in the storage
+        :type filename: ``str``
+
+        :param part_size: Size of parts in bytes
+        :type part_size: ``int`` or ``None``
+
+        :param threads: Number of parts uploaded at the same time
+        :type threads: ``int`` or ``None``
+
+        :param retries: Number of times a failed part is sent again
+        :type retries: ``int`` or ``None``
+
+        :returns: Name of the written file
+        :rtype: ``str``
+        """
+        uploader = uploads.get_uploader(self.storage, part_size=part_size, threads=threads, retries=retries)
+        if uploader is None:
+            self.logger.debug("Writing file %s, %s has no multipart API", filename, self.name)
+            name = self.storage.save(name=filename, content=filehandle)
+        else:
+            self.logger.debug("Uploading file %s by parts of %s", filename, utils.bytes_to_str(uploader.part_size))
+            name = uploader.upload(filehandle, filename)
+        if self.catalog is not None:
+            self.catalog.add(name)
+        return name
 
     def read_file(self, filepath):
+        if settings.PARALLEL_DOWNLOAD is not None:
+            return self.download_file(filepath)
         self.logger.debug("Reading file %s", filepath)
         file_ = self.storage.open(name=filepath, mode="rb")
         if not getattr(file_, "name", None):
             file_.name = filepath
         return file_
 
+    def download_file(self, filepath, part_size=None, threads=None, retries=None):
+        """
+        Open a file fetching its byte ranges in parallel with the storage's
+        ranged requests, or with its ``open`` method if it has none. Options
+        not given are taken from ``settings.DBBACKUP_PARALLEL_DOWNLOAD``.
+
+        :param filepath: Name of the file in the storage
+        :type filepath: ``str``
+
+        :param part_size: Size of ranges in bytes
+        :type part_size: ``int`` or ``None``
+
+        :param threads: Number of ranges downloaded at the same time
+        :type threads: ``int`` or ``None``
+
+        :param retries: Number of times a failed range is requested again
+        :type retries: ``int`` or ``None``
+
+        :returns: File opened in binary mode
+        :rtype: ``file`` like object
+        """
+        downloader = downloads.get_downloader(self.storage, part_size=part_size, threads=threads, retries=retries)
+        if downloader is None:
+            self.logger.debug("Reading file %s, %s has no ranged requests", filepath, self.name)
+            file_ = self.storage.open(name=filepath, mode="rb")
+        else:
+            self.logger.debug("Downloading file %s by ranges of %s", filepath, utils.bytes_to_str(downloader.part_size))
+            file_ = downloader.open(filepath)
+        if not getattr(file_, "name", None):
+            file_.name = filepath
+        return file_
+
     def list_backups(
         self,
         encrypted=None,
@@ -125,23 +203,29 @@ class Storage:
         if content_type not in ("db", "media", None):
             msg = f"Bad content_type {content_type}, must be 'db', 'media', or None"
             raise TypeError(msg)
-        # TODO: Make better filter for include only backups
-        files = [f for f in self.list_directory() if utils.filename_to_datestring(f)]
-        # Exclude metadata files
-        files = [f for f in files if not f.endswith(".metadata")]
-        if encrypted is not None:
-            files = [f for f in files if (".gpg" in f) == encrypted]
-        if compressed is not None:
-            files = [f for f in files if (".gz" in f) == compressed]
-        if content_type == "media":
-            files = [f for f in files if ".tar" in f]
-        elif content_type == "db":
-            files = [f for f in files if ".tar" not in f]
-        if database:
-            files = [f for f in files if database in f]
-        if servername:
-            files = [f for f in files if servername in f]
-        return files
+        if self.catalog is not None:
+            files = self.catalog.query(
+                encrypted=encrypted,
+                compressed=compressed,
+                content_type=content_type,
+                database=database,
+                servername=servername,
+            )
+            return [name for name, _date in files]
+        # Names are parsed once and filtered in a single pass
+        backups = (utils.parse_backup_name(f) for f in self.list_directory())
+        return [
+            backup.name
+            for backup in backups
+            if backup.is_backup
+            and backup.matches(
+                encrypted=encrypted,
+                compressed=compressed,
+                content_type=content_type,
+                database=database,
+                servername=servername,
+            )
+        ]
 
     def get_latest_backup(
         self,
@@ -241,6 +325,8 @@ class Storage:
         database=None,
         servername=None,
         keep_number=None,
+        keep_filter=None,
+        collect_garbage=True,
     ):
         """
         Delete olders backups and hold the number defined.
@@ -264,10 +350,20 @@ class Storage:
 
         :param keep_number: Number of files to keep, other will be deleted
         :type keep_number: ``int`` or ``None``
+
+        :param keep_filter: Function telling if a file must be kept anyway,
+                            ``settings.DBBACKUP_CLEANUP_KEEP_FILTER`` is used
+                            if ``None``
+        :type keep_filter: ``callable`` or ``None``
+
+        :param collect_garbage: Delete the chunks not referenced anymore if a
+                                deduplicated backup is deleted, disable it if
+                                backups are still running on the storage
+        :type collect_garbage: ``bool``
         """
         if keep_number is None:
             keep_number = settings.CLEANUP_KEEP if content_type == "db" else settings.CLEANUP_KEEP_MEDIA
-        keep_filter = settings.CLEANUP_KEEP_FILTER
+        keep_filter = keep_filter or settings.CLEANUP_KEEP_FILTER
         files = self.list_backups(
             encrypted=encrypted,
             compressed=compressed,
@@ -277,23 +373,25 @@ class Storage:
         )
         files = sorted(files, key=self._filename_to_date_or_min, reverse=True)
         files_to_delete = [fi for i, fi in enumerate(files) if i >= keep_number]
-        for filename in files_to_delete:
-            if keep_filter(filename):
-                continue
-            self.delete_file(filename)
-
-            metadata_filename = f"{filename}.metadata"
-            if self.storage.exists(metadata_filename):
-                self.delete_file(metadata_filename)
+        manifest_deleted = False
+        # The catalog is saved once for all the deleted files
+        with self.catalog.batch() if self.catalog is not None else contextlib.nullcontext():
+            for filename in files_to_delete:
+                if keep_filter(filename):
+                    continue
+                self.delete_file(filename)
+                manifest_deleted |= chunking.is_manifest_filename(filename)
+
+                metadata_filename = f"{filename}.metadata"
+                if self.storage.exists(metadata_filename):
+                    self.delete_file(metadata_filename)
+
+        if manifest_deleted and collect_garbage:
+            chunking.ChunkStore(self).collect_garbage()
 
     @staticmethod
     def _filename_to_date_or_min(filename: str) -> datetime:
-        file_date = utils.filename_to_date(filename)
-        if file_date is None:
-            return datetime.min.replace(tzinfo=timezone.utc)
-        if file_date.tzinfo is None:
-            return file_date.replace(tzinfo=timezone.utc)
-        return file_date
+        return utils.parse_backup_name(filename).sort_date
 
     def _normalize_listed_name(self, name: str) -> str:
         location = getattr(self.storage, "location", "") or ""
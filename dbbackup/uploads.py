@@ -0,0 +1,305 @@
+"""
+Chunked uploads of backup files, using the native multipart API of remote
+storages.
+
+A file is uploaded as parts sent concurrently, and a part that fails is sent
+again without restarting the upload. Storages without such API use their
+``save`` method.
+"""
+
+import logging
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.files.base import ContentFile
+
+from dbbackup import metrics, settings, utils
+
+logger = logging.getLogger("dbbackup.storage")
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_THREADS = 4
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 1
+
+
+def call_with_retries(func, *args, retries=DEFAULT_RETRIES, description="Request"):
+    """
+    Call a function, and call it again after a growing delay while it fails.
+
+    :param retries: Number of times the function is called again
+    :type retries: ``int``
+
+    :param description: Description of the call for logs
+    :type description: ``str``
+
+    :returns: What the function returns
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except Exception:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            logger.warning("%s failed, retrying (%s/%s)", description, attempt, retries, exc_info=True)
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+
+
+class BaseUploader:
+    """
+    Base class for multipart uploads. Subclasses implement :meth:`begin`,
+    :meth:`upload_part`, :meth:`complete` and :meth:`abort` with the
+    storage's API.
+    """
+
+    #: Minimum size of parts, except the last one
+    min_part_size = 1
+    #: Maximum number of parts of an upload, ``None`` for no limit
+    max_parts = None
+    #: Parts may be sent concurrently, in any order
+    parallel = True
+    #: Failed parts may be sent again
+    retry_parts = True
+
+    def __init__(self, storage, part_size=None, threads=None, retries=None):
+        """
+        :param storage: Django storage
+        :type storage: :class:`django.core.files.storage.Storage`
+
+        :param part_size: Size of parts in bytes
+        :type part_size: ``int`` or ``None``
+
+        :param threads: Number of parts uploaded at the same time
+        :type threads: ``int`` or ``None``
+
+        :param retries: Number of times a failed part is sent again
+        :type retries: ``int`` or ``None``
+        """
+        options = settings.MULTIPART_UPLOAD or {}
+        self.storage = storage
+        part_size = part_size or options.get("PART_SIZE", DEFAULT_PART_SIZE)
+        self.part_size = max(int(part_size), self.min_part_size)
+        threads = threads or options.get("THREADS", DEFAULT_THREADS)
+        self.threads = max(int(threads), 1) if self.parallel else 1
+        self.retries = int(options.get("RETRIES", DEFAULT_RETRIES) if retries is None else retries)
+
+    def begin(self, name):
+        """
+        Override this method to start an upload and return its state.
+        """
+        msg = "begin not implemented"
+        raise NotImplementedError(msg)
+
+    def upload_part(self, upload, number, data):
+        """
+        Override this method to send a part, numbered from 1, and return what
+        :meth:`complete` needs to know about it.
+        """
+        msg = "upload_part not implemented"
+        raise NotImplementedError(msg)
+
+    def complete(self, upload, parts):
+        """
+        Override this method to assemble the uploaded parts, given in order.
+        """
+        msg = "complete not implemented"
+        raise NotImplementedError(msg)
+
+    def abort(self, upload):
+        """
+        Override this method to discard the uploaded parts.
+        """
+        msg = "abort not implemented"
+        raise NotImplementedError(msg)
+
+    def _upload_part(self, upload, number, data):
+        if not self.retry_parts:
+            return self.upload_part(upload, number, data)
+        return call_with_retries(
+            self.upload_part, upload, number, data, retries=self.retries, description=f"Upload of part {number}"
+        )
+
+    def upload(self, fileobj, name):
+        """
+        Upload a file by parts. A file smaller than a part is saved with the
+        storage's ``save`` method. Parts of a file of known size are made
+        larger if needed to stay within :attr:`max_parts`, a stream needing
+        more parts fails.
+
+        :param fileobj: File to upload
+        :type fileobj: ``file`` like object
+
+        :param name: Name of the file in the storage
+        :type name: ``str``
+
+        :returns: Name of the uploaded file
+        :rtype: ``str``
+        """
+        part_size = self.part_size
+        size = metrics.get_size(fileobj)
+        if self.max_parts and size is not None and size > part_size * self.max_parts:
+            part_size = math.ceil(size / self.max_parts)
+            logger.debug(
+                "Uploading %s by parts of %s to stay within %s parts",
+                name,
+                utils.bytes_to_str(part_size),
+                self.max_parts,
+            )
+        if hasattr(fileobj, "seek"):
+            fileobj.seek(0)
+        data = fileobj.read(part_size)
+        next_data = fileobj.read(part_size)
+        if not next_data:
+            return self.storage.save(name, ContentFile(data))
+
+        name = self.storage.get_available_name(name)
+        upload = self.begin(name)
+        parts = {}
+        pending = {}
+        number = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="dbbackup-upload") as executor:
+
+                def wait_for(count):
+                    while len(pending) > count:
+                        done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            parts[pending.pop(future)] = future.result()
+
+                try:
+                    while data:
+                        if self.max_parts and number >= self.max_parts:
+                            msg = (
+                                f"{name} needs more than {self.max_parts} parts of {utils.bytes_to_str(part_size)}, "
+                                "increase PART_SIZE of DBBACKUP_MULTIPART_UPLOAD"
+                            )
+                            raise ValueError(msg)
+                        number += 1
+                        # At most one part per thread waits to be uploaded
+                        wait_for(self.threads - 1)
+                        pending[executor.submit(self._upload_part, upload, number, data)] = number
+                        data, next_data = next_data, (fileobj.read(part_size) if next_data else b"")
+                    wait_for(0)
+                finally:
+                    for future in pending:
+                        future.cancel()
+            self.complete(upload, [parts[i] for i in range(1, number + 1)])
+        except BaseException:
+            logger.warning("Upload of %s failed, aborting it", name)
+            self.abort(upload)
+            raise
+        logger.debug("%s uploaded in %s parts", name, number)
+        return name
+
+
+class S3Uploader(BaseUploader):
+    """
+    Multipart upload for ``storages.backends.s3.S3Storage``, using the boto3
+    client.
+    """
+
+    # S3 refuses parts smaller than 5 MiB and uploads of more than 10,000 parts
+    min_part_size = 5 * 1024 * 1024
+    max_parts = 10000
+
+    def _get_key(self, name):
+        from storages.utils import clean_name
+
+        return self.storage._normalize_name(clean_name(name))
+
+    def begin(self, name):
+        key = self._get_key(name)
+        params = self.storage._get_write_parameters(key)
+        client = self.storage.connection.meta.client
+        response = client.create_multipart_upload(Bucket=self.storage.bucket_name, Key=key, **params)
+        return {"Key": key, "UploadId": response["UploadId"]}
+
+    def upload_part(self, upload, number, data):
+        client = self.storage.connection.meta.client
+        response = client.upload_part(Bucket=self.storage.bucket_name, PartNumber=number, Body=data, **upload)
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    def complete(self, upload, parts):
+        client = self.storage.connection.meta.client
+        client.complete_multipart_upload(Bucket=self.storage.bucket_name, MultipartUpload={"Parts": parts}, **upload)
+
+    def abort(self, upload):
+        client = self.storage.connection.meta.client
+        client.abort_multipart_upload(Bucket=self.storage.bucket_name, **upload)
+
+
+class GoogleCloudUploader(BaseUploader):
+    """
+    Upload for ``storages.backends.gcloud.GoogleCloudStorage`` through a GCS
+    resumable upload session. Parts are sent in order, and the client library
+    sends a failed part again from the last byte received by the server. The
+    session only lasts for the upload: a failed upload is cancelled, not
+    resumed by a later run.
+    """
+
+    # Parts must be multiple of 256 KiB
+    min_part_size = 256 * 1024
+    parallel = False
+    retry_parts = False
+
+    def __init__(self, storage, part_size=None, threads=None, retries=None):
+        super().__init__(storage, part_size, threads, retries)
+        self.part_size -= self.part_size % self.min_part_size
+
+    def begin(self, name):
+        from google.cloud.storage.retry import DEFAULT_RETRY
+        from storages.utils import clean_name
+
+        blob = self.storage.bucket.blob(self.storage._normalize_name(clean_name(name)))
+        # With file_overwrite, the default, a previous backup may already be
+        # stored under the name
+        previous = self.storage.bucket.get_blob(blob.name)
+        writer = blob.open("wb", chunk_size=self.part_size, retry=DEFAULT_RETRY, ignore_flush=True)
+        return {"blob": blob, "writer": writer, "generation": previous.generation if previous is not None else None}
+
+    def upload_part(self, upload, number, data):
+        upload["writer"].write(data)
+
+    def complete(self, upload, parts):
+        upload["writer"].close()
+
+    def abort(self, upload):
+        # Closing the writer would finalize the object with the data sent so
+        # far, the resumable session is cancelled instead. BlobWriter has no
+        # terminate() before google-cloud-storage 3.0, the session is then
+        # left to expire without being finalized.
+        terminate = getattr(upload["writer"], "terminate", None)
+        if terminate is not None:
+            terminate()
+        # A new generation under the name was finalized by the failed upload,
+        # it's deleted only if it's still the current one
+        blob = self.storage.bucket.get_blob(upload["blob"].name)
+        if blob is not None and blob.generation != upload["generation"]:
+            blob.delete(if_generation_match=blob.generation)
+
+
+# Storages are matched by class name, their modules import optional packages
+UPLOADERS = {
+    "S3Storage": S3Uploader,
+    "S3Boto3Storage": S3Uploader,
+    "GoogleCloudStorage": GoogleCloudUploader,
+}
+
+
+def get_uploader(storage, **options):
+    """
+    Get the multipart uploader of a storage.
+
+    :param storage: Django storage
+    :type storage: :class:`django.core.files.storage.Storage`
+
+    :returns: Uploader or ``None`` if the storage has no multipart API
+    :rtype: :class:`BaseUploader` or ``None``
+    """
+    for storage_cls in type(storage).__mro__:
+        if storage_cls.__name__ in UPLOADERS:
+            return UPLOADERS[storage_cls.__name__](storage, **options)
+    return None
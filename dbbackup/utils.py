@@ -4,27 +4,32 @@ Utility functions for dbbackup.
 
 from __future__ import annotations
 
+import contextlib
 import copy
-import gzip
+import io
 import json
 import logging
 import os
 import re
+import stat
 import sys
 import tempfile
+import threading
 import traceback
 from datetime import datetime
-from functools import wraps
+from datetime import timezone as dt_timezone
+from functools import cache, lru_cache, partial, wraps
 from getpass import getpass
 from importlib import import_module
 from shutil import copyfileobj
 
+from django.core.files import File
 from django.core.mail import EmailMultiAlternatives
 from django.db import connection
 from django.http import HttpRequest
 from django.utils import timezone
 
-from dbbackup import settings
+from dbbackup import compression, encryption, settings
 
 FAKE_HTTP_REQUEST = HttpRequest()
 FAKE_HTTP_REQUEST.META["SERVER_NAME"] = ""
@@ -41,15 +46,99 @@ BYTES = (
     ("B", 1.0),
 )
 
+# ioctl request cloning a file on Linux filesystems with reflinks (Btrfs, XFS)
+FICLONE = 0x40049409
+
 REG_FILENAME_CLEAN = re.compile(r"-+")
+BACKUP_NAME_CACHE_SIZE = 4096
+
+
+# Raised by encryption backends, kept here for compatibility
+EncryptionError = encryption.EncryptionError
+DecryptionError = encryption.DecryptionError
+
+
+class IterStream(io.RawIOBase):
+    """
+    Read-only file-like object fed by an iterator of ``bytes`` chunks.
 
+    It lets several processing stages (dump, compression, upload) be
+    chained without writing the whole backup to a temporary file. The
+    stream can only be read once, from start to end; seeking back to the
+    start is accepted as long as nothing has been read yet.
 
-class EncryptionError(Exception):
-    pass
+    :param iterable: Iterable producing ``bytes`` chunks
+    :type iterable: ``iterable``
 
+    :param name: Optional name of the stream
+    :type name: ``str`` or ``None``
+    """
 
-class DecryptionError(Exception):
-    pass
+    mode = "rb"
+
+    def __init__(self, iterable, name=None):
+        super().__init__()
+        self._iterator = iter(iterable)
+        self._chunk = b""
+        self._offset = 0
+        self._position = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        """Get the next chunk if the current one is consumed, tell if there is data left."""
+        while self._offset >= len(self._chunk):
+            try:
+                chunk = next(self._iterator)
+            except StopIteration:
+                return False
+            self._chunk = chunk.tobytes() if isinstance(chunk, memoryview) else chunk
+            self._offset = 0
+        return True
+
+    def readinto(self, buffer):
+        if not self._fill():
+            return 0
+        size = min(len(buffer), len(self._chunk) - self._offset)
+        buffer[:size] = memoryview(self._chunk)[self._offset : self._offset + size]
+        self._offset += size
+        self._position += size
+        return size
+
+    def readline(self, size=-1):
+        # RawIOBase reads lines byte by byte, search them in the chunks instead
+        if size is None:
+            size = -1
+        parts = []
+        while size != 0 and self._fill():
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            newline = self._chunk.find(b"\n", self._offset, end)
+            if newline >= 0:
+                end = newline + 1
+            parts.append(self._chunk[self._offset : end])
+            if size > 0:
+                size -= end - self._offset
+            self._position += end - self._offset
+            self._offset = end
+            if newline >= 0:
+                break
+        return b"".join(parts)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset == 0 and whence in (io.SEEK_SET, io.SEEK_CUR) and self._position == 0:
+            return 0
+        msg = "IterStream can only be read sequentially."
+        raise io.UnsupportedOperation(msg)
+
+    def close(self):
+        if not self.closed and hasattr(self._iterator, "close"):
+            self._iterator.close()
+        super().close()
 
 
 def bytes_to_str(byte_val, decimals=1):
@@ -148,17 +237,325 @@ def create_spooled_temporary_file(filepath=None, fileobj=None):
     """
     spooled_file = tempfile.SpooledTemporaryFile(max_size=settings.TMP_FILE_MAX_SIZE, dir=settings.TMP_DIR)
     if filepath:
-        fileobj = open(filepath, "r+b")
-    if fileobj is not None:
-        fileobj.seek(0)
-        copyfileobj(fileobj, spooled_file, settings.TMP_FILE_READ_SIZE)
+        with open(filepath, "rb") as input_file:
+            _copy_to_spooled_file(input_file, spooled_file)
+    elif fileobj is not None:
+        _copy_to_spooled_file(fileobj, spooled_file)
     return spooled_file
 
 
+def _copy_to_spooled_file(fileobj, spooled_file):
+    fileobj.seek(0)
+    # Files too large to be kept in memory are copied to disk in the kernel
+    if settings.TMP_FILE_MAX_SIZE and has_fileno(fileobj):
+        with contextlib.suppress(OSError):
+            if os.fstat(fileobj.fileno()).st_size > settings.TMP_FILE_MAX_SIZE:
+                spooled_file.rollover()
+    copy_file(fileobj, spooled_file)
+
+
+def iter_file(fileobj, chunk_size=None):
+    """
+    Iterate over the content of a file-like object by chunks.
+
+    :param fileobj: File to read
+    :type fileobj: ``file`` like object
+
+    :param chunk_size: Size of chunks, ``settings.TMP_FILE_READ_SIZE`` is used
+                       if is ``None``
+    :type chunk_size: ``int`` or ``None``
+
+    :returns: Generator of ``bytes`` chunks
+    :rtype: ``generator``
+    """
+    chunk_size = chunk_size or settings.TMP_FILE_READ_SIZE
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class ClosingIterator:
+    """
+    Iterator over chunks owning resources: they are released when the
+    chunks are read to the end, when reading them fails, or when it is
+    closed, even before being read. Subclasses check the result of what
+    produced the chunks in :meth:`_check`, and release their resources in
+    :meth:`_release`.
+
+    :param chunks: Iterable producing ``bytes`` chunks, closed with the
+                   iterator if it has a ``close()`` method
+    :type chunks: ``iterable``
+
+    :param release: Called once to release the resources
+    :type release: ``callable`` or ``None``
+    """
+
+    def __init__(self, chunks, release=None):
+        self._chunks = iter(chunks)
+        self._release_callback = release
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            try:
+                self._check()
+            finally:
+                self.close()
+            raise
+        except BaseException:
+            self.close()
+            raise
+
+    def _check(self):
+        """Override this method to raise an error once everything has been read."""
+
+    def _release(self):
+        if self._release_callback is not None:
+            self._release_callback()
+
+    def close(self):
+        """Stop reading the chunks and release the resources."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._chunks, "close"):
+                self._chunks.close()
+        finally:
+            self._release()
+
+    def __del__(self):
+        self.close()
+
+
+class ProcessOutput(ClosingIterator):
+    """
+    Iterator over the standard output of a running process, checking its
+    return code once everything has been read. It owns the process and the
+    thread feeding its input, both released when the output is read to the
+    end, or when it is closed, even before being read.
+
+    :param process: Process started with ``stdout=PIPE``
+    :type process: :class:`subprocess.Popen`
+
+    :param get_error: Called with the return code of the process if it
+                      isn't 0, returns the error to raise
+    :type get_error: ``callable``
+
+    :param feeder: Thread and errors returned by :func:`start_input_feeder`
+    :type feeder: ``tuple`` or ``None``
+
+    :param release: Called once to release other resources
+    :type release: ``callable`` or ``None``
+    """
+
+    def __init__(self, process, get_error, feeder=None, release=None):
+        super().__init__(iter(partial(process.stdout.read1, settings.TMP_FILE_READ_SIZE), b""), release)
+        self._process = process
+        self._get_error = get_error
+        self._feeder, self._feed_errors = feeder or (None, ())
+
+    def _check(self):
+        self._process.wait()
+        if self._feeder is not None:
+            self._feeder.join()
+        if self._feed_errors:
+            raise self._feed_errors[0]
+        if self._process.returncode:
+            raise self._get_error(self._process.returncode)
+
+    def _release(self):
+        try:
+            if self._process.poll() is None:
+                self._process.kill()
+                self._process.wait()
+            self._process.stdout.close()
+            if self._feeder is not None:
+                self._feeder.join()
+        finally:
+            super()._release()
+
+
+def start_input_feeder(process, chunks):
+    """
+    Start a thread writing chunks into the standard input of a running
+    process, closed once they are written. If the chunks can't be read
+    entirely, the process is killed so it never uses a truncated input.
+
+    :param process: Process started with ``stdin=PIPE``
+    :type process: :class:`subprocess.Popen`
+
+    :param chunks: Iterable producing ``bytes`` chunks
+    :type chunks: ``iterable``
+
+    :returns: The thread, and the list where it puts the error stopping it
+    :rtype: ``tuple``
+    """
+    errors = []
+
+    def feed():
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # The process stopped reading, its return code tells why
+            pass
+        except Exception as err:
+            process.kill()
+            errors.append(err)
+        finally:
+            with contextlib.suppress(OSError):
+                process.stdin.close()
+
+    thread = threading.Thread(target=feed, name="dbbackup-feeder", daemon=True)
+    thread.start()
+    return thread, errors
+
+
+# Files whose file descriptor holds the data they read and write
+RAW_FILE_TYPES = (io.FileIO, io.BufferedReader, io.BufferedWriter, io.BufferedRandom)
+
+
+def _get_raw_file(fileobj):
+    """
+    Return the regular file object read and written through ``fileobj``, or
+    ``None``. Only wrappers passing data through unchanged are looked into:
+    decoders like :class:`gzip.GzipFile` also have a ``fileno()``, which is
+    the one of the file they decode.
+    """
+    while not isinstance(fileobj, RAW_FILE_TYPES):
+        if isinstance(fileobj, tempfile.SpooledTemporaryFile):
+            if not fileobj._rolled:
+                return None
+            fileobj = fileobj._file
+        elif isinstance(fileobj, (tempfile._TemporaryFileWrapper, File)):
+            fileobj = fileobj.file
+        else:
+            return None
+    return fileobj
+
+
+def has_fileno(fileobj):
+    """
+    Tell if a file-like object is a real file whose file descriptor holds its
+    data, without forcing an in-memory spooled temporary file to be written
+    on disk.
+
+    :param fileobj: File to inspect
+    :type fileobj: ``file`` like object
+
+    :rtype: ``bool``
+    """
+    raw_file = _get_raw_file(fileobj)
+    if raw_file is None:
+        return False
+    try:
+        raw_file.fileno()
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return False
+    return True
+
+
+def _reflink(src_fd, dst_fd):
+    """Clone a whole file with a copy-on-write reflink, return if it succeeded."""
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _copy_file_in_kernel(src, dst):
+    """
+    Copy as much as possible of a regular file to another with a reflink,
+    ``copy_file_range`` or ``sendfile``, and move both positions after the
+    copied data.
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    src_stat = os.fstat(src_fd)
+    if not stat.S_ISREG(src_stat.st_mode) or not stat.S_ISREG(os.fstat(dst_fd).st_mode):
+        return
+    dst.flush()
+    offset = src.tell()
+    size = src_stat.st_size
+    if offset == 0 and dst.tell() == 0 and _reflink(src_fd, dst_fd):
+        src.seek(size)
+        dst.seek(size)
+        return
+    dst.seek(dst.tell())
+    copy_functions = []
+    if hasattr(os, "copy_file_range"):
+        copy_functions.append(lambda count: os.copy_file_range(src_fd, dst_fd, count, offset_src=offset))
+    if hasattr(os, "sendfile"):
+        copy_functions.append(lambda count: os.sendfile(dst_fd, src_fd, offset, count))
+    for copy_function in copy_functions:
+        try:
+            while offset < size:
+                copied = copy_function(size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            # Not supported between these files, the next method goes on
+            continue
+        break
+    src.seek(offset)
+    dst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+
+
+def copy_file(src, dst, chunk_size=None):
+    """
+    Copy a file-like object from its position into another. Data of local
+    files isn't passed through Python buffers: the whole file is cloned
+    with a reflink where the filesystem supports it, or else copied in the
+    kernel with ``copy_file_range`` or ``sendfile``. In-memory files are
+    copied by large chunks.
+
+    :param src: File to read
+    :type src: ``file`` like object
+
+    :param dst: File to write
+    :type dst: ``file`` like object
+
+    :param chunk_size: Size of chunks of copies in Python,
+                       ``settings.TMP_FILE_READ_SIZE`` is used if is ``None``
+    :type chunk_size: ``int`` or ``None``
+    """
+    if has_fileno(src) and has_fileno(dst):
+        _copy_file_in_kernel(src, dst)
+    # What is left, if the file grew or couldn't be copied in the kernel
+    copyfileobj(src, dst, chunk_size or settings.TMP_FILE_READ_SIZE)
+
+
+def _get_gpg_passphrase(passphrase=None):
+    return passphrase or settings.GPG_PASSPHRASE or getpass("Input Passphrase: ") or None
+
+
 def _gpg_encrypt_file(inputfile, filepath, recipients, always_trust):
     import gnupg
 
     g = gnupg.GPG()
+    if settings.GPG_SYMMETRIC:
+        return g.encrypt_file(
+            inputfile,
+            output=filepath,
+            recipients=None,
+            symmetric=True,
+            passphrase=_get_gpg_passphrase(),
+        )
     return g.encrypt_file(
         inputfile,
         output=filepath,
@@ -180,6 +577,12 @@ def encrypt_file(inputfile, filename):  # sourcery skip: extract-method
     :returns: Tuple with file and new file's name
     :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
     """
+    if not isinstance(encryption.get_backend(), encryption.GpgBackend):
+        stream, filename = encrypt_stream(inputfile, filename)
+        with stream:
+            outputfile = create_spooled_temporary_file(fileobj=stream)
+        inputfile.close()
+        return outputfile, filename
     tempdir = tempfile.mkdtemp(dir=settings.TMP_DIR)
     try:
         filename = f"{filename}.gpg"
@@ -190,7 +593,7 @@ def encrypt_file(inputfile, filename):  # sourcery skip: extract-method
         try:
             inputfile.seek(0)
             always_trust = bool(settings.GPG_ALWAYS_TRUST)
-            result = _gpg_encrypt_file(inputfile, filepath, settings.GPG_RECIPIENT, always_trust)
+            result = _gpg_encrypt_file(inputfile, filepath, encryption.get_gpg_recipients(), always_trust)
             inputfile.close()
             if not result:
                 msg = f"Encryption failed; status: {result.status}"
@@ -221,21 +624,24 @@ def unencrypt_file(inputfile, filename, passphrase=None):
     :returns: Tuple with file and new file's name
     :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
     """
-    import gnupg
+    backend = encryption.get_backend_for_filename(filename)
+    if not isinstance(backend, encryption.GpgBackend):
+        stream, new_basename = unencrypt_stream(inputfile, filename, passphrase)
+        with stream:
+            return create_spooled_temporary_file(fileobj=stream), new_basename
 
-    def get_passphrase(passphrase=passphrase):
-        return passphrase or getpass("Input Passphrase: ") or None
+    import gnupg
 
     temp_dir = tempfile.mkdtemp(dir=settings.TMP_DIR)
     try:
-        new_basename = os.path.basename(filename).replace(".gpg", "")
+        new_basename = encryption.remove_extension(os.path.basename(filename), backend)
         temp_filename = os.path.join(temp_dir, new_basename)
         try:
             inputfile.seek(0)
             g = gnupg.GPG()
             result = g.decrypt_file(
                 fileobj_or_path=inputfile,
-                passphrase=get_passphrase(),
+                passphrase=_get_gpg_passphrase(passphrase),
                 output=temp_filename,
             )
             if not result:
@@ -250,9 +656,64 @@ def unencrypt_file(inputfile, filename, passphrase=None):
     return outputfile, new_basename
 
 
+def encrypt_stream(inputfile, filename):
+    """
+    Encrypt input file on the fly with the backend of
+    ``settings.DBBACKUP_ENCRYPTION`` (GPG by default) and add its extension
+    to the file's name. Data is encrypted while the returned stream is read,
+    nothing is spooled.
+
+    :param inputfile: File to encrypt
+    :type inputfile: ``file`` like object
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :returns: Tuple with encrypted stream and new file's name
+    :rtype: :class:`IterStream`, ``str``
+    """
+    if "b" not in getattr(inputfile, "mode", "b"):
+        msg = "Input file must be opened in binary mode."
+        raise ValueError(msg)
+    backend = encryption.get_backend()
+    passphrase = _get_gpg_passphrase() if backend.uses_passphrase() else None
+    inputfile.seek(0)
+    new_filename = f"{filename}{backend.extension}"
+    return IterStream(backend.iter_encrypt(inputfile, passphrase), name=new_filename), new_filename
+
+
+def unencrypt_stream(inputfile, filename, passphrase=None):
+    """
+    Unencrypt input file on the fly and remove the extension of its
+    encryption backend from its name. The backend is guessed from the file's
+    extension. Data is unencrypted while the returned stream is read,
+    nothing is spooled.
+
+    :param inputfile: File to unencrypt
+    :type inputfile: ``file`` like object
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param passphrase: Passphrase of GPG key or of symmetric encryption, if
+                       equivalent to False, it will be asked to user. If user
+                       answer an empty pass, no passphrase will be used.
+    :type passphrase: ``str`` or ``None``
+
+    :returns: Tuple with unencrypted stream and new file's name
+    :rtype: :class:`IterStream`, ``str``
+    """
+    backend = encryption.get_backend_for_filename(filename)
+    passphrase = _get_gpg_passphrase(passphrase) if backend.uses_passphrase(decrypt=True) else None
+    inputfile.seek(0)
+    new_basename = encryption.remove_extension(os.path.basename(filename), backend)
+    return IterStream(backend.iter_decrypt(inputfile, passphrase), name=new_basename), new_basename
+
+
 def compress_file(inputfile, filename):
     """
-    Compress input file using gzip and change its name.
+    Compress input file using the codec of ``settings.DBBACKUP_COMPRESSION``
+    (gzip by default) and change its name.
 
     :param inputfile: File to compress
     :type inputfile: ``file`` like object
@@ -263,9 +724,10 @@ def compress_file(inputfile, filename):
     :returns: Tuple with compressed file and new file's name
     :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
     """
+    codec = compression.get_codec()
     outputfile = create_spooled_temporary_file()
-    new_filename = f"{filename}.gz"
-    zipfile = gzip.GzipFile(filename=filename, fileobj=outputfile, mode="wb")
+    new_filename = f"{filename}{codec.extension}"
+    zipfile = codec.open_writer(outputfile)
     try:
         inputfile.seek(0)
         copyfileobj(inputfile, zipfile, settings.TMP_FILE_READ_SIZE)
@@ -274,9 +736,43 @@ def compress_file(inputfile, filename):
     return outputfile, new_filename
 
 
+def compress_stream(inputfile, filename):
+    """
+    Compress input file on the fly using the codec of
+    ``settings.DBBACKUP_COMPRESSION`` and change its name. Data is
+    compressed while the returned stream is read, nothing is spooled.
+
+    :param inputfile: File to compress
+    :type inputfile: ``file`` like object
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :returns: Tuple with compressed stream and new file's name
+    :rtype: :class:`IterStream`, ``str``
+    """
+    codec = compression.get_codec()
+
+    def _compress():
+        compressor = codec.compressor()
+        try:
+            for chunk in iter_file(inputfile):
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            compression.close_compressor(compressor)
+
+    inputfile.seek(0)
+    new_filename = f"{filename}{codec.extension}"
+    return IterStream(_compress(), name=new_filename), new_filename
+
+
 def uncompress_file(inputfile, filename):
     """
-    Uncompress this file using gzip and change its name.
+    Uncompress this file and change its name. The codec is guessed from the
+    file's extension, gzip is used if unknown.
 
     :param inputfile: File to compress
     :type inputfile: ``file`` like object
@@ -287,16 +783,38 @@ def uncompress_file(inputfile, filename):
     :returns: Tuple with file and new file's name
     :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
     """
-    zipfile = gzip.GzipFile(fileobj=inputfile, mode="rb")
+    codec = compression.get_codec_for_filename(filename)
+    zipfile = codec.open_reader(inputfile)
     try:
         inputfile.seek(0)
         outputfile = create_spooled_temporary_file(fileobj=zipfile)
     finally:
         zipfile.close()
-    new_basename = os.path.basename(filename).replace(".gz", "")
+    new_basename = compression.remove_extension(os.path.basename(filename), codec)
     return outputfile, new_basename
 
 
+def uncompress_stream(inputfile, filename):
+    """
+    Uncompress input file on the fly and change its name. The codec is
+    guessed from the file's extension, gzip is used if unknown. Data is
+    uncompressed while the returned stream is read, nothing is spooled.
+
+    :param inputfile: File to uncompress
+    :type inputfile: ``file`` like object
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :returns: Tuple with uncompressed stream and new file's name
+    :rtype: :class:`IterStream`, ``str``
+    """
+    codec = compression.get_codec_for_filename(filename)
+    inputfile.seek(0)
+    new_basename = compression.remove_extension(os.path.basename(filename), codec)
+    return IterStream(codec.iter_uncompress(inputfile), name=new_basename), new_basename
+
+
 def timestamp(value):
     """
     Return the timestamp of a datetime.datetime object.
@@ -344,9 +862,11 @@ PATTERN_MATCHNG = (
 )
 
 
+@cache
 def datefmt_to_regex(datefmt):
     """
-    Convert a strftime format string to a regex.
+    Convert a strftime format string to a regex. Regexes are compiled once
+    per format.
 
     :param datefmt: strftime format string
     :type datefmt: ``str``
@@ -360,6 +880,11 @@ def datefmt_to_regex(datefmt):
     return re.compile(f"({new_string})")
 
 
+@lru_cache(maxsize=BACKUP_NAME_CACHE_SIZE)
+def _strptime(datestring, datefmt):
+    return datetime.strptime(datestring, datefmt)
+
+
 def filename_to_datestring(filename, datefmt=None):
     """
     Return the date part of a file name.
@@ -390,7 +915,163 @@ def filename_to_date(filename, datefmt=None):
     """
     datefmt = datefmt or settings.DATE_FORMAT
     datestring = filename_to_datestring(filename, datefmt)
-    return None if datestring is None else datetime.strptime(datestring, datefmt)
+    return None if datestring is None else _strptime(datestring, datefmt)
+
+
+@cache
+def filename_template_to_regex(template, datefmt, strict=True):
+    """
+    Convert a file name template to a regex capturing the ``databasename``,
+    ``servername``, ``datetime`` and ``extension`` fields.
+
+    :param template: File name template, like ``settings.FILENAME_TEMPLATE``
+    :type template: ``str``
+
+    :param datefmt: strftime format string
+    :type datefmt: ``str``
+
+    :param strict: Require the template's dashes, otherwise they may have been
+                   squashed with empty fields by :func:`filename_generate`
+    :type strict: ``bool``
+
+    :returns: Regex matching the whole file name
+    :rtype: ``re.Pattern``
+    """
+    fields = {
+        "databasename": r".*?",
+        "servername": r".*?",
+        "datetime": datefmt_to_regex(datefmt).pattern,
+        "extension": r".+",
+        "content_type": r"(?:db|media)",
+    }
+    regex = ""
+    for part in re.split(r"(\{\w+\})", template):
+        name = part[1:-1]
+        if part.startswith("{") and name in fields:
+            # Only the first occurrence of a field is captured
+            regex += f"(?P<{name}>{fields[name]})" if f"(?P<{name}>" not in regex else fields[name]
+        else:
+            regex += re.escape(part).replace("\\-", "-+" if strict else "-*")
+    return re.compile(f"^{regex}$")
+
+
+def get_sort_date(date):
+    """
+    Make a backup date comparable: naive dates are considered UTC and unknown
+    ones the oldest.
+
+    :param date: Date of a backup
+    :type date: :class:`datetime.datetime` or ``None``
+
+    :returns: Aware date
+    :rtype: :class:`datetime.datetime`
+    """
+    if date is None:
+        return datetime.min.replace(tzinfo=dt_timezone.utc)
+    if date.tzinfo is None:
+        return date.replace(tzinfo=dt_timezone.utc)
+    return date
+
+
+class BackupName:
+    """
+    Backup file name parsed once, holding what filtering and sorting backups
+    need. Get instances with :func:`parse_backup_name`.
+    """
+
+    __slots__ = (
+        "compressed",
+        "content_type",
+        "database",
+        "date",
+        "datestring",
+        "encrypted",
+        "extension",
+        "name",
+        "servername",
+    )
+
+    def __init__(self, name, datefmt):
+        self.name = name
+        self.datestring = filename_to_datestring(name, datefmt)
+        try:
+            self.date = None if self.datestring is None else _strptime(self.datestring, datefmt)
+        except ValueError:
+            self.date = None
+        self.content_type = "media" if ".tar" in name else "db"
+        self.encrypted = encryption.is_encrypted(name)
+        self.compressed = compression.is_compressed(name)
+        self.database = self.servername = self.extension = None
+        template = settings.MEDIA_FILENAME_TEMPLATE if self.content_type == "media" else settings.FILENAME_TEMPLATE
+        if isinstance(template, str):
+            match = filename_template_to_regex(template, datefmt).match(name) or filename_template_to_regex(
+                template, datefmt, strict=False
+            ).match(name)
+            if match:
+                fields = match.groupdict()
+                self.database = fields.get("databasename")
+                self.servername = fields.get("servername")
+                self.extension = fields.get("extension")
+
+    def __repr__(self):
+        return f"<BackupName {self.name!r}>"
+
+    @property
+    def is_backup(self):
+        """Tell if this is a backup file, not a metadata file or another file."""
+        return bool(self.datestring) and not self.name.endswith(".metadata")
+
+    @property
+    def sort_date(self):
+        """Date for sorting, see :func:`get_sort_date`."""
+        return get_sort_date(self.date)
+
+    def matches(self, encrypted=None, compressed=None, content_type=None, database=None, servername=None):
+        """
+        Tell if the backup matches the given filters, a filter equal to
+        ``None`` isn't used. ``database`` and ``servername`` are searched in
+        the whole file name, as custom templates can't always be parsed.
+
+        :rtype: ``bool``
+        """
+        return (
+            (encrypted is None or self.encrypted == encrypted)
+            and (compressed is None or self.compressed == compressed)
+            and (not content_type or self.content_type == content_type)
+            and (not database or database in self.name)
+            and (not servername or servername in self.name)
+        )
+
+
+def parse_backup_name(filename, datefmt=None):
+    """
+    Parse a backup file name, results are kept in a LRU cache.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param datefmt: strftime format string, ``settings.DATE_FORMAT`` is used
+                    if is ``None``
+    :type datefmt: ``str`` or ``None``
+
+    :returns: Parsed file name
+    :rtype: :class:`BackupName`
+    """
+    datefmt = datefmt or settings.DATE_FORMAT
+    return _parse_backup_name(
+        filename,
+        datefmt,
+        settings.FILENAME_TEMPLATE,
+        settings.MEDIA_FILENAME_TEMPLATE,
+        settings.ENCRYPTION.get("BACKEND", encryption.DEFAULT_BACKEND),
+    )
+
+
+@lru_cache(maxsize=BACKUP_NAME_CACHE_SIZE)
+def _parse_backup_name(filename, datefmt, template, media_template, encryption_backend):
+    # Templates are part of the cache key as they change the parsed fields,
+    # and the encryption backend as its extension marks encrypted files
+    return BackupName(filename, datefmt)
 
 
 def filename_generate(extension, database_name="", servername=None, content_type="db", wildcard=None):
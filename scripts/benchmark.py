@@ -0,0 +1,443 @@
+"""Benchmark suite for django-dbbackup connectors and file transforms
+
+Usage:
+    python scripts/benchmark.py [--rows 10000] [--text-size 1000] [--output results.json]
+    python scripts/benchmark.py --benchmark dump:SqliteConnector --benchmark compress_file
+    python scripts/benchmark.py --compare previous.json [--max-slowdown 0.2]
+
+A synthetic SQLite database is generated once with the ``tests.testapp``
+models, then each benchmark runs ``--repeat`` times in its own process, on a
+fresh copy of the database, so peak RSS and temporary disk usage aren't mixed
+between benchmarks. Results are written as JSON; with ``--compare``, they are
+compared to a previous run and the exit code is 1 if a benchmark got slower
+than ``--max-slowdown``.
+
+Temporary disk usage is sampled from the temporary directory of the benchmark
+process while it runs, so short peaks may be missed.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from scripts._utils import get_symbols
+
+_SYMS = get_symbols()
+SYMBOL_PASS = _SYMS["PASS"]
+SYMBOL_FAIL = _SYMS["FAIL"]
+SYMBOL_SUMMARY = _SYMS["SUMMARY"]
+SYMBOL_TEST = _SYMS["TEST"]
+
+CONNECTORS = {
+    "SqliteConnector": "dbbackup.db.sqlite.SqliteConnector",
+    "SqliteBackupConnector": "dbbackup.db.sqlite.SqliteBackupConnector",
+    "SqliteCPConnector": "dbbackup.db.sqlite.SqliteCPConnector",
+    "DjangoConnector": "dbbackup.db.django.DjangoConnector",
+}
+BENCHMARKS = [
+    *(f"dump:{name}" for name in CONNECTORS),
+    *(f"restore:{name}" for name in CONNECTORS),
+    "compress_file",
+    "uncompress_file",
+    "chunk_dump",
+    "media_tar",
+]
+
+
+def log(msg: str, *, verbose: bool) -> None:
+    if verbose:
+        print(f"[Benchmark] {msg}")
+
+
+def configure_django(db_path: str, media_root: str) -> None:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+    os.environ["DB_NAME"] = db_path
+    os.environ["MEDIA_ROOT"] = media_root
+    import django  # (import after setting env vars)
+
+    django.setup()
+
+
+def get_peak_rss() -> int | None:
+    """Return the peak resident set size of this process in bytes."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class DiskSampler(threading.Thread):
+    """Sample the size of a directory until stopped, keeping the peak."""
+
+    def __init__(self, path: str, interval: float = 0.005) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            self.peak = max(self.peak, get_dir_size(self.path))
+            self._stopped.wait(self.interval)
+
+    def stop(self) -> int:
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, get_dir_size(self.path))
+        return self.peak
+
+
+# >>> Dataset <<<
+
+
+def generate_dataset(work_dir: str, args: argparse.Namespace) -> dict:
+    """Create the database and media files shared by all benchmarks."""
+    db_path = os.path.join(work_dir, "dataset.sqlite3")
+    media_root = os.path.join(work_dir, "media")
+    os.makedirs(media_root)
+    configure_django(db_path, media_root)
+    from django.core.management import call_command
+
+    from tests.testapp.models import CharModel, ForeignKeyModel, ManyToManyModel, TextModel
+
+    call_command("migrate", "--noinput", verbosity=0)
+    rng = random.Random(args.seed)
+    letters = string.ascii_letters + string.digits + " ;'\n"
+    batch_size = 1000
+
+    def random_text(size: int) -> str:
+        return "".join(rng.choices(letters, k=size))
+
+    for start in range(0, args.rows, batch_size):
+        count = min(batch_size, args.rows - start)
+        chars = CharModel.objects.bulk_create(CharModel(field=random_text(10)) for _ in range(count))
+        TextModel.objects.bulk_create(TextModel(field=random_text(args.text_size)) for _ in range(count))
+        ForeignKeyModel.objects.bulk_create(
+            ForeignKeyModel(field=char) for char in chars for _ in range(args.relations)
+        )
+    many = ManyToManyModel.objects.bulk_create(ManyToManyModel() for _ in range(args.rows // 10))
+    char_ids = list(CharModel.objects.values_list("pk", flat=True))
+    through = ManyToManyModel.field.through
+    through.objects.bulk_create(
+        through(manytomanymodel_id=obj.pk, charmodel_id=char_id)
+        for obj in many
+        for char_id in rng.sample(char_ids, min(args.relations, len(char_ids)))
+    )
+    for i in range(args.media_files):
+        path = os.path.join(media_root, f"dir{i % 10}", f"file{i}.bin")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fd:
+            fd.write(rng.randbytes(args.media_size))
+    from django.db import connections
+
+    connections.close_all()
+    return {
+        "rows": args.rows,
+        "text_size": args.text_size,
+        "relations": args.relations,
+        "media_files": args.media_files,
+        "media_size": args.media_size,
+        "seed": args.seed,
+        "db_bytes": os.path.getsize(db_path),
+        "media_bytes": get_dir_size(media_root),
+    }
+
+
+# >>> Benchmarks (run in a child process) <<<
+
+
+def get_connector(name: str):
+    from django.utils.module_loading import import_string
+
+    return import_string(CONNECTORS[name])()
+
+
+def count_rows() -> dict:
+    from tests.testapp.models import CharModel, ForeignKeyModel, TextModel
+
+    return {model.__name__: model.objects.count() for model in (CharModel, TextModel, ForeignKeyModel)}
+
+
+def clear_data() -> None:
+    from tests.testapp.models import CharModel, ManyToManyModel, TextModel
+
+    ManyToManyModel.objects.all().delete()
+    CharModel.objects.all().delete()
+    TextModel.objects.all().delete()
+
+
+def prepare(name: str, media_root: str):
+    """
+    Prepare a benchmark and return ``(run, bytes_in, check)`` where ``run``
+    is the timed function returning the size of its output.
+    """
+    from dbbackup import utils
+    from dbbackup.metrics import get_size
+
+    kind, _, connector_name = name.partition(":")
+    if kind == "dump":
+        connector = get_connector(connector_name)
+        return (lambda: get_size(connector.create_dump())), None, None
+    if kind == "restore":
+        from django.db import connections
+
+        connector = get_connector(connector_name)
+        rows = count_rows()
+        dump = connector.create_dump()
+        if connector_name in ("SqliteConnector", "DjangoConnector"):
+            clear_data()
+        connections.close_all()
+
+        def run():
+            dump.seek(0)
+            connector.restore_dump(dump)
+            connections.close_all()
+
+        def check():
+            restored = count_rows()
+            if restored != rows:
+                msg = f"Restored {restored} instead of {rows}"
+                raise AssertionError(msg)
+
+        return run, get_size(dump), check
+    if kind == "compress_file":
+        dump = get_connector("SqliteConnector").create_dump()
+        return (lambda: get_size(utils.compress_file(dump, "dump.sqlite3")[0])), get_size(dump), None
+    if kind == "uncompress_file":
+        dump = get_connector("SqliteConnector").create_dump()
+        compressed, filename = utils.compress_file(dump, "dump.sqlite3")
+        return (lambda: get_size(utils.uncompress_file(compressed, filename)[0])), get_size(compressed), None
+    if kind == "chunk_dump":
+        from dbbackup.chunking import ChunkStore, iter_chunks
+
+        dump = get_connector("SqliteConnector").create_dump()
+        store = ChunkStore(storage=None)
+
+        def run():
+            dump.seek(0)
+            return sum(len(chunk) for chunk in iter_chunks(dump, store.min_size, store.avg_size, store.max_size))
+
+        return run, get_size(dump), None
+    if kind == "media_tar":
+        from django.core.files.storage import FileSystemStorage
+
+        from dbbackup.management.commands.mediabackup import Command
+
+        command = Command()
+        command.media_storage = FileSystemStorage(location=media_root)
+        command.compress = False
+        command.logger.setLevel("WARNING")
+        return (lambda: get_size(command._create_tar("media.tar"))), get_dir_size(media_root), None
+    msg = f"Unknown benchmark {name}"
+    raise ValueError(msg)
+
+
+def run_benchmark(name: str, db_path: str, media_root: str, result_path: str) -> None:
+    run_dir = os.path.dirname(result_path)
+    tmp_dir = os.path.join(run_dir, "tmp")
+    os.makedirs(tmp_dir)
+    # DBBACKUP_TMP_DIR defaults to the temporary directory
+    tempfile.tempdir = tmp_dir
+    configure_django(db_path, media_root)
+
+    run, bytes_in, check = prepare(name, media_root)
+    baseline_temp = get_dir_size(tmp_dir)
+    sampler = DiskSampler(tmp_dir)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        bytes_out = run()
+    finally:
+        seconds = time.perf_counter() - start
+        peak_temp = sampler.stop()
+    if check is not None:
+        check()
+    size = bytes_in if bytes_in is not None else bytes_out
+    with open(result_path, "w") as fd:
+        json.dump(
+            {
+                "seconds": seconds,
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "bytes_per_second": round(size / seconds) if size and seconds > 0 else None,
+                "peak_rss_bytes": get_peak_rss(),
+                "peak_temp_bytes": max(peak_temp - baseline_temp, 0),
+            },
+            fd,
+        )
+
+
+# >>> Harness <<<
+
+
+def run_in_process(name: str, work_dir: str, dataset_path: str, media_root: str, index: int, verbose: bool) -> dict:
+    run_dir = os.path.join(work_dir, "runs", f"{name.replace(':', '-')}-{index}")
+    os.makedirs(run_dir)
+    db_path = os.path.join(run_dir, "db.sqlite3")
+    shutil.copyfile(dataset_path, db_path)
+    result_path = os.path.join(run_dir, "result.json")
+    cmd = [sys.executable, __file__, "--run", name, "--db", db_path, "--media-root", media_root]
+    cmd += ["--result", result_path]
+    proc = subprocess.run(cmd, check=False, capture_output=not verbose, text=True)
+    try:
+        if proc.returncode != 0:
+            msg = f"{name} failed:\n{proc.stderr or ''}"
+            raise RuntimeError(msg)
+        with open(result_path) as fd:
+            return json.load(fd)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def summarize(runs: list[dict]) -> dict:
+    """Keep the median run by duration, and every duration."""
+    runs = sorted(runs, key=lambda run: run["seconds"])
+    result = dict(runs[len(runs) // 2])
+    result["runs"] = [round(run["seconds"], 6) for run in runs]
+    result["seconds"] = round(result["seconds"], 6)
+    return result
+
+
+def get_environment() -> dict:
+    import django
+
+    from dbbackup import __version__
+
+    return {
+        "dbbackup": __version__,
+        "django": django.get_version(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results: dict, previous: dict, max_slowdown: float) -> bool:
+    """Print the change of each benchmark and return whether none regressed."""
+    success = True
+    print(f"\n{SYMBOL_SUMMARY} Comparison with dbbackup {previous.get('environment', {}).get('dbbackup', '?')}")
+    for name, result in results["results"].items():
+        old = previous.get("results", {}).get(name)
+        if not old:
+            print(f"  {name}: new")
+            continue
+        if "seconds" not in result or "seconds" not in old:
+            # Failed benchmarks are reported when run, they can't be compared
+            side = "now" if "seconds" not in result else "previously"
+            print(f"  {name}: skipped, failed {side}")
+            continue
+        change = result["seconds"] / old["seconds"] - 1 if old["seconds"] else 0.0
+        regressed = change > max_slowdown
+        success &= not regressed
+        status = SYMBOL_FAIL if regressed else SYMBOL_PASS
+        print(f"  {status} {name}: {old['seconds']:.3f}s -> {result['seconds']:.3f}s ({change:+.1%})")
+    return success
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark django-dbbackup connectors and file transforms")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Enable verbose output")
+    parser.add_argument("--rows", type=int, default=10000, help="Rows of each model (default: %(default)s)")
+    parser.add_argument("--text-size", type=int, default=1000, help="Characters per text row (default: %(default)s)")
+    parser.add_argument("--relations", type=int, default=2, help="Relations per row (default: %(default)s)")
+    parser.add_argument("--media-files", type=int, default=200, help="Number of media files (default: %(default)s)")
+    parser.add_argument("--media-size", type=int, default=64 * 1024, help="Bytes per media file (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated data (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark (default: %(default)s)")
+    parser.add_argument(
+        "--benchmark", action="append", choices=BENCHMARKS, help="Benchmark to run, can be repeated (default: all)"
+    )
+    parser.add_argument("--output", "-o", help="Write results to this JSON file (default: stdout)")
+    parser.add_argument("--compare", help="Compare results with a previous JSON file")
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=0.2,
+        help="Slowdown ratio above which a benchmark fails the comparison (default: %(default)s)",
+    )
+    parser.add_argument("--work-dir", help="Directory for generated data (default: a temporary directory)")
+    # Internal options of benchmark processes
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--media-root", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_benchmark(args.run, args.db, args.media_root, args.result)
+        return 0
+
+    verbose = args.verbose
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="dbbackup-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        log(f"Generating dataset in {work_dir}", verbose=verbose)
+        dataset = generate_dataset(work_dir, args)
+        log(f"Dataset: {dataset}", verbose=verbose)
+        dataset_path = os.path.join(work_dir, "dataset.sqlite3")
+        media_root = os.path.join(work_dir, "media")
+
+        results = {"environment": get_environment(), "dataset": dataset, "results": {}}
+        success = True
+        for name in args.benchmark or BENCHMARKS:
+            print(f"{SYMBOL_TEST} {name}...", file=sys.stderr)
+            try:
+                runs = [
+                    run_in_process(name, work_dir, dataset_path, media_root, index, verbose)
+                    for index in range(args.repeat)
+                ]
+            except RuntimeError as exc:
+                print(f"  {SYMBOL_FAIL} {exc}", file=sys.stderr)
+                results["results"][name] = {"error": str(exc)}
+                success = False
+                continue
+            result = results["results"][name] = summarize(runs)
+            print(f"  {SYMBOL_PASS} {result['seconds']:.3f}s", file=sys.stderr)
+
+        output = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, "w") as fd:
+                fd.write(output + "\n")
+        else:
+            print(output)
+
+        if args.compare:
+            with open(args.compare) as fd:
+                previous = json.load(fd)
+            success &= compare(results, previous, args.max_slowdown)
+        return 0 if success else 1
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":  # pragma: no cover - executed as script
+    sys.exit(main())
@@ -2,6 +2,8 @@
 Tests for dbbackup command.
 """
 
+import gzip
+import json
 import os
 import shutil
 from unittest.mock import patch
@@ -9,10 +11,14 @@ from unittest.mock import patch
 GPG_AVAILABLE = shutil.which("gpg") is not None
 
 import pytest
+from django.core.files.base import ContentFile
+from django.core.management.base import CommandError
 from django.test import TestCase
 
+from dbbackup import utils
 from dbbackup.db.base import get_connector
 from dbbackup.management.commands.dbbackup import Command as DbbackupCommand
+from dbbackup.signals import post_backup
 from dbbackup.storage import get_storage
 from tests.utils import (
     DEV_NULL,
@@ -53,6 +59,21 @@ class DbbackupCommandSaveNewBackupTest(TestCase):
         assert HANDLED_FILES["written_files"][0][0].endswith(".gz")
         assert HANDLED_FILES["written_files"][1][0].endswith(".gz.metadata")
 
+    def test_dedup(self):
+        self.command.dedup = True
+        self.command._save_new_backup(TEST_DATABASE)
+        names = [name for name, _ in HANDLED_FILES["written_files"]]
+        assert any(name.startswith("chunks/") for name in names)
+        assert names[-2].endswith(".chunks")
+        assert names[-1].endswith(".chunks.metadata")
+
+    @patch("dbbackup.utils.connection")
+    def test_dedup_output_filename(self, mock_connection):
+        # The manifest must keep its dated name to be restored and collected
+        with pytest.raises(CommandError, match="--output-filename"):
+            self.command.handle(dedup=True, output_filename="foo.psql", verbosity=0)
+        assert not HANDLED_FILES["written_files"]
+
     def test_encrypt(self):
         if not GPG_AVAILABLE:
             self.skipTest("gpg executable not available")
@@ -63,6 +84,48 @@ class DbbackupCommandSaveNewBackupTest(TestCase):
         assert HANDLED_FILES["written_files"][0][0].endswith(".gpg")
         assert HANDLED_FILES["written_files"][1][0].endswith(".gpg.metadata")
 
+    @patch("dbbackup.management.commands._base.BaseDbBackupCommand.write_to_storage")
+    def test_stream_compress(self, mock_write_to_storage):
+        written = {}
+        mock_write_to_storage.side_effect = lambda file, path: written.update({path: file.read()})
+        self.command.stream = True
+        self.command.compress = True
+        self.command._save_new_backup(TEST_DATABASE)
+        filename = next(name for name in written if not name.endswith(".metadata"))
+        assert filename.endswith(".gz")
+        assert gzip.decompress(written[filename])
+
+    @patch("dbbackup.management.commands._base.BaseDbBackupCommand.write_to_storage")
+    def test_stream_encrypt(self, mock_write_to_storage):
+        if not GPG_AVAILABLE:
+            self.skipTest("gpg executable not available")
+        add_public_gpg()
+        written = {}
+        mock_write_to_storage.side_effect = lambda file, path: written.update({path: file})
+        self.command.stream = True
+        self.command.compress = True
+        self.command.encrypt = True
+        self.command._save_new_backup(TEST_DATABASE)
+        filename = next(name for name in written if not name.endswith(".metadata"))
+        assert filename.endswith(".gz.gpg")
+        assert isinstance(written[filename], utils.IterStream)
+
+    @patch("dbbackup.management.commands._base.BaseDbBackupCommand.write_to_storage")
+    def test_stream_failure_deletes_partial_file(self, mock_write_to_storage):
+        mock_write_to_storage.side_effect = OSError("Dump failed")
+        with pytest.raises(OSError, match="Dump failed"):
+            self.command._write_backup_to_storage(utils.IterStream([b"foo"]), "foo.psql")
+        assert HANDLED_FILES["deleted_files"] == ["foo.psql"]
+
+    @patch("dbbackup.management.commands._base.BaseDbBackupCommand.write_to_storage")
+    def test_stream_failure_keeps_existing_file(self, mock_write_to_storage):
+        # A previous backup under the same name, e.g. with --output-filename
+        self.command.storage.storage.save("foo.psql", ContentFile(b"foo"))
+        mock_write_to_storage.side_effect = OSError("Dump failed")
+        with pytest.raises(OSError, match="Dump failed"):
+            self.command._write_backup_to_storage(utils.IterStream([b"bar"]), "foo.psql")
+        assert not HANDLED_FILES["deleted_files"]
+
     def test_path(self):
         local_tmp = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "tmp")
         os.makedirs(local_tmp, exist_ok=True)
@@ -96,6 +159,47 @@ class DbbackupCommandSaveNewBackupTest(TestCase):
         # Check if content is bytes
         assert isinstance(content, bytes), f"Metadata content should be bytes, but got {type(content)}"
 
+    def test_metrics(self):
+        self.command.compress = True
+        received = []
+        post_backup.connect(lambda **kwargs: received.append(kwargs["metrics"]), weak=False, dispatch_uid="test")
+        self.addCleanup(post_backup.disconnect, dispatch_uid="test")
+        with patch("dbbackup.metrics.export_metrics") as mock_export:
+            self.command._save_new_backup(TEST_DATABASE)
+        backup_metrics = received[0]
+        mock_export.assert_called_once_with(backup_metrics, "default")
+        assert list(backup_metrics["stages"]) == ["dump", "compress", "upload", "metadata"]
+        stages = backup_metrics["stages"]
+        assert stages["compress"]["bytes_in"] == stages["dump"]["bytes_out"]
+        assert stages["upload"]["bytes_in"] == stages["compress"]["bytes_out"] == backup_metrics["bytes"]
+        assert backup_metrics["estimated_temp_bytes"] == stages["dump"]["bytes_out"] + stages["compress"]["bytes_out"]
+        metadata_file = HANDLED_FILES["written_files"][1][1]
+        metadata_file.seek(0)
+        metadata = json.loads(metadata_file.read())
+        assert list(metadata["metrics"]["stages"]) == ["dump", "compress", "upload"]
+
+    @patch("dbbackup.management.commands._base.BaseDbBackupCommand.write_to_storage")
+    def test_stream_metrics(self, mock_write_to_storage):
+        written = {}
+        mock_write_to_storage.side_effect = lambda file, path: written.update({path: file.read()})
+        self.command.stream = True
+        self.command.compress = True
+        received = []
+        post_backup.connect(lambda **kwargs: received.append(kwargs["metrics"]), weak=False, dispatch_uid="test")
+        self.addCleanup(post_backup.disconnect, dispatch_uid="test")
+        self.command._save_new_backup(TEST_DATABASE)
+        backup_metrics = received[0]
+        stages = backup_metrics["stages"]
+        filename = next(name for name in written if not name.endswith(".metadata"))
+        assert backup_metrics["streamed"]
+        # Compression is done during the upload, which is the only one timed
+        assert stages["compress"]["streamed"]
+        assert stages["compress"]["seconds"] is None
+        assert stages["compress"]["bytes_out"] is None
+        assert not stages["upload"]["streamed"]
+        assert stages["upload"]["seconds"] is not None
+        assert stages["upload"]["bytes_in"] == backup_metrics["bytes"] == len(written[filename])
+
     @patch("dbbackup.management.commands._base.BaseDbBackupCommand.write_to_storage")
     def test_path_s3_uri(self, mock_write_to_storage):
         """Test that S3 URIs in output path are handled by write_to_storage instead of write_local_file."""
@@ -189,6 +293,10 @@ class DbbackupCommandSaveNewBackupTest(TestCase):
             self.command.database = "db1,,db2"
             assert self.command._get_database_keys() == ["db1", "db2"]
 
+        with self.subTest("repeated databases are backed up once"):
+            self.command.database = "db1,db2,db1"
+            assert self.command._get_database_keys() == ["db1", "db2"]
+
         with self.subTest("just comma returns empty list"):
             self.command.database = ","
             assert self.command._get_database_keys() == []
@@ -198,6 +306,54 @@ class DbbackupCommandSaveNewBackupTest(TestCase):
             assert self.command._get_database_keys() == []
 
 
+@patch("sys.stdout", DEV_NULL)
+@patch("dbbackup.management.commands.dbbackup.get_connector", side_effect=lambda key: get_connector("default"))
+class DbbackupCommandParallelTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        self.command = DbbackupCommand()
+        self.command.stdout = DEV_NULL
+
+    def test_func(self, mock_get_connector):
+        self.command.handle(database="db1,db2", parallel=2, verbosity=0)
+        assert len(HANDLED_FILES["written_files"]) == 4
+
+    @patch("dbbackup.management.commands.dbbackup.Command._save_new_backup")
+    def test_own_connectors(self, mock_save_new_backup, mock_get_connector):
+        self.command.handle(database="db1,db2,db3", parallel=3, verbosity=0)
+        connectors = {id(call.kwargs["connector"]) for call in mock_save_new_backup.call_args_list}
+        assert len(connectors) == 3
+
+    @patch("dbbackup.management.commands.dbbackup.Command._backup_database")
+    def test_errors_aggregated(self, mock_backup_database, mock_get_connector):
+        def backup_database(database_key, connector, collect_garbage=True):
+            if database_key == "db2":
+                raise ValueError("foo")
+
+        mock_backup_database.side_effect = backup_database
+        with pytest.raises(CommandError, match="1 of 3 database backups failed:\ndb2: foo$"):
+            self.command.handle(database="db1,db2,db3", parallel=2, verbosity=0)
+        assert sorted(call.args[0] for call in mock_backup_database.call_args_list) == ["db1", "db2", "db3"]
+
+    @patch("dbbackup.storage.Storage.clean_old_backups")
+    @patch("dbbackup.chunking.ChunkStore.collect_garbage")
+    def test_dedup_clean(self, mock_collect_garbage, mock_clean_old_backups, mock_get_connector):
+        def collect_garbage():
+            # All backups are written before unreferenced chunks are deleted
+            assert len([name for name, _file in HANDLED_FILES["written_files"] if name.endswith(".chunks")]) == 2
+
+        mock_collect_garbage.side_effect = collect_garbage
+        self.command.handle(database="db1,db2", parallel=2, dedup=True, clean=True, verbosity=0)
+        assert mock_clean_old_backups.call_count == 2
+        assert all(not call.kwargs["collect_garbage"] for call in mock_clean_old_backups.call_args_list)
+        mock_collect_garbage.assert_called_once_with()
+
+    @patch("dbbackup.management.commands.dbbackup.Command._backup_database")
+    def test_repeated_database(self, mock_backup_database, mock_get_connector):
+        self.command.handle(database="db1,db1", parallel=2, verbosity=0)
+        assert mock_backup_database.call_count == 1
+
+
 @patch("dbbackup.settings.GPG_RECIPIENT", "test@test")
 @patch("sys.stdout", DEV_NULL)
 @patch("dbbackup.db.sqlite.SqliteConnector.create_dump")
@@ -3,6 +3,7 @@ Tests for dbrestore command.
 """
 
 import io
+import json
 import shutil
 from io import BytesIO
 from shutil import copyfileobj
@@ -16,6 +17,7 @@ from django.core.management.base import CommandError
 from django.test import TestCase, override_settings
 
 from dbbackup import utils
+from dbbackup.chunking import ChunkStore
 from dbbackup.db.base import get_connector
 from dbbackup.db.mongodb import MongoDumpConnector
 from dbbackup.db.postgresql import PgDumpConnector
@@ -112,6 +114,40 @@ class DbrestoreCommandRestoreBackupTest(TestCase):
         self.command.uncompress = True
         self.command._restore_backup()
 
+    def test_uncompress_stream(self, *args):
+        self.command.path = None
+        self.command.stream = True
+        compressed_file, self.command.filename = utils.compress_file(get_dump(), get_dump_name())
+        HANDLED_FILES["written_files"].append((self.command.filename, File(compressed_file)))
+        self.command.uncompress = True
+        with patch.object(self.command.connector.__class__, "restore_dump") as mock_restore_dump:
+            self.command._restore_backup()
+        (dump,), _kwargs = mock_restore_dump.call_args
+        assert isinstance(dump, utils.IterStream)
+        assert dump.read() == get_dump().read()
+
+    def test_chunks(self, *args):
+        self.command.path = None
+        manifest = ChunkStore(self.command.storage).write(get_dump(), get_dump_name())
+        self.command.filename = f"{get_dump_name()}.chunks"
+        HANDLED_FILES["written_files"].append((self.command.filename, File(BytesIO(json.dumps(manifest).encode()))))
+        with patch.object(self.command.connector.__class__, "restore_dump") as mock_restore_dump:
+            self.command._restore_backup()
+        (dump,), _kwargs = mock_restore_dump.call_args
+        dump.seek(0)
+        assert dump.read() == get_dump().read()
+
+    def test_chunks_without_extension(self, *args):
+        self.command.path = None
+        manifest = ChunkStore(self.command.storage).write(get_dump(), get_dump_name())
+        self.command.filename = "foo.psql"
+        HANDLED_FILES["written_files"].append((self.command.filename, File(BytesIO(json.dumps(manifest).encode()))))
+        with patch.object(self.command.connector.__class__, "restore_dump") as mock_restore_dump:
+            self.command._restore_backup()
+        (dump,), _kwargs = mock_restore_dump.call_args
+        dump.seek(0)
+        assert dump.read() == get_dump().read()
+
     @patch("dbbackup.utils.getpass", return_value=None)
     def test_decrypt(self, *args):
         if not GPG_AVAILABLE:
@@ -123,6 +159,24 @@ class DbrestoreCommandRestoreBackupTest(TestCase):
         HANDLED_FILES["written_files"].append((self.command.filename, File(encrypted_file)))
         self.command._restore_backup()
 
+    @patch("dbbackup.utils.getpass", return_value=None)
+    def test_decrypt_stream(self, *args):
+        if not GPG_AVAILABLE:
+            self.skipTest("gpg executable not available")
+        add_private_gpg()
+        self.command.path = None
+        self.command.stream = True
+        self.command.decrypt = True
+        self.command.uncompress = True
+        compressed_file, filename = utils.compress_file(get_dump(), get_dump_name())
+        encrypted_file, self.command.filename = utils.encrypt_file(compressed_file, filename)
+        HANDLED_FILES["written_files"].append((self.command.filename, File(encrypted_file)))
+        with patch.object(self.command.connector.__class__, "restore_dump") as mock_restore_dump:
+            self.command._restore_backup()
+        (dump,), _kwargs = mock_restore_dump.call_args
+        assert isinstance(dump, utils.IterStream)
+        assert dump.read() == get_dump().read()
+
     def test_path(self, *args):
         temp_dump = get_dump()
         dump_path = mktemp()
@@ -108,3 +108,12 @@ class ListbackupsCommandArgComputingTest(TestCase):
         stdout.readline()
         for line in stdout.readlines():
             assert ".tar" in line
+
+    @patch("dbbackup.settings.CATALOG", True)
+    def test_reconcile(self):
+        stdout = StringIO()
+        with patch("sys.stdout", stdout), patch("dbbackup.catalog.BackupCatalog.reconcile") as mock_reconcile:
+            mock_reconcile.return_value = ({"foo.db"}, set())
+            execute_from_command_line(["", "listbackups", "--reconcile"])
+        assert mock_reconcile.called
+        assert "1 added, 0 removed" in stdout.getvalue()
@@ -5,11 +5,14 @@ Tests for mediabackup command.
 import contextlib
 import os
 import shutil
+import tarfile
 import tempfile
+import threading
 from unittest import mock
 
 GPG_AVAILABLE = shutil.which("gpg") is not None
 
+from django.core.files.storage import FileSystemStorage
 from django.test import TestCase
 
 from dbbackup.management.commands.mediabackup import Command as DbbackupCommand
@@ -95,3 +98,85 @@ class MediabackupBackupMediafilesTest(TestCase):
 
             # Verify no files were written to local storage
             assert len(HANDLED_FILES["written_files"]) == 0
+
+
+class MediabackupPrefetchTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        self.media_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        self.contents = {}
+        for i in range(20):
+            name = os.path.join(f"dir{i % 3}", f"file{i}.txt")
+            os.makedirs(os.path.join(self.media_dir, os.path.dirname(name)), exist_ok=True)
+            self.contents[name] = os.urandom(100 * i)
+            with open(os.path.join(self.media_dir, name), "wb") as fd:
+                fd.write(self.contents[name])
+        self.command = DbbackupCommand()
+        self.command.servername = "foo-server"
+        self.command.storage = get_storage()
+        self.command.stdout = DEV_NULL
+        self.command.compress = False
+        self.command.encrypt = False
+        self.command.path = None
+        self.command.media_storage = FileSystemStorage(location=self.media_dir)
+        self.command.filename = None
+
+    def _get_archived_files(self):
+        tarball = HANDLED_FILES["written_files"][-1][1]
+        tarball.seek(0)
+        with tarfile.open(fileobj=tarball, mode="r") as tar:
+            return [(member.name, tar.extractfile(member).read()) for member in tar.getmembers()]
+
+    def test_same_archive(self):
+        self.command.backup_mediafiles()
+        expected = self._get_archived_files()
+        assert dict(expected) == self.contents
+        with mock.patch("dbbackup.settings.MEDIA_PREFETCH", {"WORKERS": 4, "DEPTH": 3}):
+            self.command.backup_mediafiles()
+        assert self._get_archived_files() == expected
+
+    def test_memory_budget(self):
+        # Files bigger than their share of the budget are streamed from storage
+        fetched = {}
+        fetch_media_file = self.command._fetch_media_file
+
+        def fetch(*args):
+            media = fetch_media_file(*args)
+            fetched[media.name] = media.content
+            return media
+
+        options = {"WORKERS": 4, "DEPTH": 4, "MAX_MEMORY": 4000}
+        with (
+            mock.patch("dbbackup.settings.MEDIA_PREFETCH", options),
+            mock.patch.object(self.command, "_fetch_media_file", side_effect=fetch),
+        ):
+            self.command.backup_mediafiles()
+        assert dict(self._get_archived_files()) == self.contents
+        for name, content in self.contents.items():
+            assert fetched[name] == (content if len(content) <= 1000 else None)
+
+    def test_prefetch_opens_in_workers(self):
+        # All files are sized and opened by the workers, and opened once
+        calls = []
+        media_storage = self.command.media_storage
+
+        def record(method):
+            def wrapper(name, *args, **kwargs):
+                calls.append((method.__name__, name, threading.current_thread().name))
+                return method(name, *args, **kwargs)
+
+            return wrapper
+
+        options = {"WORKERS": 4, "DEPTH": 4, "MAX_MEMORY": 4000}
+        with (
+            mock.patch("dbbackup.settings.MEDIA_PREFETCH", options),
+            mock.patch.object(media_storage, "open", record(media_storage.open)),
+            mock.patch.object(media_storage, "size", record(media_storage.size)),
+        ):
+            self.command.backup_mediafiles()
+        assert dict(self._get_archived_files()) == self.contents
+        for method in ("open", "size"):
+            names = sorted(name for called, name, _ in calls if called == method)
+            assert names == sorted(self.contents)
+        assert all(thread.startswith("dbbackup-media") for _, _, thread in calls)
@@ -3,10 +3,14 @@ Tests for mediarestore command.
 """
 
 import gzip
+import os
+import shutil
 import tarfile
+import tempfile
 from io import BytesIO
 from unittest.mock import Mock, patch
 
+from django.core.files.storage import FileSystemStorage
 from django.test import TestCase
 
 from dbbackup.management.commands.mediarestore import Command
@@ -145,3 +149,63 @@ class MediarestoreCommandTest(TestCase):
 
             # Verify that the file was uploaded
             mock_media_storage.save.assert_called_once()
+
+
+class MediarestoreParallelTest(TestCase):
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        self.command = Command()
+        self.command.media_storage = FileSystemStorage(location=self.media_dir)
+        self.command.logger = Mock()
+        self.command.replace = False
+        self.command.parallel = 4
+        self.contents = {f"dir{i % 3}/file{i}.txt": os.urandom(100 * i) for i in range(30)}
+
+    def _create_tar(self):
+        tar_buffer = BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode="w") as tar:
+            for name, content in self.contents.items():
+                info = tarfile.TarInfo(name=name)
+                info.size = len(content)
+                tar.addfile(info, BytesIO(content))
+        tar_buffer.seek(0)
+        return tarfile.open(fileobj=tar_buffer, mode="r:")
+
+    def _read_file(self, name):
+        with self.command.media_storage.open(name) as fd:
+            return fd.read()
+
+    @patch("dbbackup.settings.MEDIA_RESTORE_MAX_MEMORY", 2000)
+    def test_restore(self):
+        self.command.media_storage.save("dir1/file1.txt", BytesIO(b"existing"))
+        self.command.existing_files = self.command._list_media_files()
+        assert self.command.existing_files == {"dir1/file1.txt"}
+        media_storage = self.command.media_storage
+        with patch.object(media_storage, "exists", wraps=media_storage.exists) as mock_exists:
+            self.command._restore_tar(self._create_tar())
+        # Only called by FileSystemStorage.save for the uploaded files
+        assert mock_exists.call_count == len(self.contents) - 1
+        assert self._read_file("dir1/file1.txt") == b"existing"
+        for name, content in self.contents.items():
+            if name != "dir1/file1.txt":
+                assert self._read_file(name) == content
+
+    def test_restore_replace(self):
+        self.command.replace = True
+        self.command.media_storage.save("dir1/file1.txt", BytesIO(b"existing"))
+        self.command.existing_files = self.command._list_media_files()
+        paths = {"dir1/file1.txt", "dir2/file2.txt"}
+        self.command._restore_tar(self._create_tar(), paths)
+        assert paths == set()
+        assert self._read_file("dir1/file1.txt") == self.contents["dir1/file1.txt"]
+        assert self._read_file("dir2/file2.txt") == self.contents["dir2/file2.txt"]
+        assert not self.command.media_storage.exists("dir0/file0.txt")
+
+    def test_upload_error(self):
+        self.command.existing_files = set()
+        with (
+            patch.object(self.command.media_storage, "save", side_effect=OSError("Upload failed")),
+            self.assertRaises(OSError),
+        ):
+            self.command._restore_tar(self._create_tar())
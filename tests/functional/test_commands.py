@@ -1,12 +1,15 @@
+import json
 import os
 import shutil
+import tarfile
 import tempfile
 import unittest
 from unittest.mock import patch
 
 import pytest
 from django.conf import settings
-from django.core.management import execute_from_command_line
+from django.core.management import call_command, execute_from_command_line
+from django.core.management.base import CommandError
 from django.db import connection
 from django.test import TransactionTestCase as TestCase
 
@@ -306,3 +309,106 @@ class MediaRestoreCommandTest(TestCase):
         # Verify content is correct
         with open(test_file) as f:
             assert f.read() == "test image content"
+
+
+@patch("dbbackup.management.commands._base.input", return_value="y")
+class IncrementalMediaBackupTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        self._empty_media()
+
+    def tearDown(self):
+        self._empty_media()
+
+    def _empty_media(self):
+        if os.path.exists(settings.MEDIA_ROOT):
+            shutil.rmtree(settings.MEDIA_ROOT)
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+
+    def _write_file(self, name, content):
+        with open(os.path.join(settings.MEDIA_ROOT, name), "wb") as fd:
+            fd.write(content)
+
+    def _read_file(self, name):
+        with open(os.path.join(settings.MEDIA_ROOT, name), "rb") as fd:
+            return fd.read()
+
+    def _get_written_file(self, name):
+        return next(f for n, f in HANDLED_FILES["written_files"] if n == name)
+
+    def test_restore_chain(self, *args):
+        self._write_file("deleted", b"foo")
+        self._write_file("changed", b"foo")
+        self._write_file("unchanged", b"foo")
+        execute_from_command_line(["", "mediabackup", "--incremental", "-o", "foo-2015-02-06-042810.tar"])
+        os.remove(os.path.join(settings.MEDIA_ROOT, "deleted"))
+        self._write_file("changed", b"foobar")
+        self._write_file("added", b"bar")
+        execute_from_command_line(["", "mediabackup", "--incremental", "-o", "foo-2015-02-07-042810.tar"])
+
+        metadata = json.load(self._get_written_file("foo-2015-02-07-042810.tar.metadata"))
+        assert metadata["base"] == "foo-2015-02-06-042810.tar"
+        assert metadata["deleted"] == ["deleted"]
+        assert sorted(metadata["manifest"]) == ["added", "changed", "unchanged"]
+        increment = self._get_written_file("foo-2015-02-07-042810.tar")
+        increment.seek(0)
+        with tarfile.open(fileobj=increment, mode="r:") as tar_file:
+            assert sorted(tar_file.getnames()) == ["added", "changed"]
+
+        self._empty_media()
+        self._write_file("deleted", b"foo")
+        execute_from_command_line(["", "mediarestore", "--replace"])
+        assert self._read_file("changed") == b"foobar"
+        assert self._read_file("unchanged") == b"foo"
+        assert self._read_file("added") == b"bar"
+        assert not os.path.exists(os.path.join(settings.MEDIA_ROOT, "deleted"))
+
+    @patch("dbbackup.settings.MEDIA_INCREMENTAL_MAX_CHAIN", 2)
+    @patch("dbbackup.settings.CLEANUP_KEEP_MEDIA", 2)
+    def test_clean_old_chains(self, *args):
+        for day in range(1, 6):
+            self._write_file(f"file{day}", b"foo")
+            execute_from_command_line([
+                "",
+                "mediabackup",
+                "--incremental",
+                "--clean",
+                "-o",
+                f"foo-2015-02-0{day}-042810.tar",
+            ])
+        bases = []
+        for day in range(1, 6):
+            metadata_file = self._get_written_file(f"foo-2015-02-0{day}-042810.tar.metadata")
+            metadata_file.seek(0)
+            bases.append(json.load(metadata_file)["base"])
+        # A full backup starts a new chain every 2 backups
+        assert bases == [None, "foo-2015-02-01-042810.tar", None, "foo-2015-02-03-042810.tar", None]
+        # The base of the kept increment is kept, the first chain is deleted
+        deleted = set(HANDLED_FILES["deleted_files"])
+        assert {"foo-2015-02-01-042810.tar", "foo-2015-02-02-042810.tar"} <= deleted
+        assert "foo-2015-02-03-042810.tar" not in deleted
+
+    def test_broken_chain(self, *args):
+        self._write_file("unchanged", b"foo")
+        execute_from_command_line(["", "mediabackup", "--incremental", "-o", "foo-2015-02-06-042810.tar"])
+        self._write_file("added", b"bar")
+        execute_from_command_line(["", "mediabackup", "--incremental", "-o", "foo-2015-02-07-042810.tar"])
+        HANDLED_FILES["written_files"] = [
+            f for f in HANDLED_FILES["written_files"] if f[0] != "foo-2015-02-06-042810.tar.metadata"
+        ]
+        with pytest.raises(CommandError, match="incremental chain is broken"):
+            call_command("mediarestore", interactive=False)
+
+    @unittest.skipIf(not GPG_AVAILABLE, "gpg executable not available")
+    def test_not_based_on_other_encryption(self, *args):
+        add_public_gpg()
+        self.addCleanup(clean_gpg_keys)
+        self._write_file("unchanged", b"foo")
+        execute_from_command_line(["", "mediabackup", "--incremental", "--encrypt", "-o", "foo-2015-02-06-042810.tar"])
+        self._write_file("added", b"bar")
+        execute_from_command_line(["", "mediabackup", "--incremental", "-o", "foo-2015-02-07-042810.tar"])
+
+        metadata = json.load(self._get_written_file("foo-2015-02-07-042810.tar.metadata"))
+        # An unencrypted backup isn't an increment of an encrypted one
+        assert metadata["base"] is None
+        assert sorted(metadata["manifest"]) == ["added", "unchanged"]
@@ -33,6 +33,18 @@ class ChecksTest(TestCase):
         errors = checks.check_settings(DbbackupConfig)
         assert expected_errors == errors
 
+    @patch("dbbackup.checks.settings.COMPRESSION", {"CODEC": "rar"})
+    def test_compression_codec_invalid(self):
+        expected_errors = [checks.W011]
+        errors = checks.check_settings(DbbackupConfig)
+        assert expected_errors == errors
+
+    @patch("dbbackup.checks.settings.ENCRYPTION", {"BACKEND": "rot13"})
+    def test_encryption_backend_invalid(self):
+        expected_errors = [checks.W012]
+        errors = checks.check_settings(DbbackupConfig)
+        assert expected_errors == errors
+
     @patch("dbbackup.checks.settings.FILENAME_TEMPLATE", foobar_func)
     def test_filename_template_is_callable(self):
         assert not checks.check_settings(DbbackupConfig)
@@ -0,0 +1,137 @@
+import os
+import random
+import shutil
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from django.core.files.base import ContentFile
+from django.test import TestCase
+
+from dbbackup import chunking, compression, settings
+from dbbackup.storage import get_storage
+
+MIN_SIZE, AVG_SIZE, MAX_SIZE = 1024, 4096, 16384
+
+
+def make_dump(seed=0, lines=5000):
+    rand = random.Random(seed)
+    return b"".join(f"INSERT INTO foo VALUES ({i}, '{rand.random()}');\n".encode() for i in range(lines))
+
+
+class IterChunksTest(TestCase):
+    def test_func(self):
+        dump = make_dump()
+        chunks = list(chunking.iter_chunks(BytesIO(dump), MIN_SIZE, AVG_SIZE, MAX_SIZE))
+        assert b"".join(chunks) == dump
+        assert all(MIN_SIZE <= len(chunk) <= MAX_SIZE for chunk in chunks[:-1])
+        # Boundaries are found in the content, not only at the maximum size
+        assert sum(len(chunk) < MAX_SIZE for chunk in chunks[:-1]) > len(chunks) // 2
+
+    def test_no_boundary(self):
+        data = b"\x00" * 40000
+        chunks = list(chunking.iter_chunks(BytesIO(data), MIN_SIZE, AVG_SIZE, MAX_SIZE))
+        assert [len(chunk) for chunk in chunks] == [MAX_SIZE, MAX_SIZE, 40000 - 2 * MAX_SIZE]
+
+    def test_empty(self):
+        assert list(chunking.iter_chunks(BytesIO(b""), MIN_SIZE, AVG_SIZE, MAX_SIZE)) == []
+
+    def test_average_size(self):
+        data = random.Random(0).randbytes(200 * AVG_SIZE)
+        chunks = list(chunking.iter_chunks(BytesIO(data), MIN_SIZE, AVG_SIZE, MAX_SIZE))
+        assert AVG_SIZE * 0.75 <= len(data) / len(chunks) <= AVG_SIZE * 1.5
+
+    def _assert_resync(self, data, modified):
+        chunks = set(chunking.iter_chunks(BytesIO(data), MIN_SIZE, AVG_SIZE, MAX_SIZE))
+        modified_chunks = list(chunking.iter_chunks(BytesIO(modified), MIN_SIZE, AVG_SIZE, MAX_SIZE))
+        changed = [chunk for chunk in modified_chunks if chunk not in chunks]
+        assert 1 <= len(changed) <= 2
+
+    def test_insertion_resync(self):
+        dump = make_dump()
+        position = dump.index(b"\n", len(dump) // 3) + 1
+        self._assert_resync(dump, dump[:position] + b"INSERT INTO foo VALUES (-1, 'new');\n" + dump[position:])
+
+    def test_binary_insertion_resync(self):
+        rand = random.Random(1)
+        # Binary data without any line feed
+        data = rand.randbytes(50 * AVG_SIZE).replace(b"\n", b"\x00")
+        position = len(data) // 3
+        self._assert_resync(data, data[:position] + rand.randbytes(7) + data[position:])
+        self._assert_resync(data, data[:position] + data[position + 5 :])
+
+
+class ChunkStoreTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        with patch("dbbackup.settings.STORAGE_OPTIONS", {}):
+            self.storage = get_storage("django.core.files.storage.FileSystemStorage", {"location": self.location})
+        self.chunk_store = chunking.ChunkStore(
+            self.storage, {"MIN_SIZE": MIN_SIZE, "AVG_SIZE": AVG_SIZE, "MAX_SIZE": MAX_SIZE}
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def _count_chunks(self):
+        return sum(len(files) for _root, _dirs, files in os.walk(os.path.join(self.location, "chunks")))
+
+    def test_write_read(self):
+        dump = make_dump()
+        manifest = self.chunk_store.write(BytesIO(dump), "foo.psql")
+        assert manifest["size"] == len(dump)
+        assert b"".join(self.chunk_store.iter_read(manifest)) == dump
+
+    def test_dedup(self):
+        self.chunk_store.write(BytesIO(make_dump()), "foo.psql")
+        stored = self._count_chunks()
+        manifest = self.chunk_store.write(BytesIO(make_dump() + b"-- end\n"), "foo.psql")
+        assert self._count_chunks() <= stored + 1
+        assert b"".join(self.chunk_store.iter_read(manifest)).endswith(b"-- end\n")
+
+    def test_compressed(self):
+        dump = make_dump()
+        manifest = self.chunk_store.write(BytesIO(dump), "foo.psql", codec=compression.get_codec("gzip"))
+        assert manifest["codec"] == "gzip"
+        assert all(path.endswith(".gz") for path in self.chunk_store.get_chunk_paths(manifest))
+        assert b"".join(self.chunk_store.iter_read(manifest)) == dump
+
+    def test_corrupted(self):
+        manifest = self.chunk_store.write(BytesIO(make_dump()), "foo.psql")
+        path = min(self.chunk_store.get_chunk_paths(manifest))
+        with open(os.path.join(self.location, path), "wb") as fd:
+            fd.write(b"foo")
+        with pytest.raises(ValueError, match="corrupted"):
+            b"".join(self.chunk_store.iter_read(manifest))
+
+    @patch("dbbackup.settings.DEDUP", {"MIN_SIZE": MIN_SIZE, "AVG_SIZE": AVG_SIZE, "MAX_SIZE": MAX_SIZE})
+    def test_clean_collects_garbage(self):
+        manifests = {}
+        for day, seed in ((6, 0), (7, 1)):
+            manifest = self.chunk_store.write(BytesIO(make_dump(seed)), "foo.psql")
+            name = f"foo-server-2015-02-0{day}-042810.psql.chunks"
+            self.storage.storage.save(name, ContentFile(chunking.json.dumps(manifest).encode()))
+            manifests[name] = manifest
+        self.storage.clean_old_backups(keep_number=1)
+        kept = self.chunk_store.get_chunk_paths(manifests["foo-server-2015-02-07-042810.psql.chunks"])
+        assert self._count_chunks() == len(kept)
+        assert all(os.path.exists(os.path.join(self.location, path)) for path in kept)
+
+    def test_collect_garbage_manifest_not_in_catalog(self):
+        with patch("dbbackup.settings.CATALOG", True), patch("dbbackup.settings.STORAGE_OPTIONS", {}):
+            self.storage = get_storage("django.core.files.storage.FileSystemStorage", {"location": self.location})
+        self.chunk_store.storage = self.storage
+        tracked = self.chunk_store.write(BytesIO(make_dump(0)), "foo.psql")
+        self.storage.write_file(ContentFile(chunking.json.dumps(tracked).encode()), "foo-2015-02-06-042810.psql.chunks")
+        # Neither in the catalog nor named like a backup
+        untracked = self.chunk_store.write(BytesIO(make_dump(1)), "foo.psql")
+        self.storage.storage.save("manual.chunks", ContentFile(chunking.json.dumps(untracked).encode()))
+        self.chunk_store.write(BytesIO(make_dump(2)), "foo.psql")
+        assert self.storage.storage.exists(settings.CATALOG_FILENAME)
+        assert "manual.chunks" not in self.storage.catalog.query()
+
+        self.chunk_store.collect_garbage()
+        kept = self.chunk_store.get_chunk_paths(tracked) | self.chunk_store.get_chunk_paths(untracked)
+        assert self._count_chunks() == len(kept)
+        assert all(os.path.exists(os.path.join(self.location, path)) for path in kept)
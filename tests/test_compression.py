@@ -0,0 +1,148 @@
+import gzip
+import importlib.util
+import lzma
+import unittest
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from dbbackup import compression, utils
+
+ZSTD_AVAILABLE = importlib.util.find_spec("zstandard") is not None
+LZ4_AVAILABLE = importlib.util.find_spec("lz4") is not None
+DATA = b"foo" * 10000
+
+
+def compress(codec, data):
+    compressor = codec.compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+class GetCodecTest(TestCase):
+    def test_default(self):
+        codec = compression.get_codec()
+        assert isinstance(codec, compression.GzipCodec)
+        assert codec.level == 9
+        assert codec.threads == 1
+
+    @patch("dbbackup.settings.COMPRESSION", {"CODEC": "xz", "LEVEL": 1, "THREADS": 2})
+    def test_settings(self):
+        codec = compression.get_codec()
+        assert isinstance(codec, compression.XzCodec)
+        assert codec.level == 1
+        assert codec.threads == 2
+
+    def test_unknown(self):
+        with pytest.raises(ImproperlyConfigured):
+            compression.get_codec("rar")
+
+    def test_for_filename(self):
+        assert isinstance(compression.get_codec_for_filename("foo.db.xz"), compression.XzCodec)
+        assert isinstance(compression.get_codec_for_filename("foo.db.zst"), compression.ZstdCodec)
+        assert isinstance(compression.get_codec_for_filename("foo.db"), compression.GzipCodec)
+        assert compression.get_codec_for_filename("foo.db", default=None) is None
+
+    def test_is_compressed(self):
+        assert compression.is_compressed("foo.db.gz")
+        assert compression.is_compressed("foo.tar.lz4.gpg")
+        assert compression.is_compressed("foo.db.zst")
+        assert not compression.is_compressed("foo.db.gpg")
+        assert not compression.is_compressed("foo.gzip.db")
+        assert compression.is_compressed("foo.psql.gz.chunks")
+        assert compression.is_compressed("foo.db.xz.enc.metadata")
+        # Only the trailing extensions are looked at
+        assert not compression.is_compressed("foo.gz.db")
+        assert not compression.is_compressed("foo.xz.psql.gpg")
+        assert not compression.is_compressed("foo-server.gz-2015-02-06.db")
+
+
+class GzipCodecTest(TestCase):
+    def test_func(self):
+        codec = compression.GzipCodec()
+        assert gzip.decompress(compress(codec, DATA)) == DATA
+
+    def test_threads(self):
+        codec = compression.GzipCodec(threads=3)
+        codec.block_size = 1000
+        compressed = compress(codec, DATA)
+        assert gzip.decompress(compressed) == DATA
+        reader = codec.iter_uncompress(BytesIO(compressed), chunk_size=100)
+        assert b"".join(reader) == DATA
+
+    def test_iter_uncompress_padding(self):
+        codec = compression.GzipCodec()
+        compressed = compress(codec, DATA)
+        # Padding starting on a chunk boundary and spanning several chunks
+        reader = codec.iter_uncompress(BytesIO(compressed + b"\x00" * 100), chunk_size=len(compressed))
+        assert b"".join(reader) == DATA
+        padded = compressed + b"\x00" * 100 + compressed
+        reader = codec.iter_uncompress(BytesIO(padded), chunk_size=len(compressed) // 2 + 1)
+        assert b"".join(reader) == DATA * 2
+
+    def test_threads_empty(self):
+        codec = compression.GzipCodec(threads=2)
+        assert gzip.decompress(compress(codec, b"")) == b""
+
+    def test_threads_stopped(self):
+        codec = compression.GzipCodec(threads=2)
+        codec.block_size = 1000
+        compressor = codec.compressor()
+        compressor.compress(DATA)
+        # Not flushed, e.g. the stream was closed before the end
+        compression.close_compressor(compressor)
+        assert compressor._executor._shutdown
+        assert not compressor._pending
+
+    @patch("dbbackup.settings.COMPRESSION", {"CODEC": "gzip", "THREADS": 2})
+    def test_compress_file_closed(self):
+        with patch.object(compression.ParallelGzipCompressor, "close") as mock_close:
+            stream, _filename = utils.compress_file(BytesIO(DATA), "foo.db")
+            stream.read(1)
+            stream.close()
+        mock_close.assert_called_with()
+
+
+class XzCodecTest(TestCase):
+    def test_func(self):
+        codec = compression.XzCodec()
+        compressed = compress(codec, DATA)
+        assert lzma.decompress(compressed) == DATA
+        assert b"".join(codec.iter_uncompress(BytesIO(compressed))) == DATA
+
+
+@unittest.skipIf(not ZSTD_AVAILABLE, "zstandard not installed")
+class ZstdCodecTest(TestCase):
+    def test_func(self):
+        codec = compression.ZstdCodec(threads=2)
+        compressed = compress(codec, DATA)
+        assert b"".join(codec.iter_uncompress(BytesIO(compressed))) == DATA
+
+
+@unittest.skipIf(not LZ4_AVAILABLE, "lz4 not installed")
+class Lz4CodecTest(TestCase):
+    def test_func(self):
+        codec = compression.Lz4Codec()
+        compressed = compress(codec, DATA)
+        assert b"".join(codec.iter_uncompress(BytesIO(compressed))) == DATA
+
+
+@patch("dbbackup.settings.COMPRESSION", {"CODEC": "xz"})
+class CodecFileTest(TestCase):
+    def test_compress_file(self):
+        outputfile, filename = utils.compress_file(BytesIO(DATA), "foo.db")
+        assert filename == "foo.db.xz"
+        outputfile.seek(0)
+        uncompressed, filename = utils.uncompress_file(outputfile, filename)
+        assert filename == "foo.db"
+        uncompressed.seek(0)
+        assert uncompressed.read() == DATA
+
+    def test_compress_stream(self):
+        stream, filename = utils.compress_stream(BytesIO(DATA), "foo.db")
+        assert filename == "foo.db.xz"
+        uncompressed, filename = utils.uncompress_stream(BytesIO(stream.read()), filename)
+        assert filename == "foo.db"
+        assert uncompressed.read() == DATA
@@ -1,4 +1,7 @@
 import os
+import shlex
+import sys
+from subprocess import Popen
 from tempfile import SpooledTemporaryFile
 from unittest.mock import patch
 
@@ -7,6 +10,9 @@ from django.test import TestCase
 
 from dbbackup.db import exceptions
 from dbbackup.db.base import BaseCommandDBConnector, BaseDBConnector, get_connector
+from dbbackup.utils import IterStream
+
+PYTHON = shlex.quote(sys.executable)
 
 
 class GetConnectorTest(TestCase):
@@ -119,6 +125,51 @@ class BaseCommandDBConnectorTest(TestCase):
             assert "Database command" not in error_message
             assert "client tools are installed" not in error_message
 
+    def test_run_command_stream(self):
+        connector = BaseCommandDBConnector()
+        stdout, stderr = connector.run_command(f"{PYTHON} -c \"print('foo' * 3)\"", stream=True)
+        assert isinstance(stdout, IterStream)
+        assert stdout.read() == b"foofoofoo\n"
+        assert not stderr.read()
+
+    def test_run_command_stream_error(self):
+        connector = BaseCommandDBConnector()
+        stdout, _stderr = connector.run_command(
+            f"{PYTHON} -c \"import sys; sys.stderr.write('boom'); sys.exit(1)\"", stream=True
+        )
+        with pytest.raises(exceptions.CommandConnectorError, match="boom"):
+            stdout.read()
+
+    def test_run_command_stream_closed_unread(self):
+        processes = []
+
+        def popen(*args, **kwargs):
+            processes.append(Popen(*args, **kwargs))
+            return processes[-1]
+
+        connector = BaseCommandDBConnector()
+        with patch("dbbackup.db.base.Popen", side_effect=popen):
+            stdout, _stderr = connector.run_command(f'{PYTHON} -c "import time; time.sleep(60)"', stream=True)
+        stdout.close()
+        # The process is killed and reaped
+        assert processes[0].returncode is not None
+
+    def test_run_command_stdin_stream(self):
+        connector = BaseCommandDBConnector()
+        stdin = IterStream([b"foo", b"bar"])
+        stdout, _stderr = connector.run_command(f'{PYTHON} -c "import sys; print(len(sys.stdin.read()))"', stdin=stdin)
+        assert stdout.read() == b"6\n"
+
+    def test_run_command_stdin_stream_error(self):
+        def broken_input():
+            yield b"foo"
+            msg = "Broken input"
+            raise EOFError(msg)
+
+        connector = BaseCommandDBConnector()
+        with pytest.raises(EOFError):
+            connector.run_command(f'{PYTHON} -c "import sys; sys.stdin.read()"', stdin=IterStream(broken_input()))
+
     def test_run_command_stdin(self):
         connector = BaseCommandDBConnector()
         stdin = SpooledTemporaryFile()
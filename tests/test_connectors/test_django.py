@@ -2,12 +2,17 @@
 Tests for Django native serializer connector.
 """
 
+import datetime
+import json
+from io import BytesIO
 from tempfile import SpooledTemporaryFile
 from unittest.mock import patch
 
-from django.test import TestCase
+from django.db import connections
+from django.test import TestCase, TransactionTestCase
 
-from dbbackup.db.django import DjangoConnector
+from dbbackup.db.django import DjangoConnector, _iter_fixture_objects
+from tests.testapp.models import CharModel, ForeignKeyModel, ManyToManyModel, NaturalKeyModel, TextModel
 
 
 class DjangoConnectorTest(TestCase):
@@ -269,3 +274,164 @@ class DjangoConnectorTest(TestCase):
         # Check that we have compressed data
         compressed_file.seek(0)
         assert len(compressed_file.read()) > 0
+
+
+class DjangoConnectorJsonLinesTest(TestCase):
+    """Tests for DjangoConnector with FORMAT = "jsonl"."""
+
+    def setUp(self):
+        self.connector = DjangoConnector(format="jsonl", chunk_size=2)
+        for i in range(5):
+            char = CharModel.objects.create(field=f"foo{i}")
+            ForeignKeyModel.objects.create(field=char)
+        TextModel.objects.create(field="bar\nbaz")
+
+    def test_extension(self):
+        assert self.connector.extension == "jsonl"
+        assert self.connector.generate_filename().endswith(".jsonl")
+
+    def test_create_dump(self):
+        dump = self.connector.create_dump()
+        objects = [json.loads(line) for line in dump.read().decode("utf-8").splitlines()]
+        models = [obj["model"] for obj in objects]
+        assert models.count("testapp.charmodel") == 5
+        assert models.count("testapp.foreignkeymodel") == 5
+        # Objects come after the ones they refer to
+        assert models.index("testapp.foreignkeymodel") > models.index("testapp.charmodel")
+        assert {
+            "model": "testapp.textmodel",
+            "pk": TextModel.objects.get().pk,
+            "fields": {"field": "bar\nbaz"},
+        } in objects
+
+    def test_create_dump_iterates_by_chunks(self):
+        with patch("django.db.models.query.QuerySet.iterator", autospec=True, return_value=iter([])) as mock_iterator:
+            self.connector.create_dump()
+        assert mock_iterator.call_count == len(self.connector._get_models())
+        assert all(call.kwargs == {"chunk_size": 2} for call in mock_iterator.call_args_list)
+
+    def test_create_dump_with_exclude(self):
+        self.connector.exclude = ["testapp.TextModel"]
+        dump = self.connector.create_dump()
+        assert b"testapp.textmodel" not in dump.read()
+        assert TextModel not in self.connector._get_models()
+
+    def test_restore_dump(self):
+        dump = self.connector.create_dump()
+        ForeignKeyModel.objects.all().delete()
+        CharModel.objects.all().delete()
+        TextModel.objects.all().delete()
+        self.connector.restore_dump(dump)
+        assert sorted(CharModel.objects.values_list("field", flat=True)) == [f"foo{i}" for i in range(5)]
+        assert ForeignKeyModel.objects.count() == 5
+        assert TextModel.objects.get().field == "bar\nbaz"
+
+
+class DjangoConnectorParallelJsonLinesTest(TransactionTestCase):
+    """Models are dumped by separate threads, which only see committed data."""
+
+    def setUp(self):
+        for i in range(5):
+            ForeignKeyModel.objects.create(field=CharModel.objects.create(field=f"foo{i}"))
+            TextModel.objects.create(field=f"bar{i}")
+        self.sequential = DjangoConnector(format="jsonl").create_dump().read()
+
+    @patch.object(DjangoConnector, "_import_snapshot")
+    @patch.object(DjangoConnector, "_export_snapshot", return_value="00000003-00000002-1")
+    def test_same_as_sequential_dump(self, mock_export_snapshot, mock_import_snapshot):
+        connector = DjangoConnector(format="jsonl", workers=3)
+        with patch.object(connections["default"], "vendor", "postgresql"):
+            parallel = connector.create_dump().read()
+        assert parallel == self.sequential
+        assert parallel.count(b"\n") == 15
+        # Every worker's transaction sees the exported snapshot
+        mock_export_snapshot.assert_called_once_with()
+        assert mock_import_snapshot.call_count == len(connector._get_models())
+        assert {call.args for call in mock_import_snapshot.call_args_list} == {("00000003-00000002-1",)}
+
+    @patch.object(DjangoConnector, "_dump_model")
+    def test_no_shared_snapshot(self, mock_dump_model):
+        with self.assertLogs("dbbackup.command", "WARNING"):
+            dump = DjangoConnector(format="jsonl", workers=3).create_dump().read()
+        assert dump == self.sequential
+        mock_dump_model.assert_not_called()
+
+
+class DjangoConnectorBulkRestoreTest(TestCase):
+    """Tests for DjangoConnector with BULK_RESTORE."""
+
+    def setUp(self):
+        self.updated = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        chars = [CharModel.objects.create(field=f"foo{i}") for i in range(5)]
+        for char in chars:
+            ForeignKeyModel.objects.create(field=char)
+        ManyToManyModel.objects.create().field.set(chars[:3])
+        # The child comes before its parent in the dump
+        child = NaturalKeyModel.objects.create(name="child")
+        parent = NaturalKeyModel.objects.create(name="parent")
+        NaturalKeyModel.objects.filter(pk=child.pk).update(parent=parent)
+        NaturalKeyModel.objects.update(updated=self.updated)
+
+    def _clear(self):
+        for model in (ManyToManyModel, ForeignKeyModel, CharModel, NaturalKeyModel):
+            model.objects.all().delete()
+
+    def _check(self):
+        assert sorted(CharModel.objects.values_list("field", flat=True)) == [f"foo{i}" for i in range(5)]
+        assert sorted(ForeignKeyModel.objects.values_list("field__field", flat=True)) == [f"foo{i}" for i in range(5)]
+        assert sorted(ManyToManyModel.objects.get().field.values_list("field", flat=True)) == ["foo0", "foo1", "foo2"]
+        assert NaturalKeyModel.objects.get(name="child").parent.name == "parent"
+        assert set(NaturalKeyModel.objects.values_list("updated", flat=True)) == {self.updated}
+
+    def test_restore_json(self):
+        dump = DjangoConnector().create_dump()
+        self._clear()
+        connector = DjangoConnector(bulk_restore=True, bulk_batch_size=2)
+        with patch("dbbackup.db.django.call_command") as mock_call_command:
+            connector.restore_dump(dump)
+        mock_call_command.assert_not_called()
+        self._check()
+
+    def test_restore_jsonl(self):
+        dump = DjangoConnector(format="jsonl").create_dump()
+        self._clear()
+        DjangoConnector(bulk_restore=True).restore_dump(dump)
+        self._check()
+
+    def test_restore_batches(self):
+        dump = DjangoConnector(format="jsonl").create_dump()
+        self._clear()
+        connector = DjangoConnector(bulk_restore=True, bulk_batch_size=2)
+        with patch.object(connector, "_save_objects", wraps=connector._save_objects) as mock_save:
+            connector.restore_dump(dump)
+        # CharModel: 3 batches, ForeignKeyModel: 3, ManyToManyModel: 1, NaturalKeyModel: 1
+        assert [len(call.args[0]) for call in mock_save.call_args_list].count(2) == 5
+        self._check()
+
+    def test_restore_existing_objects(self):
+        dump = DjangoConnector(format="jsonl").create_dump()
+        CharModel.objects.filter(field="foo0").update(field="bar")
+        NaturalKeyModel.objects.filter(name="child").update(parent=None)
+        DjangoConnector(bulk_restore=True).restore_dump(dump)
+        self._check()
+        assert NaturalKeyModel.objects.count() == 2
+
+
+class IterFixtureObjectsTest(TestCase):
+    def test_json(self):
+        dump = BytesIO('[\n{"model": "a", "fields": {"f": "\u00e9]},"}},\n  {"model": "b"}\n]\n'.encode())
+        objects = list(_iter_fixture_objects(dump, chunk_size=3))
+        assert objects == [{"model": "a", "fields": {"f": "\u00e9]},"}}, {"model": "b"}]
+
+    def test_json_lines(self):
+        dump = SpooledTemporaryFile(mode="w+t", encoding="utf-8")
+        dump.write('{"model": "a"}\n{"model": "b"}\n')
+        dump.seek(0)
+        assert list(_iter_fixture_objects(dump, chunk_size=5)) == [{"model": "a"}, {"model": "b"}]
+
+    def test_empty(self):
+        assert list(_iter_fixture_objects(BytesIO(b"[]"))) == []
+
+    def test_invalid(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(_iter_fixture_objects(BytesIO(b'[{"model": "a"')))
@@ -1,3 +1,6 @@
+import os
+import shlex
+import tarfile
 from io import BytesIO
 from unittest.mock import Mock, patch
 
@@ -6,6 +9,7 @@ from django.test import TestCase
 from dbbackup.db.postgresql import (
     PgDumpBinaryConnector,
     PgDumpConnector,
+    PgDumpDirectoryConnector,
     PgDumpGisConnector,
     parse_postgres_settings,
 )
@@ -343,6 +347,82 @@ class PgDumpBinaryConnectorTest(TestCase):
         assert "--dbname=postgresql://example@%2Frun%2Fpostgresql:5432/dbname" in mock_run_command.call_args[0][0]
 
 
+def fake_directory_dump(cmd, **kwargs):
+    """Mimic ``pg_dump --format=directory`` by writing a few files."""
+    output_dir = next(arg for arg in shlex.split(cmd) if arg.startswith("--file="))[len("--file=") :]
+    os.makedirs(output_dir)
+    with open(os.path.join(output_dir, "toc.dat"), "wb") as fd:
+        fd.write(b"toc")
+    with open(os.path.join(output_dir, "3001.dat.gz"), "wb") as fd:
+        fd.write(b"data" * 1000)
+    return BytesIO(), BytesIO()
+
+
+@patch("dbbackup.db.postgresql.PgDumpDirectoryConnector.run_command", side_effect=fake_directory_dump)
+class PgDumpDirectoryConnectorTest(TestCase):
+    def setUp(self):
+        self.connector = PgDumpDirectoryConnector()
+        self.connector.settings["HOST"] = "hostname"
+        self.connector.settings["ENGINE"] = "django.db.backends.postgresql"
+        self.connector.settings["NAME"] = "dbname"
+
+    def test_create_dump(self, mock_run_command):
+        dump = self.connector.create_dump()
+        cmd = mock_run_command.call_args[0][0]
+        assert "--format=directory" in cmd
+        assert "--jobs=4" in cmd
+        output_dir = next(arg for arg in shlex.split(cmd) if arg.startswith("--file="))[len("--file=") :]
+        # Temporary directory is removed once packed
+        assert not os.path.exists(output_dir)
+        with tarfile.open(fileobj=dump, mode="r:") as tar_file:
+            assert sorted(tar_file.getnames()) == ["3001.dat.gz", "toc.dat"]
+            assert tar_file.extractfile("3001.dat.gz").read() == b"data" * 1000
+
+    def test_create_dump_stream(self, mock_run_command):
+        self.connector.stream = True
+        dump = self.connector.create_dump()
+        with tarfile.open(fileobj=dump, mode="r|") as tar_file:
+            assert sorted(member.name for member in tar_file) == ["3001.dat.gz", "toc.dat"]
+
+    def test_create_dump_stream_closed_unread(self, mock_run_command):
+        self.connector.stream = True
+        dump = self.connector.create_dump()
+        cmd = mock_run_command.call_args[0][0]
+        output_dir = next(arg for arg in shlex.split(cmd) if arg.startswith("--file="))[len("--file=") :]
+        assert os.path.exists(output_dir)
+        dump.close()
+        assert not os.path.exists(os.path.dirname(output_dir))
+
+    def test_restore_dump(self, mock_run_command):
+        self.connector.jobs = 8
+        dump = self.connector.create_dump()
+        restored = {}
+
+        def fake_restore(cmd, **kwargs):
+            restore_dir = shlex.split(cmd)[-1]
+            restored.update({
+                name: os.path.getsize(os.path.join(restore_dir, name)) for name in os.listdir(restore_dir)
+            })
+            return BytesIO(), BytesIO()
+
+        mock_run_command.side_effect = fake_restore
+        self.connector.restore_dump(dump)
+        cmd = mock_run_command.call_args[0][0]
+        assert cmd.startswith("pg_restore --dbname=postgresql://hostname/dbname --no-password --jobs=8")
+        assert "--single-transaction" not in cmd
+        assert restored == {"toc.dat": 3, "3001.dat.gz": 4000}
+
+    def test_restore_dump_single_job(self, mock_run_command):
+        self.connector.jobs = 1
+        dump = self.connector.create_dump()
+        mock_run_command.side_effect = None
+        mock_run_command.return_value = (BytesIO(), BytesIO())
+        self.connector.restore_dump(dump)
+        cmd = mock_run_command.call_args[0][0]
+        assert "--jobs" not in cmd
+        assert "--single-transaction" in cmd
+
+
 @patch(
     "dbbackup.db.postgresql.PgDumpGisConnector.run_command",
     return_value=(BytesIO(b"foo"), BytesIO()),
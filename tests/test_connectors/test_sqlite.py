@@ -1,7 +1,13 @@
+import os
+import shutil
+import sqlite3
+import tempfile
 from io import BytesIO
-from unittest.mock import mock_open, patch
+from shutil import copyfileobj
+from unittest.mock import Mock, patch
 
-from django.db import connection
+import pytest
+from django.db import connection, transaction
 from django.test import TestCase
 
 from dbbackup.db.sqlite import SqliteBackupConnector, SqliteConnector, SqliteCPConnector
@@ -217,19 +223,244 @@ CREATE VIEW test_exists_view AS SELECT * FROM test_exists;
         assert already_exists_warnings, "Should warn about 'already exists' errors"
 
 
-@patch("dbbackup.db.sqlite.open", mock_open(read_data=b"foo"), create=True)
-class SqliteCPConnectorTest(TestCase):
-    def test_create_dump(self):
-        connector = SqliteCPConnector()
+class SqliteConnectorStreamingRestoreTest(TestCase):
+    def test_iter_statements(self):
+        dump = BytesIO(
+            b"CREATE TABLE foo (bar TEXT);\n"
+            b"INSERT INTO foo VALUES('a;\nb');\n"
+            b"INSERT INTO foo VALUES('c');\n"
+            b"CREATE TRIGGER t AFTER INSERT ON foo BEGIN\nDELETE FROM foo;\nEND;\n"
+            b"SELECT 1;"
+        )
+        statements = list(SqliteConnector()._iter_statements(dump))
+        assert statements == [
+            "CREATE TABLE foo (bar TEXT);\n",
+            "INSERT INTO foo VALUES('a;\nb');\n",
+            "INSERT INTO foo VALUES('c');\n",
+            "CREATE TRIGGER t AFTER INSERT ON foo BEGIN\nDELETE FROM foo;\nEND;\n",
+            "SELECT 1;",
+        ]
+
+    def test_restore_by_batches(self):
+        for i in range(5):
+            CharModel.objects.create(field=f"foo{i}")
+        connector = SqliteConnector(restore_batch_size=2)
         dump = connector.create_dump()
-        dump_content = dump.read()
-        assert dump_content
-        assert dump_content == b"foo"
+        statements = list(connector._iter_statements(dump))
+        CharModel.objects.all().delete()
+        dump.seek(0)
+        with patch("dbbackup.db.sqlite.transaction.atomic", wraps=transaction.atomic) as mock_atomic:
+            connector.restore_dump(dump)
+        assert mock_atomic.call_count == (len(statements) + 1) // 2
+        assert CharModel.objects.count() == 5
 
-    def test_restore_dump(self):
-        connector = SqliteCPConnector()
+    def test_dump_by_batches(self):
+        for i in range(5):
+            CharModel.objects.create(field=f"foo'{i}")
+        connector = SqliteConnector(dump_batch_size=3)
         dump = connector.create_dump()
+        inserts = [line for line in dump.read().splitlines() if b'INTO "testapp_charmodel"' in line]
+        assert len(inserts) == 2
+        assert inserts[0].startswith(b'INSERT OR REPLACE INTO "testapp_charmodel" VALUES(')
+        assert inserts[0].count(b"),(") == 2
+        CharModel.objects.all().delete()
+        dump.seek(0)
         connector.restore_dump(dump)
+        assert sorted(CharModel.objects.values_list("field", flat=True)) == [f"foo'{i}" for i in range(5)]
+
+    def test_set_pragmas(self):
+        db = sqlite3.connect(":memory:")
+        self.addCleanup(db.close)
+        cursor = db.cursor()
+        previous = SqliteConnector()._set_pragmas(cursor, {"synchronous": "OFF", "foo bar": "baz"})
+        assert previous == {"synchronous": 2}
+        assert cursor.execute("PRAGMA synchronous").fetchone()[0] == 0
+
+
+class SqliteConnectorParallelDumpTest(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, "db.sqlite3")
+        self.db = sqlite3.connect(self.path)
+        self.addCleanup(self.db.close)
+        for i in range(6):
+            self.db.execute(f'CREATE TABLE "table{i}" (id INTEGER PRIMARY KEY, name TEXT)')
+            self.db.executemany(f'INSERT INTO "table{i}" (name) VALUES (?)', [(f"it's\n{j}",) for j in range(50 * i)])
+        self.db.execute('CREATE INDEX "index1" ON "table1" (name)')
+        self.db.execute('CREATE VIEW "view2" AS SELECT name FROM "table2"')
+        self.db.commit()
+
+    def _create_connector(self, **kwargs):
+        connector = SqliteConnector(**kwargs)
+        connector.connection = Mock(settings_dict={"NAME": self.path}, cursor=self.db.cursor)
+        return connector
+
+    def _dump(self, connector):
+        dump = BytesIO()
+        connector._write_dump(dump)
+        return dump.getvalue()
+
+    def test_same_as_sequential_dump(self):
+        sequential = self._dump(self._create_connector(dump_batch_size=7))
+        parallel_connector = self._create_connector(dump_batch_size=7, dump_workers=3)
+        with patch.object(parallel_connector, "_open_snapshot", wraps=parallel_connector._open_snapshot) as mock_open:
+            parallel = self._dump(parallel_connector)
+        mock_open.assert_called_once_with(self.path, 3)
+        assert parallel == sequential
+        assert b'CREATE VIEW IF NOT EXISTS "view2"' in parallel
+
+    def test_table_timings(self):
+        connector = self._create_connector(dump_workers=2, exclude=["table0"])
+        self._dump(connector)
+        assert sorted(connector.table_timings) == [f"table{i}" for i in range(1, 6)]
+        assert all(seconds >= 0 for seconds in connector.table_timings.values())
+
+    def test_snapshot(self):
+        # With WAL, writers don't wait for readers to finish
+        self.db.execute("PRAGMA journal_mode=WAL")
+        connector = self._create_connector()
+        connections = connector._open_snapshot(self.path, 2)
+        try:
+            self.db.execute('INSERT INTO "table1" (name) VALUES (?)', ("new",))
+            self.db.commit()
+            for connection in connections:
+                assert connection.execute('SELECT COUNT(*) FROM "table1"').fetchone()[0] == 50
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def test_in_memory_database(self):
+        connector = self._create_connector(dump_workers=2)
+        connector.connection.settings_dict["NAME"] = ":memory:"
+        with patch.object(connector, "_write_tables_in_parallel") as mock_parallel:
+            self._dump(connector)
+        mock_parallel.assert_not_called()
+
+
+class SqliteCPConnectorTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "db.sqlite3")
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE foo (bar TEXT)")
+        db.executemany("INSERT INTO foo VALUES (?)", [(f"bar{i}" * 100,) for i in range(1000)])
+        db.commit()
+        db.close()
+        self.connector = SqliteCPConnector()
+        self.connector.connection = Mock(settings_dict={"NAME": self.path})
+
+    def _read_db(self):
+        with open(self.path, "rb") as fd:
+            return fd.read()
+
+    def test_create_dump(self):
+        # Everything is copied in the kernel, nothing is left for copyfileobj
+        with patch("dbbackup.utils.copyfileobj"):
+            dump = self.connector.create_dump()
+        assert dump.read() == self._read_db()
+        dump.close()
+        assert os.listdir(self.tmp_dir) == ["db.sqlite3"]
+
+    def _open_wal_writer(self):
+        writer = sqlite3.connect(self.path, isolation_level=None)
+        self.addCleanup(writer.close)
+        writer.execute("PRAGMA journal_mode=WAL")
+        writer.execute("PRAGMA wal_autocheckpoint=0")
+        writer.executemany("INSERT INTO foo VALUES (?)", [(f"wal{i}",) for i in range(100)])
+        assert os.path.getsize(f"{self.path}-wal")
+        return writer
+
+    def _count_dump_rows(self, dump):
+        path = os.path.join(self.tmp_dir, "dump.sqlite3")
+        with open(path, "wb") as fd:
+            copyfileobj(dump, fd)
+        db = sqlite3.connect(path)
+        try:
+            return db.execute("SELECT COUNT(*) FROM foo").fetchone()[0]
+        finally:
+            db.close()
+
+    def test_create_dump_wal_checkpointed(self):
+        self._open_wal_writer()
+        with patch("dbbackup.db.sqlite.utils.copy_file", wraps=copyfileobj) as mock_copy:
+            dump = self.connector.create_dump()
+        mock_copy.assert_called_once()
+        assert os.path.getsize(f"{self.path}-wal") == 0
+        assert self._count_dump_rows(dump) == 1100
+
+    def test_create_dump_wal_with_reader(self):
+        writer = self._open_wal_writer()
+        # A reader of the WAL keeps the checkpoint from emptying it
+        reader = sqlite3.connect(self.path, isolation_level=None)
+        self.addCleanup(reader.close)
+        reader.execute("BEGIN")
+        reader.execute("SELECT COUNT(*) FROM foo").fetchall()
+        writer.execute("INSERT INTO foo VALUES ('after')")
+        with patch("dbbackup.db.sqlite.utils.copy_file") as mock_copy:
+            dump = self.connector.create_dump()
+        mock_copy.assert_not_called()
+        assert self._count_dump_rows(dump) == 1101
+
+    def test_create_dump_holds_write_lock(self):
+        writer = sqlite3.connect(self.path, timeout=0)
+        self.addCleanup(writer.close)
+
+        def copy_file(src, dst):
+            with pytest.raises(sqlite3.OperationalError, match="locked"):
+                writer.execute("INSERT INTO foo VALUES ('baz')")
+                writer.commit()
+            copyfileobj(src, dst)
+
+        with patch("dbbackup.db.sqlite.utils.copy_file", side_effect=copy_file):
+            self.connector.create_dump()
+
+    def test_restore_dump(self):
+        content = self._read_db()
+        dump = self.connector.create_dump()
+        with open(f"{self.path}-journal", "wb") as fd:
+            fd.write(b"stale")
+        os.truncate(self.path, 0)
+        self.connector.restore_dump(dump)
+        assert self._read_db() == content
+        assert os.listdir(self.tmp_dir) == ["db.sqlite3"]
+        self.connector.connection.close.assert_called_once_with()
+
+    def test_restore_dump_removes_journals_before_replace(self):
+        content = self._read_db()
+        dump = self.connector.create_dump()
+        for suffix in ("-journal", "-wal", "-shm"):
+            with open(f"{self.path}{suffix}", "wb") as fd:
+                fd.write(b"stale")
+        reader = sqlite3.connect(self.path, timeout=0)
+        self.addCleanup(reader.close)
+        replace = os.replace
+
+        def replace_database(src, dst):
+            assert sorted(os.listdir(self.tmp_dir)) == sorted(["db.sqlite3", os.path.basename(src)])
+            # The previous database is locked until it is replaced
+            with pytest.raises(sqlite3.OperationalError, match="locked"):
+                reader.execute("SELECT COUNT(*) FROM foo").fetchall()
+            replace(src, dst)
+
+        with patch("dbbackup.db.sqlite.os.replace", side_effect=replace_database):
+            self.connector.restore_dump(dump)
+        assert self._read_db() == content
+        assert os.listdir(self.tmp_dir) == ["db.sqlite3"]
+
+    def test_restore_dump_from_memory(self):
+        content = self._read_db()
+        self.connector.restore_dump(BytesIO(content))
+        assert self._read_db() == content
+
+    def test_restore_dump_failure_keeps_database(self):
+        content = self._read_db()
+        dump = Mock(fileno=Mock(side_effect=OSError), read=Mock(side_effect=OSError("Read failed")))
+        with pytest.raises(OSError, match="Read failed"):
+            self.connector.restore_dump(dump)
+        assert self._read_db() == content
+        assert os.listdir(self.tmp_dir) == ["db.sqlite3"]
 
 
 class SqliteBackupConnectorTest(TestCase):
@@ -245,6 +476,21 @@ class SqliteBackupConnectorTest(TestCase):
         dump = connector.create_dump()
         connector.restore_dump(dump)
 
+    def test_create_dump_by_steps(self):
+        connector = SqliteBackupConnector(pages=1)
+        with patch.object(connector, "_progress", wraps=connector._progress) as mock_progress:
+            dump = connector.create_dump()
+        assert mock_progress.call_count > 1
+        assert dump.read().startswith(b"SQLite format 3")
+
+    def test_temporary_file_removed(self):
+        connector = SqliteBackupConnector()
+        dump = connector.create_dump()
+        path = dump.name
+        dump.read()
+        dump.close()
+        assert not os.path.exists(path)
+
 
 class SqliteConnectionHandlingTest(TestCase):
     """Test connection handling edge cases"""
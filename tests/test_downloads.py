@@ -0,0 +1,147 @@
+import gzip
+import threading
+from io import BytesIO
+from unittest.mock import Mock, patch
+
+import pytest
+from django.test import TestCase
+
+from dbbackup import downloads, utils
+from dbbackup.storage import get_storage
+from tests.utils import HANDLED_FILES, FakeStorage
+
+
+class MemoryDownloader(downloads.BaseDownloader):
+    def __init__(self, storage, files, failures=None, **options):
+        super().__init__(storage, **options)
+        self.files = files
+        self.failures = failures or {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get_size(self, name):
+        return len(self.files[name])
+
+    def read_range(self, name, start, end):
+        with self.lock:
+            self.requests.append((start, end))
+            if self.failures.get(start):
+                self.failures[start] -= 1
+                # Connection closed in the middle of the response
+                return self.files[name][start : end - 1]
+        return self.files[name][start:end]
+
+
+@patch("dbbackup.uploads.RETRY_DELAY", 0)
+class RangeReaderTest(TestCase):
+    def setUp(self):
+        self.data = bytes(range(256)) * 1000
+        self.downloader = MemoryDownloader(FakeStorage(), {"foo.gz": self.data}, part_size=10000, threads=4)
+
+    def test_read(self):
+        with self.downloader.open("foo.gz") as reader:
+            assert isinstance(reader, downloads.RangeReader)
+            assert reader.read() == self.data
+            assert reader.read() == b""
+        assert sorted(self.downloader.requests) == [
+            (i, min(i + 10000, len(self.data))) for i in range(0, 256000, 10000)
+        ]
+
+    def test_read_sizes(self):
+        with self.downloader.open("foo.gz") as reader:
+            chunks = [reader.read(size) for size in (1, 9999, 10001, 25000)]
+            assert chunks == [self.data[:1], self.data[1:10000], self.data[10000:20001], self.data[20001:45001]]
+            assert reader.tell() == 45001
+
+    def test_seek(self):
+        with self.downloader.open("foo.gz") as reader:
+            assert reader.size == len(self.data)
+            reader.read(15000)
+            assert reader.seek(12000) == 12000
+            assert reader.read(10) == self.data[12000:12010]
+            reader.seek(-10, 2)
+            assert reader.read() == self.data[-10:]
+            reader.seek(0)
+            assert reader.read() == self.data
+
+    def test_retry_short_read(self):
+        self.downloader.failures = {20000: 2}
+        with self.downloader.open("foo.gz") as reader:
+            assert reader.read() == self.data
+        assert self.downloader.requests.count((20000, 30000)) == 3
+
+    def test_failure(self):
+        self.downloader.failures = {20000: 10}
+        self.downloader.retries = 1
+        with self.downloader.open("foo.gz") as reader, pytest.raises(OSError, match="instead of"):
+            reader.read()
+
+    def test_small_file(self):
+        storage = Mock()
+        self.downloader.storage = storage
+        self.downloader.part_size = len(self.data)
+        assert self.downloader.open("foo.gz") is storage.open.return_value
+        storage.open.assert_called_once_with("foo.gz", "rb")
+
+    def test_uncompress(self):
+        self.downloader.files["foo.gz"] = gzip.compress(self.data)
+        self.downloader.part_size = 1000
+        reader = self.downloader.open("foo.gz")
+        assert utils.handle_size(reader) == utils.bytes_to_str(len(self.downloader.files["foo.gz"]))
+        uncompressed_file, filename = utils.uncompress_file(reader, "foo.gz")
+        assert filename == "foo"
+        uncompressed_file.seek(0)
+        assert uncompressed_file.read() == self.data
+
+
+class S3Storage(FakeStorage):
+    bucket_name = "bucket"
+
+    def _normalize_name(self, name):
+        return f"backups/{name}"
+
+
+class S3DownloaderTest(TestCase):
+    def test_open(self):
+        data = b"0123456789"
+        storage = S3Storage()
+        storage.connection = Mock()
+        client = storage.connection.meta.client
+        client.head_object.return_value = {"ContentLength": len(data)}
+
+        def get_object(Bucket, Key, Range):
+            start, end = map(int, Range.removeprefix("bytes=").split("-"))
+            return {"Body": BytesIO(data[start : end + 1])}
+
+        client.get_object.side_effect = get_object
+        downloader = downloads.get_downloader(storage, part_size=4, threads=2)
+        assert isinstance(downloader, downloads.S3Downloader)
+        with downloader.open("foo.gz") as reader:
+            assert reader.read() == data
+        client.head_object.assert_called_once_with(Bucket="bucket", Key="backups/foo.gz")
+        assert sorted(call.kwargs["Range"] for call in client.get_object.call_args_list) == [
+            "bytes=0-3",
+            "bytes=4-7",
+            "bytes=8-9",
+        ]
+
+
+class StorageDownloadFileTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        HANDLED_FILES["written_files"].append(("foo.gz", BytesIO(b"foo")))
+        self.storage = get_storage()
+
+    def test_fallback_to_open(self):
+        assert downloads.get_downloader(self.storage.storage) is None
+        assert self.storage.download_file("foo.gz").read() == b"foo"
+
+    @patch("dbbackup.settings.PARALLEL_DOWNLOAD", {"PART_SIZE": 2})
+    def test_read_file(self):
+        downloader = MemoryDownloader(self.storage.storage, {"foo.gz": b"foobar"})
+        with patch("dbbackup.downloads.get_downloader", return_value=downloader) as mock_get_downloader:
+            reader = self.storage.read_file("foo.gz")
+        mock_get_downloader.assert_called_once_with(self.storage.storage, part_size=None, threads=None, retries=None)
+        assert reader.name == "foo.gz"
+        assert reader.read() == b"foobar"
+        reader.close()
@@ -0,0 +1,204 @@
+import base64
+import importlib.util
+import os
+import tempfile
+import unittest
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from dbbackup import encryption, utils
+
+CRYPTOGRAPHY_AVAILABLE = importlib.util.find_spec("cryptography") is not None
+KEY = bytes(range(32))
+DATA = os.urandom(100) * 1000
+AEAD_SETTINGS = {"BACKEND": "aead", "KEY": KEY, "SEGMENT_SIZE": 4096}
+
+
+def get_key():
+    return KEY
+
+
+class CustomBackend(encryption.BaseBackend):
+    name = "custom"
+    extension = ".rot"
+
+
+class GetBackendTest(TestCase):
+    def test_default(self):
+        backend = encryption.get_backend()
+        assert isinstance(backend, encryption.GpgBackend)
+
+    @patch("dbbackup.settings.ENCRYPTION", {"BACKEND": "aead", "ALGORITHM": "ChaCha20-Poly1305", "THREADS": 4})
+    def test_settings(self):
+        backend = encryption.get_backend()
+        assert isinstance(backend, encryption.AeadBackend)
+        assert backend.algorithm == "ChaCha20-Poly1305"
+        assert backend.threads == 4
+
+    @patch("dbbackup.settings.ENCRYPTION", {"BACKEND": "tests.test_encryption.CustomBackend"})
+    def test_import_path(self):
+        assert isinstance(encryption.get_backend(), CustomBackend)
+        assert encryption.is_encrypted("foo.psql.rot")
+
+    def test_unknown(self):
+        with pytest.raises(ImproperlyConfigured):
+            encryption.get_backend("rot13")
+
+    @patch("dbbackup.settings.ENCRYPTION", AEAD_SETTINGS)
+    def test_for_filename(self):
+        assert isinstance(encryption.get_backend_for_filename("foo.psql.gz.gpg"), encryption.GpgBackend)
+        backend = encryption.get_backend_for_filename("foo.psql.gz.enc")
+        assert isinstance(backend, encryption.AeadBackend)
+        assert backend.key == KEY
+        backend = encryption.get_backend_for_filename("db.enc.example.com-2024.psql.gpg")
+        assert isinstance(backend, encryption.GpgBackend)
+
+    def test_is_encrypted(self):
+        assert encryption.is_encrypted("foo.psql.gpg")
+        assert encryption.is_encrypted("foo.tar.gz.enc")
+        assert not encryption.is_encrypted("foo.psql.gz")
+        assert not encryption.is_encrypted("encrypted.psql")
+        assert not encryption.is_encrypted("db.enc.example.com-2024-01-01-000000.psql")
+        assert not encryption.is_encrypted("foo.gpg-2024.psql.gz")
+        assert encryption.is_encrypted("foo.psql.gpg.metadata")
+
+    def test_remove_extension(self):
+        backend = encryption.get_backend("aead")
+        assert encryption.remove_extension("foo.psql.gz.enc", backend) == "foo.psql.gz"
+        assert encryption.remove_extension("web.encore-2024.psql.enc", backend) == "web.encore-2024.psql"
+
+
+@unittest.skipIf(not CRYPTOGRAPHY_AVAILABLE, "cryptography not installed")
+class AeadBackendTest(TestCase):
+    def _encrypt(self, data=DATA, **options):
+        backend = encryption.AeadBackend(**{"key": KEY, "segment_size": 4096, **options})
+        return b"".join(backend.iter_encrypt(BytesIO(data)))
+
+    def _decrypt(self, data, **options):
+        backend = encryption.AeadBackend(**{"key": KEY, **options})
+        return b"".join(backend.iter_decrypt(BytesIO(data)))
+
+    def test_func(self):
+        encrypted = self._encrypt()
+        assert DATA[:4096] not in encrypted
+        # Header, and a tag for each segment
+        assert len(encrypted) == encryption.AEAD_HEADER.size + len(DATA) + 25 * encryption.AEAD_TAG_SIZE
+        assert self._decrypt(encrypted) == DATA
+
+    def test_chacha20(self):
+        encrypted = self._encrypt(algorithm="ChaCha20-Poly1305")
+        # The algorithm is read from the header
+        assert self._decrypt(encrypted) == DATA
+
+    def test_threads(self):
+        encrypted = self._encrypt(threads=4)
+        assert self._decrypt(encrypted, threads=4) == DATA
+        assert self._decrypt(encrypted) == DATA
+
+    def test_empty(self):
+        assert self._decrypt(self._encrypt(b"")) == b""
+
+    def test_exact_segments(self):
+        data = DATA[: 4096 * 3]
+        assert self._decrypt(self._encrypt(data)) == data
+
+    def test_random_salt(self):
+        assert self._encrypt() != self._encrypt()
+
+    def test_wrong_key(self):
+        encrypted = self._encrypt()
+        with pytest.raises(encryption.DecryptionError, match="segment 0"):
+            self._decrypt(encrypted, key=bytes(32))
+
+    def test_tampered(self):
+        encrypted = bytearray(self._encrypt())
+        encrypted[-1] ^= 1
+        with pytest.raises(encryption.DecryptionError, match="segment 24"):
+            self._decrypt(bytes(encrypted))
+
+    def test_truncated(self):
+        encrypted = self._encrypt()
+        segment = 4096 + encryption.AEAD_TAG_SIZE
+        # Whole segments are removed, the new last one isn't flagged as last
+        with pytest.raises(encryption.DecryptionError, match="segment 23"):
+            self._decrypt(encrypted[: encryption.AEAD_HEADER.size + 24 * segment])
+
+    def test_reordered(self):
+        encrypted = self._encrypt()
+        header, size = encryption.AEAD_HEADER.size, 4096 + encryption.AEAD_TAG_SIZE
+        first, second = encrypted[header : header + size], encrypted[header + size : header + 2 * size]
+        with pytest.raises(encryption.DecryptionError, match="segment 0"):
+            self._decrypt(encrypted[:header] + second + first + encrypted[header + 2 * size :])
+
+    def test_invalid_segment_size(self):
+        encrypted = self._encrypt()
+        for segment_size in (0, 1023, 64 * 1024 * 1024 + 1, 2**32 - 1):
+            header = bytearray(encrypted[: encryption.AEAD_HEADER.size])
+            header[8:12] = segment_size.to_bytes(4, "big")
+            fileobj = BytesIO(bytes(header) + encrypted[encryption.AEAD_HEADER.size :])
+            backend = encryption.AeadBackend(key=KEY)
+            with pytest.raises(encryption.DecryptionError, match="segment size"):
+                backend.iter_decrypt(fileobj)
+            # No segment is read
+            assert fileobj.tell() == encryption.AEAD_HEADER.size
+        with pytest.raises(ImproperlyConfigured, match="SEGMENT_SIZE"):
+            self._encrypt(segment_size=0)
+
+    def test_not_encrypted(self):
+        with pytest.raises(encryption.DecryptionError, match="not an encrypted backup"):
+            self._decrypt(b"foo" * 100)
+
+    def test_key_callable(self):
+        encrypted = self._encrypt(key=get_key)
+        assert self._decrypt(encrypted, key="tests.test_encryption.get_key") == DATA
+
+    def test_key_base64(self):
+        encrypted = self._encrypt(key=base64.b64encode(KEY).decode())
+        assert self._decrypt(encrypted) == DATA
+
+    def test_key_file(self):
+        with tempfile.NamedTemporaryFile(delete=False) as fd:
+            fd.write(base64.b64encode(KEY) + b"\n")
+        self.addCleanup(os.remove, fd.name)
+        encrypted = self._encrypt(key=None, key_file=fd.name)
+        assert self._decrypt(encrypted) == DATA
+
+    def test_invalid_key(self):
+        with pytest.raises(ImproperlyConfigured, match="32 bytes"):
+            self._encrypt(key=b"foo")
+        with pytest.raises(ImproperlyConfigured, match="KEY_FILE"):
+            self._encrypt(key=None)
+        with pytest.raises(ImproperlyConfigured, match="base64"):
+            self._encrypt(key="not a key!")
+        with pytest.raises(ImproperlyConfigured, match="import"):
+            self._encrypt(key="tests.test_encryption.missing_key")
+
+    def test_unknown_algorithm(self):
+        with pytest.raises(ImproperlyConfigured, match="algorithm"):
+            self._encrypt(algorithm="DES")
+
+
+@unittest.skipIf(not CRYPTOGRAPHY_AVAILABLE, "cryptography not installed")
+@patch("dbbackup.settings.ENCRYPTION", AEAD_SETTINGS)
+class AeadUtilsTest(TestCase):
+    def test_file(self):
+        encrypted_file, filename = utils.encrypt_file(BytesIO(DATA), "foo.psql")
+        assert filename == "foo.psql.enc"
+        decrypted_file, filename = utils.unencrypt_file(encrypted_file, filename)
+        assert filename == "foo.psql"
+        decrypted_file.seek(0)
+        assert decrypted_file.read() == DATA
+
+    def test_stream(self):
+        stream, filename = utils.encrypt_stream(BytesIO(DATA), "foo.psql")
+        assert filename == "foo.psql.enc"
+        stream, filename = utils.unencrypt_stream(BytesIO(stream.read()), filename)
+        assert filename == "foo.psql"
+        assert stream.read() == DATA
+
+    def test_backup_name(self):
+        assert utils.BackupName("default-foo-2016-01-01-000000.psql.gz.enc", "%Y-%m-%d-%H%M%S").encrypted
@@ -0,0 +1,126 @@
+import os
+import shutil
+import socket
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from dbbackup import metrics, utils
+
+
+class GetSizeTest(TestCase):
+    def test_file(self):
+        fileobj = BytesIO(b"foobar")
+        fileobj.seek(2)
+        assert metrics.get_size(fileobj) == 6
+        assert fileobj.tell() == 2
+
+    def test_stream(self):
+        assert metrics.get_size(utils.IterStream(iter([b"foo"]))) is None
+
+
+class BackupMetricsTest(TestCase):
+    def test_as_dict(self):
+        backup_metrics = metrics.BackupMetrics()
+        with backup_metrics.stage("dump") as stage:
+            stage["bytes_out"] = 1000
+        with backup_metrics.stage("compress", bytes_in=1000) as stage:
+            stage["bytes_out"] = 100
+        with backup_metrics.stage("upload", bytes_in=100):
+            pass
+        backup_metrics.finish()
+        result = backup_metrics.as_dict()
+        assert list(result["stages"]) == ["dump", "compress", "upload"]
+        assert result["bytes"] == 100
+        assert result["estimated_temp_bytes"] == 1100
+        assert result["stages"]["compress"] == {
+            "seconds": result["stages"]["compress"]["seconds"],
+            "bytes_in": 1000,
+            "bytes_out": 100,
+            "bytes_per_second": result["stages"]["compress"]["bytes_per_second"],
+            "streamed": False,
+        }
+        assert not result["streamed"]
+        assert result["seconds"] >= sum(stage["seconds"] for stage in result["stages"].values())
+
+    def test_streamed_stage(self):
+        backup_metrics = metrics.BackupMetrics()
+        with backup_metrics.stage("compress", bytes_in=1000) as stage:
+            stage["streamed"] = True
+        with backup_metrics.stage("upload") as stage:
+            stage["bytes_in"] = 100
+        result = backup_metrics.as_dict()
+        assert result["streamed"]
+        assert result["bytes"] == 100
+        assert result["stages"]["compress"]["seconds"] is None
+        assert result["stages"]["compress"]["bytes_per_second"] is None
+        assert result["stages"]["upload"]["seconds"] is not None
+
+    def test_failed_stage(self):
+        backup_metrics = metrics.BackupMetrics()
+        with self.assertRaises(OSError), backup_metrics.stage("dump"):
+            raise OSError
+        assert backup_metrics.as_dict()["stages"]["dump"]["bytes_out"] is None
+
+
+METRICS = {
+    "seconds": 2.5,
+    "bytes": 100,
+    "estimated_temp_bytes": 1100,
+    "streamed": True,
+    "stages": {
+        "dump": {"seconds": 2.0, "bytes_in": None, "bytes_out": 1000, "bytes_per_second": 500, "streamed": False},
+        "compress": {"seconds": None, "bytes_in": 1000, "bytes_out": None, "bytes_per_second": None, "streamed": True},
+        "upload": {"seconds": 0.5, "bytes_in": 100, "bytes_out": None, "bytes_per_second": 200, "streamed": False},
+    },
+}
+
+
+class ExportMetricsTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_prometheus_textfile(self):
+        path = os.path.join(self.tmp_dir, "dbbackup-{database}.prom")
+        with patch("dbbackup.settings.METRICS", {"PROMETHEUS_TEXTFILE": path}):
+            metrics.export_metrics(METRICS, "default")
+        assert os.listdir(self.tmp_dir) == ["dbbackup-default.prom"]
+        with open(os.path.join(self.tmp_dir, "dbbackup-default.prom")) as fd:
+            lines = fd.read().splitlines()
+        assert 'dbbackup_backup_duration_seconds{database="default"} 2.5' in lines
+        assert 'dbbackup_backup_size_bytes{database="default"} 100' in lines
+        assert 'dbbackup_stage_duration_seconds{database="default",stage="dump"} 2.0' in lines
+        assert 'dbbackup_stage_bytes_out{database="default",stage="dump"} 1000' in lines
+        assert 'dbbackup_backup_streamed{database="default"} 1' in lines
+        assert not any(
+            line.startswith('dbbackup_stage_duration_seconds{database="default",stage="compress"}') for line in lines
+        )
+        assert not any(line.startswith('dbbackup_stage_bytes_in{database="default",stage="dump"}') for line in lines)
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        address = f"127.0.0.1:{server.getsockname()[1]}"
+        with patch("dbbackup.settings.METRICS", {"STATSD": address, "STATSD_PREFIX": "backups"}):
+            metrics.export_metrics(METRICS, "default")
+        lines = set()
+        while "backups.default.upload.bytes_per_second:200|g" not in lines:
+            lines.add(server.recv(1024).decode())
+        assert "backups.default.seconds:2500|ms" in lines
+        assert "backups.default.dump.seconds:2000|ms" in lines
+        assert "backups.default.dump.bytes_out:1000|g" in lines
+        assert "backups.default.streamed:1|g" in lines
+        assert not any(line.startswith("backups.default.compress.seconds") for line in lines)
+
+    def test_errors_logged(self):
+        path = os.path.join(self.tmp_dir, "missing", "dbbackup.prom")
+        with (
+            patch("dbbackup.settings.METRICS", {"PROMETHEUS_TEXTFILE": path}),
+            self.assertLogs("dbbackup.command", "WARNING"),
+        ):
+            metrics.export_metrics(METRICS, "default")
@@ -1,9 +1,17 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
 from unittest.mock import patch
 
 import pytest
+from django.core.files.base import ContentFile
 from django.test import TestCase, override_settings
 
-from dbbackup import utils
+from dbbackup import settings, utils
+from dbbackup.catalog import BackupCatalog
 from dbbackup.storage import Storage, get_storage, get_storage_class
 from tests.utils import HANDLED_FILES, FakeStorage, LocationPrefixedFakeStorage
 
@@ -286,3 +294,154 @@ class StorageEdgeCasesTest(TestCase):
             storage.get_older_backup()
 
         assert "There's no backup file available" in str(context)
+
+
+class StorageCatalogTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        with patch("dbbackup.settings.CATALOG", True), patch("dbbackup.settings.STORAGE_OPTIONS", {}):
+            self.storage = get_storage(DEFAULT_STORAGE_PATH, {"location": self.location})
+        for name in (
+            "foodb-fooserver-2015-02-06-042810.db",
+            "foodb-fooserver-2015-02-07-042810.db.gz",
+            "fooserver-2015-02-08-042810.tar",
+        ):
+            self.storage.storage.save(name, ContentFile(b"foo"))
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_built_from_listing(self):
+        files = self.storage.list_backups(content_type="db")
+        assert files == ["foodb-fooserver-2015-02-06-042810.db", "foodb-fooserver-2015-02-07-042810.db.gz"]
+        assert self.storage.storage.exists(settings.CATALOG_FILENAME)
+
+    def test_listing_not_used_once_built(self):
+        self.storage.list_backups()
+        storage = Storage(DEFAULT_STORAGE_PATH, location=self.location)
+        storage.catalog = BackupCatalog(storage)
+        with patch.object(Storage, "list_directory", side_effect=AssertionError):
+            assert storage.get_latest_backup(content_type="db") == "foodb-fooserver-2015-02-07-042810.db.gz"
+            assert storage.list_backups(compressed=True) == ["foodb-fooserver-2015-02-07-042810.db.gz"]
+
+    def test_write_and_delete(self):
+        self.storage.list_backups()
+        self.storage.write_file(ContentFile(b"bar"), "foodb-fooserver-2015-02-09-042810.db")
+        self.storage.write_file(ContentFile(b"{}"), "foodb-fooserver-2015-02-09-042810.db.metadata")
+        assert self.storage.get_latest_backup(content_type="db") == "foodb-fooserver-2015-02-09-042810.db"
+        self.storage.delete_file("foodb-fooserver-2015-02-09-042810.db")
+        assert self.storage.get_latest_backup(content_type="db") == "foodb-fooserver-2015-02-07-042810.db.gz"
+
+    def _add_backups(self):
+        for day in (10, 11, 12):
+            name = f"foodb-fooserver-2015-02-{day}-042810.db"
+            self.storage.storage.save(name, ContentFile(b"foo"))
+            self.storage.storage.save(f"{name}.metadata", ContentFile(b"{}"))
+        self.storage.catalog.reconcile()
+
+    def test_clean_old_backups_saved_once(self):
+        self._add_backups()
+        catalog = self.storage.catalog
+        with (
+            patch.object(catalog, "_read", wraps=catalog._read) as mock_read,
+            patch.object(catalog, "_save", wraps=catalog._save) as mock_save,
+        ):
+            self.storage.clean_old_backups(content_type="db", keep_number=1)
+        mock_read.assert_called_once_with()
+        mock_save.assert_called_once()
+        assert self.storage.list_backups(content_type="db") == ["foodb-fooserver-2015-02-12-042810.db"]
+        catalog = BackupCatalog(Storage(DEFAULT_STORAGE_PATH, location=self.location))
+        assert [name for name, _date in catalog.query(content_type="db")] == ["foodb-fooserver-2015-02-12-042810.db"]
+
+    def test_clean_old_backups_interrupted(self):
+        self._add_backups()
+        delete = self.storage.storage.delete
+
+        def interrupted_delete(name):
+            if name.startswith("foodb-fooserver-2015-02-10"):
+                raise OSError("Interrupted")
+            delete(name)
+
+        with (
+            patch.object(self.storage.storage, "delete", side_effect=interrupted_delete),
+            pytest.raises(OSError, match="Interrupted"),
+        ):
+            self.storage.clean_old_backups(content_type="db", keep_number=1)
+        # The files deleted before the error are removed from the saved catalog
+        catalog = BackupCatalog(Storage(DEFAULT_STORAGE_PATH, location=self.location))
+        assert "foodb-fooserver-2015-02-11-042810.db" not in dict(catalog.query())
+        assert "foodb-fooserver-2015-02-10-042810.db" in dict(catalog.query())
+
+    def test_query_date_range(self):
+        files = self.storage.catalog.query(start=datetime(2015, 2, 7), end=datetime(2015, 2, 8))
+        assert [name for name, _date in files] == ["foodb-fooserver-2015-02-07-042810.db.gz"]
+
+    def test_reconcile(self):
+        self.storage.list_backups()
+        self.storage.storage.delete("fooserver-2015-02-08-042810.tar")
+        self.storage.storage.save("barserver-2015-02-10-042810.tar", ContentFile(b"foo"))
+        added, removed = self.storage.catalog.reconcile()
+        assert added == {"barserver-2015-02-10-042810.tar"}
+        assert removed == {"fooserver-2015-02-08-042810.tar"}
+        assert self.storage.list_backups(content_type="media") == ["barserver-2015-02-10-042810.tar"]
+
+    def test_unreadable(self):
+        self.storage.storage.save(settings.CATALOG_FILENAME, ContentFile(b"not json"))
+        assert len(self.storage.list_backups()) == 3
+
+    def test_updates_of_other_processes_kept(self):
+        self.storage.list_backups()
+        other = Storage(DEFAULT_STORAGE_PATH, location=self.location)
+        other.catalog = BackupCatalog(other)
+        other.list_backups()
+        self.storage.write_file(ContentFile(b"bar"), "foodb-fooserver-2015-02-09-042810.db")
+        other.write_file(ContentFile(b"bar"), "bardb-fooserver-2015-02-09-042810.db")
+        catalog = BackupCatalog(Storage(DEFAULT_STORAGE_PATH, location=self.location))
+        assert len(catalog.query(content_type="db")) == 4
+
+    def test_lost_while_saved(self):
+        self.storage.list_backups()
+        save = self.storage.storage.save
+
+        def interrupted_save(name, *args, **kwargs):
+            # The previous catalog is deleted, the new one is never written
+            if name == settings.CATALOG_FILENAME:
+                raise OSError("Interrupted")
+            return save(name, *args, **kwargs)
+
+        with (
+            patch.object(self.storage.storage, "save", side_effect=interrupted_save),
+            pytest.raises(OSError, match="Interrupted"),
+        ):
+            self.storage.write_file(ContentFile(b"bar"), "foodb-fooserver-2015-02-09-042810.db")
+        assert not self.storage.storage.exists(settings.CATALOG_FILENAME)
+        catalog = BackupCatalog(Storage(DEFAULT_STORAGE_PATH, location=self.location))
+        assert len(catalog.query(content_type="db")) == 3
+
+    def test_concurrent_writes(self):
+        self.storage.list_backups()
+        barrier = threading.Barrier(8)
+        save = self.storage.storage.save
+
+        def slow_save(*args, **kwargs):
+            # Widen the window between checking and saving the catalog
+            time.sleep(0.01)
+            return save(*args, **kwargs)
+
+        def write(index):
+            barrier.wait()
+            self.storage.write_file(ContentFile(b"bar"), f"db{index}-fooserver-2015-02-09-042810.db")
+
+        threads = [threading.Thread(target=write, args=(index,)) for index in range(8)]
+        with patch.object(self.storage.storage, "save", side_effect=slow_save):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        storage = Storage(DEFAULT_STORAGE_PATH, location=self.location)
+        catalog = BackupCatalog(storage)
+        assert len(catalog.query(content_type="db")) == 10
+        # The catalog wasn't saved under another name by concurrent saves
+        assert [name for name in os.listdir(self.location) if name.startswith("dbbackup-catalog")] == [
+            settings.CATALOG_FILENAME
+        ]
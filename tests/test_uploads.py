@@ -0,0 +1,242 @@
+import threading
+from io import BytesIO
+from unittest.mock import Mock, patch
+
+import pytest
+from django.test import TestCase
+
+from dbbackup import uploads
+from dbbackup.storage import get_storage
+from dbbackup.utils import IterStream
+from tests.utils import HANDLED_FILES, FakeStorage
+
+
+class MemoryUploader(uploads.BaseUploader):
+    def __init__(self, storage, failures=None, **options):
+        super().__init__(storage, **options)
+        self.failures = failures or {}
+        self.uploads = {}
+        self.completed = {}
+        self.aborted = []
+        self.lock = threading.Lock()
+
+    def begin(self, name):
+        self.uploads[name] = {}
+        return name
+
+    def upload_part(self, upload, number, data):
+        with self.lock:
+            if self.failures.get(number):
+                self.failures[number] -= 1
+                msg = "Connection reset"
+                raise OSError(msg)
+            self.uploads[upload][number] = data
+        return number
+
+    def complete(self, upload, parts):
+        self.completed[upload] = b"".join(self.uploads[upload][number] for number in parts)
+
+    def abort(self, upload):
+        self.aborted.append(upload)
+
+
+@patch("dbbackup.uploads.RETRY_DELAY", 0)
+class BaseUploaderTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        self.storage = FakeStorage()
+        self.data = bytes(range(256)) * 1000
+
+    def test_upload(self):
+        uploader = MemoryUploader(self.storage, part_size=10000, threads=4)
+        assert uploader.upload(BytesIO(self.data), "foo.gz") == "foo.gz"
+        assert uploader.completed["foo.gz"] == self.data
+        assert len(uploader.uploads["foo.gz"]) == 26
+        assert not HANDLED_FILES["written_files"]
+
+    def test_small_file(self):
+        uploader = MemoryUploader(self.storage, part_size=len(self.data))
+        uploader.upload(BytesIO(self.data), "foo.gz")
+        assert not uploader.uploads
+        assert HANDLED_FILES["written_files"][0][0] == "foo.gz"
+
+    def test_exact_parts(self):
+        uploader = MemoryUploader(self.storage, part_size=len(self.data) // 2, threads=2)
+        uploader.upload(BytesIO(self.data), "foo.gz")
+        assert uploader.completed["foo.gz"] == self.data
+        assert len(uploader.uploads["foo.gz"]) == 2
+
+    def test_retry_part(self):
+        uploader = MemoryUploader(self.storage, failures={3: 2}, part_size=10000, threads=4, retries=2)
+        uploader.upload(BytesIO(self.data), "foo.gz")
+        assert uploader.completed["foo.gz"] == self.data
+        assert not uploader.aborted
+
+    def test_abort(self):
+        uploader = MemoryUploader(self.storage, failures={3: 3}, part_size=10000, threads=4, retries=2)
+        with pytest.raises(OSError, match="Connection reset"):
+            uploader.upload(BytesIO(self.data), "foo.gz")
+        assert uploader.aborted == ["foo.gz"]
+        assert not uploader.completed
+
+    def test_max_parts(self):
+        uploader = MemoryUploader(self.storage, part_size=1000, threads=4)
+        uploader.max_parts = 10
+        uploader.upload(BytesIO(self.data), "foo.gz")
+        assert uploader.completed["foo.gz"] == self.data
+        # Parts are made larger to stay within the limit
+        assert len(uploader.uploads["foo.gz"]) == 10
+
+    def test_max_parts_stream(self):
+        uploader = MemoryUploader(self.storage, part_size=10000, threads=4)
+        uploader.max_parts = 10
+        stream = IterStream([self.data[i : i + 1000] for i in range(0, len(self.data), 1000)])
+        with pytest.raises(ValueError, match="more than 10 parts"):
+            uploader.upload(stream, "foo.gz")
+        assert uploader.aborted == ["foo.gz"]
+        assert len(uploader.uploads["foo.gz"]) <= 10
+
+
+class S3Storage(FakeStorage):
+    bucket_name = "bucket"
+
+    def _normalize_name(self, name):
+        return f"backups/{name}"
+
+    def _get_write_parameters(self, name, content=None):
+        return {"ContentType": "application/gzip"}
+
+
+class S3UploaderTest(TestCase):
+    def setUp(self):
+        self.storage = S3Storage()
+        self.storage.connection = Mock()
+        self.client = self.storage.connection.meta.client
+        self.client.create_multipart_upload.return_value = {"UploadId": "42"}
+        self.client.upload_part.side_effect = lambda PartNumber, **kwargs: {"ETag": f"etag{PartNumber}"}
+
+    def test_get_uploader(self):
+        assert isinstance(uploads.get_uploader(self.storage), uploads.S3Uploader)
+        assert uploads.get_uploader(FakeStorage()) is None
+
+    def test_min_part_size(self):
+        uploader = uploads.S3Uploader(self.storage, part_size=1024)
+        assert uploader.part_size == 5 * 1024 * 1024
+
+    def test_max_parts(self):
+        uploader = uploads.S3Uploader(self.storage, threads=2)
+        uploader.part_size = 4
+        uploader.upload(BytesIO(b"0" * 40001), "foo.gz")
+        # S3 accepts at most 10,000 parts
+        assert self.client.upload_part.call_count == 8001
+
+    def test_upload(self):
+        uploader = uploads.S3Uploader(self.storage, threads=2)
+        uploader.part_size = 4
+        uploader.upload(BytesIO(b"0123456789"), "foo.gz")
+        self.client.create_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="backups/foo.gz", ContentType="application/gzip"
+        )
+        assert self.client.upload_part.call_count == 3
+        self.client.complete_multipart_upload.assert_called_once_with(
+            Bucket="bucket",
+            Key="backups/foo.gz",
+            UploadId="42",
+            MultipartUpload={"Parts": [{"ETag": f"etag{i}", "PartNumber": i} for i in (1, 2, 3)]},
+        )
+        self.client.abort_multipart_upload.assert_not_called()
+
+    @patch("dbbackup.uploads.RETRY_DELAY", 0)
+    def test_abort(self):
+        self.client.upload_part.side_effect = OSError("Connection reset")
+        uploader = uploads.S3Uploader(self.storage, threads=2, retries=1)
+        uploader.part_size = 4
+        with pytest.raises(OSError, match="Connection reset"):
+            uploader.upload(BytesIO(b"0123456789"), "foo.gz")
+        self.client.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key="backups/foo.gz", UploadId="42")
+        self.client.complete_multipart_upload.assert_not_called()
+
+
+class GoogleCloudStorage(FakeStorage):
+    pass
+
+
+class GoogleCloudUploaderTest(TestCase):
+    def setUp(self):
+        self.storage = GoogleCloudStorage()
+        self.storage.bucket = Mock()
+        self.storage.bucket.get_blob.return_value = None
+        self.blob = Mock()
+        self.writer = self.blob.open.return_value
+        self.uploader = uploads.GoogleCloudUploader(self.storage)
+        self.uploader.part_size = 4
+        self.upload = {"blob": self.blob, "writer": self.writer, "generation": None}
+        begin = patch.object(uploads.GoogleCloudUploader, "begin", return_value=self.upload)
+        begin.start()
+        self.addCleanup(begin.stop)
+
+    def test_get_uploader(self):
+        assert isinstance(uploads.get_uploader(self.storage), uploads.GoogleCloudUploader)
+
+    def test_part_size(self):
+        uploader = uploads.GoogleCloudUploader(self.storage, part_size=1024 * 1024 + 1000)
+        assert uploader.part_size == 1024 * 1024
+
+    def test_upload(self):
+        self.uploader.upload(BytesIO(b"0123456789"), "foo.gz")
+        assert [call.args[0] for call in self.writer.write.call_args_list] == [b"0123", b"4567", b"89"]
+        self.writer.close.assert_called_once_with()
+        self.writer.terminate.assert_not_called()
+
+    def test_abort(self):
+        self.writer.write.side_effect = [None, OSError("Connection reset")]
+        with pytest.raises(OSError, match="Connection reset"):
+            self.uploader.upload(BytesIO(b"0123456789"), "foo.gz")
+        # The session is cancelled, the partial data is never finalized
+        self.writer.terminate.assert_called_once_with()
+        self.writer.close.assert_not_called()
+        self.storage.bucket.get_blob.assert_called_once_with(self.blob.name)
+
+    def test_abort_without_terminate(self):
+        # google-cloud-storage < 3.0
+        self.upload["writer"] = Mock(spec=["write", "close"])
+        self.upload["writer"].write.side_effect = OSError("Connection reset")
+        with pytest.raises(OSError, match="Connection reset"):
+            self.uploader.upload(BytesIO(b"0123456789"), "foo.gz")
+        self.upload["writer"].close.assert_not_called()
+
+    def test_abort_deletes_finalized_object(self):
+        self.upload["generation"] = 1
+        finalized = self.storage.bucket.get_blob.return_value = Mock(generation=2)
+        self.writer.close.side_effect = OSError("Connection reset")
+        with pytest.raises(OSError, match="Connection reset"):
+            self.uploader.upload(BytesIO(b"0123456789"), "foo.gz")
+        finalized.delete.assert_called_once_with(if_generation_match=2)
+
+    def test_abort_keeps_previous_object(self):
+        # The previous backup under the name, with file_overwrite
+        self.upload["generation"] = 1
+        previous = self.storage.bucket.get_blob.return_value = Mock(generation=1)
+        self.writer.close.side_effect = OSError("Connection reset")
+        with pytest.raises(OSError, match="Connection reset"):
+            self.uploader.upload(BytesIO(b"0123456789"), "foo.gz")
+        previous.delete.assert_not_called()
+
+
+class StorageUploadFileTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        self.storage = get_storage()
+
+    def test_fallback_to_save(self):
+        assert self.storage.upload_file(BytesIO(b"foo"), "foo.gz") == "foo.gz"
+        assert HANDLED_FILES["written_files"][0][0] == "foo.gz"
+
+    @patch("dbbackup.settings.MULTIPART_UPLOAD", {"PART_SIZE": 2})
+    def test_write_file(self):
+        uploader = MemoryUploader(self.storage.storage)
+        with patch("dbbackup.uploads.get_uploader", return_value=uploader) as mock_get_uploader:
+            self.storage.write_file(BytesIO(b"foobar"), "foo.gz")
+        mock_get_uploader.assert_called_once_with(self.storage.storage, part_size=None, threads=None, retries=None)
+        assert uploader.part_size == 2
+        assert uploader.completed["foo.gz"] == b"foobar"
@@ -1,18 +1,22 @@
+import gc
+import gzip
+import io
 import os
 import shlex
 import shutil
 import tempfile
 import unittest
 from datetime import datetime, timezone
-from io import StringIO
+from io import BytesIO, StringIO
 from unittest.mock import patch
 
 import django
 import pytest
 from django.core import mail
+from django.core.files import File
 from django.test import TestCase
 
-from dbbackup import settings, utils
+from dbbackup import encryption, settings, utils
 from tests.utils import (
     COMPRESSED_FILE,
     ENCRYPTED_FILE,
@@ -166,6 +170,89 @@ class UnencryptFileTest(TestCase):
             assert uncryptfile.read() == b"foo\n"
 
 
+@unittest.skipIf(not GPG_AVAILABLE, "gpg executable not available")
+class EncryptStreamTest(TestCase):
+    def setUp(self):
+        add_public_gpg()
+        add_private_gpg()
+        self.addCleanup(clean_gpg_keys)
+
+    def _roundtrip(self, data=b"foo" * 100000):
+        stream, filename = utils.encrypt_stream(BytesIO(data), "foo.txt")
+        assert filename == "foo.txt.gpg"
+        assert isinstance(stream, utils.IterStream)
+        encrypted = stream.read()
+        assert data not in encrypted
+        with patch("dbbackup.utils.getpass", return_value=None):
+            stream, filename = utils.unencrypt_stream(BytesIO(encrypted), "foo.txt.gpg")
+        assert filename == "foo.txt"
+        assert stream.read() == data
+
+    def test_func(self):
+        self._roundtrip()
+
+    @patch("dbbackup.utils.settings.GPG_RECIPIENT", ["test@test", "7438 8D4E 02AF C011 4E2F  1E79 F7D1 BBF0 1F63 FDE9"])
+    def test_multiple_recipients(self):
+        self._roundtrip()
+
+    @patch("dbbackup.utils.settings.GPG_SYMMETRIC", True)
+    @patch("dbbackup.utils.settings.GPG_PASSPHRASE", "secret")
+    def test_symmetric(self):
+        self._roundtrip()
+
+    @patch("dbbackup.utils.settings.GPG_RECIPIENT", None)
+    def test_no_recipient(self):
+        with pytest.raises(utils.EncryptionError, match="no recipient"):
+            utils.encrypt_stream(BytesIO(b"foo"), "foo.txt")
+
+    @patch("dbbackup.utils.getpass", return_value=None)
+    def test_unencrypt_file(self, *args):
+        with open(ENCRYPTED_FILE, "rb") as inputfile:
+            stream, filename = utils.unencrypt_stream(inputfile, "foofile.gpg")
+            assert stream.read() == b"foo\n"
+        assert filename == "foofile"
+
+    @patch("dbbackup.utils.getpass", return_value=None)
+    def test_unencrypt_failure(self, *args):
+        stream, _filename = utils.unencrypt_stream(BytesIO(b"foo"), "foo.gpg")
+        with pytest.raises(utils.DecryptionError, match="Decryption failed"):
+            stream.read()
+
+    def test_input_failure(self):
+        inputfile = utils.IterStream(_raise_after(b"foo", OSError("Read failed")))
+        stream, _filename = utils.encrypt_stream(inputfile, "foo.txt")
+        with pytest.raises(OSError, match="Read failed"):
+            stream.read()
+
+    def test_close(self):
+        stream, _filename = utils.encrypt_stream(BytesIO(b"foo" * 1000000), "foo.txt")
+        assert stream.read(10)
+        stream.close()
+
+    def test_close_before_read(self):
+        stream, _filename = utils.encrypt_stream(BytesIO(b"foo" * 1000000), "foo.txt")
+        output = stream._iterator
+        # gpg's error output, closed with the process
+        stderr = output._release_callback.__self__
+        stream.close()
+        assert output._process.returncode is not None
+        assert not output._feeder.is_alive()
+        assert stderr.closed
+
+    def test_unreferenced_before_read(self):
+        output = encryption.GpgBackend().iter_encrypt(BytesIO(b"foo" * 1000000))
+        process, thread = output._process, output._feeder
+        del output
+        gc.collect()
+        assert process.returncode is not None
+        assert not thread.is_alive()
+
+
+def _raise_after(chunk, error):
+    yield chunk
+    raise error
+
+
 @unittest.skipIf(not GPG_AVAILABLE, "gpg executable not available")
 class CompressFileTest(TestCase):
     def setUp(self):
@@ -222,6 +309,114 @@ class UncompressFileTest(TestCase):
             fd.seek(0)
             assert fd.read() == b"foo\n"
 
+    @patch("dbbackup.utils.settings.TMP_FILE_MAX_SIZE", 1024)
+    def test_larger_than_max_size(self):
+        # The decompressed data is copied, not the compressed file
+        data = os.urandom(64 * 1024) * 4
+        with tempfile.TemporaryFile() as fd:
+            fd.write(gzip.compress(data))
+            fd.seek(0)
+            outputfile, filename = utils.uncompress_file(fd, "foo.psql.gz")
+        assert filename == "foo.psql"
+        outputfile.seek(0)
+        assert outputfile.read() == data
+
+
+class IterStreamTest(TestCase):
+    def test_read(self):
+        stream = utils.IterStream([b"foo", b"", b"bar"])
+        assert stream.read(2) == b"fo"
+        assert stream.read() == b"obar"
+        assert stream.tell() == 6
+
+    def test_readline(self):
+        stream = utils.IterStream([b"foo\nba", b"", b"r\n\nbaz", memoryview(b"\nqux")])
+        assert stream.readline(2) == b"fo"
+        assert list(stream) == [b"o\n", b"bar\n", b"\n", b"baz\n", b"qux"]
+        assert stream.tell() == 16
+
+    def test_readline_reads_chunks(self):
+        # Lines are not read byte by byte
+        stream = utils.IterStream([b"foo\n" * 10000] * 10)
+        with patch.object(utils.IterStream, "readinto", side_effect=AssertionError):
+            assert sum(1 for _line in stream) == 100000
+
+    def test_seek_start(self):
+        stream = utils.IterStream([b"foo"])
+        assert stream.seek(0) == 0
+        stream.read(1)
+        with pytest.raises(io.UnsupportedOperation):
+            stream.seek(0)
+
+
+class ClosingIteratorTest(TestCase):
+    def test_released_at_end(self):
+        released = []
+        chunks = utils.ClosingIterator([b"foo", b"bar"], release=lambda: released.append(True))
+        assert list(chunks) == [b"foo", b"bar"]
+        assert released == [True]
+        chunks.close()
+        assert released == [True]
+
+    def test_released_on_error(self):
+        released = []
+        chunks = utils.ClosingIterator(
+            _raise_after(b"foo", OSError("Read failed")), release=lambda: released.append(True)
+        )
+        assert next(chunks) == b"foo"
+        with pytest.raises(OSError, match="Read failed"):
+            next(chunks)
+        assert released == [True]
+        assert list(chunks) == []
+
+    def test_close_before_read(self):
+        released = []
+        generator = _raise_after(b"foo", OSError("Read failed"))
+        utils.ClosingIterator(generator, release=lambda: released.append(True)).close()
+        assert released == [True]
+        # The generator is closed too
+        assert list(generator) == []
+
+
+class CompressStreamTest(TestCase):
+    def test_func(self):
+        stream, filename = utils.compress_stream(BytesIO(b"foo" * 1000), "foo")
+        assert filename == "foo.gz"
+        assert gzip.decompress(stream.read()) == b"foo" * 1000
+
+
+class UncompressStreamTest(TestCase):
+    def test_func(self):
+        with open(COMPRESSED_FILE, "rb") as inputfile:
+            stream, filename = utils.uncompress_stream(inputfile, "foo.gz")
+            assert filename == "foo"
+            assert stream.read() == b"foo\n"
+
+    def test_multiple_members(self):
+        inputfile = BytesIO(gzip.compress(b"foo") + gzip.compress(b"bar"))
+        stream, _filename = utils.uncompress_stream(inputfile, "foo.gz")
+        assert stream.read() == b"foobar"
+
+    def test_truncated(self):
+        inputfile = BytesIO(gzip.compress(b"foo" * 1000)[:-10])
+        stream, _filename = utils.uncompress_stream(inputfile, "foo.gz")
+        with pytest.raises(EOFError):
+            stream.read()
+
+
+class HasFilenoTest(TestCase):
+    def test_func(self):
+        assert not utils.has_fileno(BytesIO())
+        assert not utils.has_fileno(utils.create_spooled_temporary_file())
+        with tempfile.TemporaryFile() as fd:
+            assert utils.has_fileno(fd)
+            assert utils.has_fileno(File(fd))
+
+    def test_decoder(self):
+        # Decoders give the file descriptor of the data they decode
+        with tempfile.TemporaryFile() as fd:
+            assert not utils.has_fileno(gzip.GzipFile(fileobj=fd, mode="rb"))
+
 
 class CreateSpooledTemporaryFileTest(TestCase):
     def setUp(self):
@@ -233,7 +428,73 @@ class CreateSpooledTemporaryFileTest(TestCase):
         os.remove(self.path)
 
     def test_func(self, *args):
-        utils.create_spooled_temporary_file(filepath=self.path)
+        spooled_file = utils.create_spooled_temporary_file(filepath=self.path)
+        spooled_file.seek(0)
+        assert spooled_file.read() == b"foo"
+        assert not spooled_file._rolled
+
+    @patch("dbbackup.utils.settings.TMP_FILE_MAX_SIZE", 2)
+    def test_larger_than_max_size(self):
+        with patch("dbbackup.utils.copyfileobj") as mock_copyfileobj:
+            spooled_file = utils.create_spooled_temporary_file(filepath=self.path)
+        # Written on disk in the kernel, nothing is left to copy in Python
+        assert spooled_file._rolled
+        assert mock_copyfileobj.call_args.args[0].closed
+        spooled_file.seek(0)
+        assert spooled_file.read() == b"foo"
+
+
+class CopyFileTest(TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryFile()
+        self.src.write(b"foo" * 10000)
+        self.src.seek(0)
+        self.dst = tempfile.TemporaryFile()
+        self.addCleanup(self.src.close)
+        self.addCleanup(self.dst.close)
+
+    def test_files(self):
+        with patch("dbbackup.utils.copyfileobj") as mock_copyfileobj:
+            utils.copy_file(self.src, self.dst)
+        mock_copyfileobj.assert_called_once()
+        assert self.src.tell() == self.dst.tell() == 30000
+        self.dst.seek(0)
+        assert self.dst.read() == b"foo" * 10000
+
+    def test_from_position(self):
+        self.src.seek(3)
+        self.dst.write(b"bar")
+        utils.copy_file(self.src, self.dst)
+        assert self.src.tell() == 30000
+        self.dst.seek(0)
+        assert self.dst.read() == b"bar" + b"foo" * 9999
+
+    @patch("dbbackup.utils._reflink", return_value=False)
+    def test_without_reflink(self, *args):
+        utils.copy_file(self.src, self.dst)
+        self.dst.seek(0)
+        assert self.dst.read() == b"foo" * 10000
+
+    def test_unsupported_kernel_copy(self):
+        with (
+            patch("dbbackup.utils._reflink", return_value=False),
+            patch("dbbackup.utils.os.copy_file_range", side_effect=OSError, create=True),
+            patch("dbbackup.utils.os.sendfile", side_effect=OSError, create=True),
+        ):
+            utils.copy_file(self.src, self.dst)
+        self.dst.seek(0)
+        assert self.dst.read() == b"foo" * 10000
+
+    def test_in_memory(self):
+        dst = BytesIO()
+        utils.copy_file(self.src, dst)
+        assert dst.getvalue() == b"foo" * 10000
+        self.dst.write(b"bar")
+        self.dst.seek(0)
+        spooled_file = utils.create_spooled_temporary_file()
+        utils.copy_file(self.dst, spooled_file)
+        spooled_file.seek(0)
+        assert spooled_file.read() == b"bar"
 
 
 class TimestampTest(TestCase):
@@ -248,6 +509,56 @@ class TimestampTest(TestCase):
             assert timestamp == "2015-08-15-101512"
 
 
+class ParseBackupNameTest(TestCase):
+    def test_db(self):
+        backup = utils.parse_backup_name("foodb-fooserver-2015-02-06-042810.psql.gz.gpg")
+        assert backup.database == "foodb"
+        assert backup.servername == "fooserver"
+        assert backup.date == datetime(2015, 2, 6, 4, 28, 10)
+        assert backup.extension == "psql.gz.gpg"
+        assert backup.content_type == "db"
+        assert backup.encrypted
+        assert backup.compressed
+        assert backup.is_backup
+
+    def test_media(self):
+        backup = utils.parse_backup_name("fooserver-2015-02-06-042810.tar")
+        assert backup.servername == "fooserver"
+        assert backup.database is None
+        assert backup.content_type == "media"
+        assert not backup.compressed
+
+    def test_not_backup(self):
+        assert not utils.parse_backup_name("foo.txt").is_backup
+        assert not utils.parse_backup_name("foodb-fooserver-2015-02-06-042810.psql.metadata").is_backup
+
+    @patch("dbbackup.settings.FILENAME_TEMPLATE", callable_for_filename_template)
+    def test_callable_template(self):
+        backup = utils.parse_backup_name("2015-02-06-042810-foodb.psql")
+        assert backup.date == datetime(2015, 2, 6, 4, 28, 10)
+        assert backup.database is None
+
+    def test_cached(self):
+        name = "foodb-fooserver-2015-02-06-042810.psql"
+        assert utils.parse_backup_name(name) is utils.parse_backup_name(name)
+        assert utils.datefmt_to_regex(settings.DATE_FORMAT) is utils.datefmt_to_regex(settings.DATE_FORMAT)
+
+    def test_encryption_backend(self):
+        name = "foodb-fooserver-2015-02-06-042810.psql.gz.rot"
+        assert not utils.parse_backup_name(name).encrypted
+        # Parsed again with the backend whose extension marks encrypted files
+        with patch("dbbackup.settings.ENCRYPTION", {"BACKEND": "tests.test_encryption.CustomBackend"}):
+            backup = utils.parse_backup_name(name)
+            assert backup.encrypted
+            assert backup.compressed
+
+    def test_matches(self):
+        backup = utils.parse_backup_name("foodb-fooserver-2015-02-06-042810.psql.gz")
+        assert backup.matches(compressed=True, content_type="db", database="foodb", servername="fooserver")
+        assert not backup.matches(encrypted=True)
+        assert not backup.matches(content_type="media")
+
+
 class DatefmtToRegex(TestCase):
     def test_patterns(self):
         now = datetime.now()
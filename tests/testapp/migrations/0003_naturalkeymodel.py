@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0002_textmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NaturalKeyModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('parent', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='testapp.naturalkeymodel')),
+            ],
+        ),
+    ]
@@ -19,3 +19,19 @@ class ManyToManyModel(models.Model):
 
 class FileModel(models.Model):
     field = models.FileField(upload_to=".")
+
+
+class NaturalKeyManager(models.Manager):
+    def get_by_natural_key(self, name):
+        return self.get(name=name)
+
+
+class NaturalKeyModel(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    parent = models.ForeignKey("self", null=True, on_delete=models.CASCADE)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = NaturalKeyManager()
+
+    def natural_key(self):
+        return (self.name,)